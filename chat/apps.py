@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (keeps the FAQ index in sync)
+        from .faq_index import load_persisted_index
+
+        # Map the prebuilt FAQ index so the first chat message skips a full rebuild
+        load_persisted_index()
+
+        from django.conf import settings
+        if getattr(settings, 'LLM_WARM_UP', False):
+            from .llm import warm_up
+            warm_up()
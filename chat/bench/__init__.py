@@ -0,0 +1,5 @@
+"""
+Retrieval benchmark: synthetic FAQ corpora, query sets with known answers,
+and a runner that reports latency, throughput, memory and ranking quality
+for every FAQ matching strategy. Driven by `manage.py bench_retrieval`.
+"""
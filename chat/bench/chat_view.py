@@ -0,0 +1,203 @@
+"""
+Concurrent-request capacity of the chat POST view under ASGI.
+
+Both views are driven through Django's ASGIHandler in-process, with the
+FakeBackend standing in for Gemini (settings.LLM_FAKE_DELAY makes it slow).
+sync_chat_post is the pre-async view kept here as the baseline. Under ASGI
+Django runs each sync request in a thread of its own, which it holds for the
+whole LLM wait; the async view only borrows threads for ORM and retrieval
+work. Besides latency and throughput, the report has the peak number of
+threads alive during each burst, which is what caps a real deployment.
+
+With FAQs seeded, retrieval embeds every message; SlowEmbedder stands in for
+the remote embedder (settings.FAQ_FAKE_EMBED_DELAY makes it slow).
+"""
+import asyncio
+import contextlib
+import io
+import json
+import threading
+import time
+from importlib import import_module
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.http import JsonResponse
+from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
+
+from .. import faq_index, llm, views
+from ..conversation import get_bot, get_or_create_session, recent_history, save_message
+from ..models import FAQ, UserProfile
+from ..pipeline import FAQ_ANSWER, GROUNDED, decide
+from ..embeddings import HashingEmbedder
+from ..services import get_gemini_response
+from .corpus import generate_corpus
+from .runner import latency_stats, populate
+
+# Questions no FAQ answers, so every request goes through the LLM
+MESSAGE = 'Tell me something about request number {n} that nobody has asked before'
+
+
+class SlowEmbedder(HashingEmbedder):
+    """HashingEmbedder whose queries take FAQ_FAKE_EMBED_DELAY seconds, like a remote API."""
+
+    def __init__(self, dim=256):
+        super().__init__(dim)
+        self.delay = getattr(settings, 'FAQ_FAKE_EMBED_DELAY', 0.0)
+
+    def embed_queries(self, texts):
+        time.sleep(self.delay)
+        return super().embed_queries(texts)
+
+    async def aembed_queries(self, texts):
+        await asyncio.sleep(self.delay)
+        return super().embed_queries(texts)
+
+
+def sync_chat_post(request):
+    """The chat POST path as it was before the view went async."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'login required'}, status=403)
+    user_message = request.POST.get('message')
+    user_profile, _ = UserProfile.objects.get_or_create(user=request.user)
+    chat_session, session_id = get_or_create_session(user_profile, request.POST.get('session_id'))
+    selected_bot = get_bot(request.POST.get('bot_id'))
+    save_message(chat_session, 'user', user_message)
+    decision = decide(user_message, bot_config=selected_bot)
+    if decision.action == FAQ_ANSWER:
+        bot_response = decision.answer
+    else:
+        passages = decision.passages() if decision.action == GROUNDED else None
+        bot_response = get_gemini_response(user_message, bot_config=selected_bot, passages=passages,
+                                           history=recent_history(chat_session))
+    save_message(chat_session, 'bot', bot_response)
+    return JsonResponse({'response': bot_response, 'session_id': session_id})
+
+
+urlpatterns = [
+    path('sync/', csrf_exempt(sync_chat_post)),
+    path('async/', csrf_exempt(views.chat)),
+]
+
+VIEWS = {'sync': '/sync/', 'async': '/async/'}
+
+
+def session_cookie(user):
+    """A session cookie header value logging user in."""
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    cookie = SimpleCookie()
+    cookie[settings.SESSION_COOKIE_NAME] = session.session_key
+    return cookie.output(header='', sep='; ').strip()
+
+
+async def post(app, url, data, cookie):
+    """POST form data to the ASGI app; returns (status, body bytes)."""
+    body = urlencode(data).encode()
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'POST', 'scheme': 'http', 'path': url, 'raw_path': url.encode(),
+        'query_string': b'', 'root_path': '',
+        'headers': [
+            (b'host', b'testserver'),
+            (b'content-type', b'application/x-www-form-urlencoded'),
+            (b'content-length', str(len(body)).encode()),
+            (b'cookie', cookie.encode()),
+        ],
+        'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+    }
+    incoming = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    status, chunks = None, []
+
+    async def receive():
+        if incoming:
+            return incoming.pop()
+        # The client never disconnects; the handler stops listening once it has responded
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return status, b''.join(chunks)
+
+
+async def burst(app, url, concurrency, cookie, round_number):
+    """
+    concurrency simultaneous POSTs; returns per-request seconds, the wall time
+    and the peak number of live threads.
+    """
+    peak_threads = threading.active_count()
+    done = asyncio.Event()
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while not done.is_set():
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.01)
+
+    async def one(n):
+        started = time.perf_counter()
+        status, body = await post(app, url, {'message': MESSAGE.format(n=f'{round_number}-{n}')}, cookie)
+        if status != 200 or 'response' not in json.loads(body):
+            raise RuntimeError(f'{url} answered {status}: {body[:200]!r}')
+        return time.perf_counter() - started
+
+    sampler = asyncio.create_task(sample_threads())
+    started = time.perf_counter()
+    try:
+        latencies = await asyncio.gather(*(one(n) for n in range(concurrency)))
+    finally:
+        done.set()
+        await sampler
+    return latencies, time.perf_counter() - started, peak_threads
+
+
+def run(concurrency_levels, view_names=None, rounds=3, faqs=0, log=None):
+    """
+    Time bursts of concurrent POSTs against each view, with faqs synthetic
+    FAQs none of the messages match. Expects a throwaway database and the
+    FakeBackend; ROOT_URLCONF must point at this module.
+    """
+    log = log or (lambda message: None)
+    llm.reset()
+    if FAQ.objects.exists():
+        raise RuntimeError('The chat view benchmark expects an empty FAQ table')
+    populate(generate_corpus(faqs))
+    faq_index.invalidate_faq_index()
+    user = User.objects.create_user('bench', 'bench@example.com', 'bench-password')
+    cookie = session_cookie(user)
+    app = ASGIHandler()
+    results = {}
+    for name in view_names or VIEWS:
+        results[name] = {}
+        for concurrency in concurrency_levels:
+            latencies, wall, peak_threads = [], 0.0, 0
+            # The views print per message; keep that out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                for round_number in range(rounds):
+                    seconds, elapsed, threads = asyncio.run(burst(app, VIEWS[name], concurrency, cookie,
+                                                                  f'{name}-{concurrency}-{round_number}'))
+                    latencies.extend(seconds)
+                    wall += elapsed
+                    peak_threads = max(peak_threads, threads)
+            stats = latency_stats(latencies)
+            # Requests completed per second of wall time, with `concurrency` in flight
+            stats['throughput_qps'] = round(len(latencies) / wall, 2)
+            stats['peak_threads'] = peak_threads
+            results[name][concurrency] = stats
+            log(f"{name} x{concurrency}: {stats['throughput_qps']} req/s, p95 {stats['p95_ms']}ms, "
+                f"{peak_threads} threads")
+    return results
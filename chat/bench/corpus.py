@@ -0,0 +1,119 @@
+"""
+Deterministic synthetic FAQ corpora and query sets.
+
+Each FAQ is about one (action, object, product) triple, with the product
+drawn from generated pseudo-words so corpora of any size stay unique.
+Queries name the same triple in other words (paraphrase) or with typing
+mistakes (typo), and remember which FAQ they should retrieve.
+"""
+import random
+from collections import namedtuple
+
+ACTIONS = {
+    'reset': ['change', 'recover'],
+    'cancel': ['stop', 'terminate'],
+    'update': ['modify', 'edit'],
+    'install': ['setup', 'deploy'],
+    'export': ['download', 'save'],
+    'delete': ['remove', 'erase'],
+    'activate': ['enable', 'turn on'],
+    'renew': ['extend', 'prolong'],
+    'share': ['send', 'forward'],
+    'transfer': ['move', 'migrate'],
+}
+OBJECTS = {
+    'password': ['passcode', 'login secret'],
+    'subscription': ['plan', 'membership'],
+    'invoice': ['bill', 'receipt'],
+    'account': ['profile', 'user record'],
+    'order': ['purchase', 'booking'],
+    'address': ['location', 'postal details'],
+    'report': ['summary', 'statement'],
+    'device': ['gadget', 'hardware'],
+    'license': ['permit', 'key'],
+    'notification': ['alert', 'reminder'],
+}
+QUESTION_TEMPLATES = [
+    "How do I {action} the {obj} for {product}?",
+    "Can I {action} my {product} {obj}?",
+    "What happens when I {action} a {product} {obj}?",
+    "Where can I {action} {product} {obj} settings?",
+]
+PARAPHRASE_TEMPLATES = [
+    "{product} {obj} {action} steps",
+    "is it possible to {action} {obj} on {product}",
+    "need help: {action} {product} {obj}",
+    "{action} {obj} {product}?",
+    "what is the way to {action} the {obj} of my {product}",
+]
+SYLLABLES = ['ka', 'zo', 'ri', 'mu', 'ten', 'vex', 'lo', 'qua', 'bri', 'sol', 'nar', 'dy',
+             'pim', 'ul', 'gor', 'fae', 'wix', 'tro', 'hel', 'jun', 'cy', 'ost', 'ra', 'be']
+PAIRS_PER_PRODUCT = len(ACTIONS) * len(OBJECTS)
+QUERY_KINDS = ('paraphrase', 'typo')
+
+SyntheticFAQ = namedtuple('SyntheticFAQ', ['question', 'answer', 'keywords', 'action', 'obj', 'product'])
+Query = namedtuple('Query', ['text', 'target', 'kind'])
+
+
+def product_names(n, rng):
+    """n distinct pronounceable pseudo-words."""
+    names = set()
+    while len(names) < n:
+        names.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(names)
+
+
+def generate_corpus(size, seed=0):
+    """size SyntheticFAQs, each about a distinct (action, object, product)."""
+    rng = random.Random(seed)
+    products = product_names(-(-size // PAIRS_PER_PRODUCT), rng)
+    actions, objects = list(ACTIONS), list(OBJECTS)
+    faqs = []
+    for i in rng.sample(range(len(products) * PAIRS_PER_PRODUCT), size):
+        product = products[i // PAIRS_PER_PRODUCT]
+        action = actions[i // len(objects) % len(actions)]
+        obj = objects[i % len(objects)]
+        question = rng.choice(QUESTION_TEMPLATES).format(action=action, obj=obj, product=product)
+        answer = (f"To {action} the {obj} for {product}, open Settings > {obj.title()} "
+                  f"and choose {action.title()}. Reference {product.upper()}-{i}.")
+        keywords = f"{action} {product} {obj},{product} {obj}"
+        faqs.append(SyntheticFAQ(question, answer, keywords, action, obj, product))
+    return faqs
+
+
+def paraphrase(faq, rng):
+    action = rng.choice(ACTIONS[faq.action]) if rng.random() < 0.7 else faq.action
+    obj = rng.choice(OBJECTS[faq.obj]) if rng.random() < 0.7 else faq.obj
+    return rng.choice(PARAPHRASE_TEMPLATES).format(action=action, obj=obj, product=faq.product)
+
+
+def add_typo(word, rng):
+    """One random deletion, insertion, substitution or transposition."""
+    i = rng.randrange(1, len(word) - 1)
+    edit = rng.randrange(4)
+    if edit == 0:
+        return word[:i] + word[i + 1:]
+    if edit == 1:
+        return word[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[i:]
+    if edit == 2:
+        return word[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz'.replace(word[i], '')) + word[i + 1:]
+    return word[:i - 1] + word[i] + word[i - 1] + word[i + 1:]
+
+
+def misspell(faq, rng):
+    """The FAQ's question with up to two of its longer words mistyped."""
+    words = faq.question.rstrip('?').split()
+    long_words = [i for i, word in enumerate(words) if len(word) >= 5]
+    for i in rng.sample(long_words, min(2, len(long_words))):
+        words[i] = add_typo(words[i], rng)
+    return ' '.join(words)
+
+
+def generate_queries(faqs, faq_ids, count, seed=0):
+    """count queries of each kind in QUERY_KINDS; targets are faq_ids entries."""
+    rng = random.Random(seed + 1)
+    picks = rng.sample(range(len(faqs)), min(count, len(faqs)))
+    return {
+        'paraphrase': [Query(paraphrase(faqs[i], rng), faq_ids[i], 'paraphrase') for i in picks],
+        'typo': [Query(misspell(faqs[i], rng), faq_ids[i], 'typo') for i in picks],
+    }
@@ -0,0 +1,84 @@
+"""
+Throughput of EncryptedTextField's bulk crypto against the per-row path.
+
+Decryption is timed end to end over ChatMessage rows in the database:
+reading .content instance by instance (each value decrypted on its own as
+the descriptor is hit) versus a decrypted() queryset, which decrypts each
+chunk of rows in parallel batches. Encryption compares encrypt() per value
+with encrypt_many(), as bulk_create uses it, both in the binary format
+ChatMessage.content is stored in. Bulk runs are repeated for each
+thread count; the gain depends on the cores available.
+"""
+import contextlib
+import io
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+
+from ..fields import encrypt, encrypt_many
+from ..models import ChatMessage, ChatSession, UserProfile
+
+# Roughly the size of a chat reply
+MESSAGE = 'Message {n}: ' + 'a reply of typical length, a few sentences about the product. ' * 6
+
+
+def seed(rows):
+    """rows ChatMessages in one session; returns their plaintexts."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        user = User.objects.create_user('bench_crypto', 'bench_crypto@example.com', 'bench')
+        profile = UserProfile.objects.create(user=user)
+        session = ChatSession.objects.create(user_profile=profile, session_id='bench-crypto')
+        contents = [MESSAGE.format(n=n) for n in range(rows)]
+        ChatMessage.objects.bulk_create(ChatMessage(session=session, sender='user', content=content)
+                                        for content in contents)
+    return contents
+
+
+def best_rate(fn, rows, repeats):
+    """Rows per second of the fastest of repeats runs of fn()."""
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return round(rows / best, 1)
+
+
+def run(rows=10000, thread_counts=(1, 2, 4, 8), batch_size=256, repeats=3, log=None):
+    """Rows/second per path and thread count. Expects a throwaway database."""
+    log = log or (lambda message: None)
+    contents = seed(rows)
+
+    def read_per_row():
+        for message in ChatMessage.objects.all():
+            message.content
+
+    def read_bulk():
+        for message in ChatMessage.objects.decrypted():
+            message.content
+
+    results = {
+        'rows': rows,
+        'cpu_count': os.cpu_count(),
+        'batch_size': batch_size,
+        'decrypt_per_row': best_rate(read_per_row, rows, repeats),
+        'encrypt_per_row': best_rate(lambda: [encrypt(content, True) for content in contents], rows, repeats),
+        'bulk': [],
+    }
+    log(f"per row: decrypt {results['decrypt_per_row']} rows/s, encrypt {results['encrypt_per_row']} rows/s")
+    for threads in thread_counts:
+        with override_settings(ENCRYPTION_THREADS=threads, ENCRYPTION_BATCH_SIZE=batch_size):
+            result = {
+                'threads': threads,
+                'decrypt': best_rate(read_bulk, rows, repeats),
+                'encrypt': best_rate(lambda: encrypt_many(contents, True), rows, repeats),
+            }
+        result['decrypt_speedup'] = round(result['decrypt'] / results['decrypt_per_row'], 2)
+        result['encrypt_speedup'] = round(result['encrypt'] / results['encrypt_per_row'], 2)
+        log(f"{threads} threads: decrypt {result['decrypt']} rows/s (x{result['decrypt_speedup']}), "
+            f"encrypt {result['encrypt']} rows/s (x{result['encrypt_speedup']})")
+        results['bulk'].append(result)
+    return results
@@ -0,0 +1,182 @@
+"""
+Runs every strategy over one synthetic corpus and collects the numbers.
+
+Latency is wall-clock per query; throughput is queries / total time of the
+timed loop. Memory is reported twice: resident set growth while the FAQ
+index is built, and the tracemalloc peak of a few queries per strategy.
+Quality is recall@1, recall@k and MRR against each query's target FAQ.
+"""
+import contextlib
+import gc
+import io
+import os
+import time
+import tracemalloc
+
+import numpy as np
+from django.db import connection
+
+from .. import faq_index
+from ..models import FAQ
+from .corpus import generate_corpus, generate_queries
+from .strategies import STRATEGIES
+
+# Queries per strategy sampled under tracemalloc (it slows everything down)
+MEMORY_SAMPLE = 20
+INSERT_BATCH = 5000
+
+
+def rss_mb():
+    """Current resident set size in MiB (Linux), else peak RSS."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def latency_stats(seconds):
+    if not seconds:
+        return {'queries': 0}
+    ms = np.asarray(seconds) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        'queries': len(ms),
+        'p50_ms': round(float(p50), 4),
+        'p95_ms': round(float(p95), 4),
+        'p99_ms': round(float(p99), 4),
+        'mean_ms': round(float(ms.mean()), 4),
+        'throughput_qps': round(len(ms) / (ms.sum() / 1000), 2) if ms.sum() else None,
+    }
+
+
+def quality(rankings, targets, k):
+    """recall@1, recall@k and MRR (reciprocal rank within the top k, else 0)."""
+    if not rankings:
+        return {}
+    hits_1 = hits_k = reciprocal = 0.0
+    for ranking, target in zip(rankings, targets):
+        ranking = list(ranking)[:k]
+        if target in ranking:
+            rank = ranking.index(target) + 1
+            hits_1 += rank == 1
+            hits_k += 1
+            reciprocal += 1.0 / rank
+    n = len(rankings)
+    return {'recall@1': round(hits_1 / n, 4), f'recall@{k}': round(hits_k / n, 4), 'mrr': round(reciprocal / n, 4)}
+
+
+def peak_memory_kb(strategy, queries, k):
+    tracemalloc.start()
+    try:
+        for query in queries:
+            strategy(query.text, k)
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def run_strategy(strategy, queries, k, time_budget):
+    """Time strategy over queries, stopping early once time_budget seconds are spent."""
+    latencies, rankings = [], []
+    spent = 0.0
+    for query in queries:
+        started = time.perf_counter()
+        ranking = strategy(query.text, k)
+        elapsed = time.perf_counter() - started
+        latencies.append(elapsed)
+        rankings.append(ranking)
+        spent += elapsed
+        if spent >= time_budget:
+            break
+    result = latency_stats(latencies)
+    result.update(quality(rankings, [query.target for query in queries], k))
+    # Sample no more queries than fit in the time budget
+    result['peak_alloc_kb'] = peak_memory_kb(strategy, queries[:min(MEMORY_SAMPLE, len(latencies))], k)
+    if len(latencies) < len(queries):
+        result['truncated'] = True
+    return result
+
+
+def populate(faqs):
+    """Insert the corpus and return the new FAQ ids, in corpus order."""
+    # EncryptedTextField logs every value it encrypts; keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for start in range(0, len(faqs), INSERT_BATCH):
+            FAQ.objects.bulk_create(
+                FAQ(question=faq.question, answer=faq.answer, keywords=faq.keywords)
+                for faq in faqs[start:start + INSERT_BATCH])
+    ids = dict(FAQ.objects.values_list('question', 'id'))
+    return [ids[faq.question] for faq in faqs]
+
+
+def bench_corpus(size, strategies, query_count=200, k=5, time_budget=10.0, seed=0, log=None):
+    """
+    Benchmark strategies ({name: callable}) on a fresh corpus of size FAQs.
+    The FAQ table must be empty; the caller provides a throwaway database.
+    """
+    log = log or (lambda message: None)
+    started = time.perf_counter()
+    faqs = generate_corpus(size, seed)
+    faq_ids = populate(faqs)
+    queries = generate_queries(faqs, faq_ids, query_count, seed)
+    log(f"{size} FAQs inserted in {time.perf_counter() - started:.1f}s")
+
+    gc.collect()
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    faq_index.invalidate_faq_index()
+    with contextlib.redirect_stdout(io.StringIO()):
+        faq_index.get_faq_index()
+    build_seconds = time.perf_counter() - started
+    result = {
+        'size': size,
+        'index_build_s': round(build_seconds, 3),
+        'index_rss_mb': round(rss_mb() - rss_before, 1),
+        'strategies': {},
+    }
+    log(f"{size} FAQs indexed in {build_seconds:.1f}s")
+
+    for name, strategy in strategies.items():
+        result['strategies'][name] = {}
+        for kind, kind_queries in queries.items():
+            # Decrypting answers logs per row too; see populate()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = run_strategy(strategy, kind_queries, k, time_budget)
+            result['strategies'][name][kind] = stats
+            log(f"{size} {name} {kind}: p50 {stats.get('p50_ms')}ms recall@1 {stats.get('recall@1')}")
+    faq_index.invalidate_faq_index()
+    return result
+
+
+@contextlib.contextmanager
+def fresh_database(test_name=None):
+    """
+    A throwaway test database for the default connection. test_name overrides
+    the test database name (e.g. an on-disk SQLite file instead of :memory:).
+    """
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict['TEST']
+    old_test_name = test_settings.get('NAME')
+    if test_name:
+        test_settings['NAME'] = test_name
+    try:
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    finally:
+        test_settings['NAME'] = old_test_name
+
+
+def run(sizes, strategy_names=None, **options):
+    """Benchmark every size in its own throwaway database."""
+    strategies = {name: STRATEGIES[name] for name in (strategy_names or STRATEGIES)}
+    results = []
+    for size in sizes:
+        with fresh_database():
+            results.append(bench_corpus(size, strategies, **options))
+        gc.collect()
+    return results
@@ -0,0 +1,69 @@
+"""
+FAQ matching strategies under benchmark.
+
+Each strategy takes (query, k) and returns FAQ ids, best first. Strategies
+that pick a single answer return at most one id. The two legacy strategies
+reproduce the matching the app used before the retrieval index existed, so
+every run keeps a fixed baseline to compare against.
+"""
+from .. import faq_index, pipeline
+from ..models import FAQ
+
+
+def legacy_get_faq_answer(query, k):
+    """The original views.get_faq_answer: scan every FAQ's keywords, then icontains."""
+    query_lower = query.lower().strip()
+    for faq in FAQ.objects.all():
+        if any(kw in query_lower for kw in faq.get_keywords_list()):
+            return [faq.pk]
+    try:
+        return [FAQ.objects.get(question__icontains=query).pk]
+    except (FAQ.DoesNotExist, FAQ.MultipleObjectsReturned):
+        return []
+
+
+def legacy_icontains(query, k):
+    """The original chat view match: first FAQ whose question contains the message."""
+    faq = FAQ.objects.filter(question__icontains=query).first()
+    return [faq.pk] if faq else []
+
+
+def get_faq_answer(query, k):
+    """Today's get_faq_answer, including decrypting the matched answer."""
+    match = faq_index.lookup_faq(query)
+    if match is None:
+        return []
+    match.answer
+    return [match.faq_id]
+
+
+def keyword(query, k):
+    return [hit.faq_id for hit in faq_index.get_faq_index().keyword_search(query, k)]
+
+
+def bm25(query, k):
+    return [hit.faq_id for hit in faq_index.search_faqs(query, k)]
+
+
+def fuzzy(query, k):
+    return [hit.faq_id for hit in faq_index.fuzzy_search_faqs(query, k)]
+
+
+def semantic(query, k):
+    return [hit.faq_id for hit in faq_index.get_faq_index().semantic_search(query, k)]
+
+
+def hybrid(query, k):
+    return [candidate.faq_id for candidate in pipeline.retrieve(query, k)]
+
+
+STRATEGIES = {
+    'legacy_get_faq_answer': legacy_get_faq_answer,
+    'legacy_icontains': legacy_icontains,
+    'get_faq_answer': get_faq_answer,
+    'keyword': keyword,
+    'bm25': bm25,
+    'fuzzy': fuzzy,
+    'semantic': semantic,
+    'hybrid': hybrid,
+}
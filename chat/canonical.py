@@ -0,0 +1,31 @@
+"""
+Canonical form of a user query, so that repeats of one question share cache
+entries however they are typed.
+
+"How do I reset my password?" and "how do i RESET my password, please"
+both canonicalise to "how password reset": Unicode NFKC and casefolding,
+punctuation, stopwords and politeness words dropped, and the words of short
+queries sorted. Question words and negations are kept, since they change
+what is being asked.
+"""
+import unicodedata
+
+from .retrieval import STOPWORDS, TOKEN_RE
+
+QUESTION_WORDS = frozenset('how what when where which who why'.split())
+POLITENESS = frozenset('please pls plz kindly thanks thank thx hi hello hey'.split())
+DROPPED = (STOPWORDS - QUESTION_WORDS) | POLITENESS
+# Queries of at most this many words are treated as a bag of words
+SHORT_QUERY_WORDS = 6
+
+
+def canonicalize(text):
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    words = TOKEN_RE.findall(text)
+    kept = [word for word in words if word not in DROPPED]
+    if not set(kept) - QUESTION_WORDS:
+        # Nothing but stopwords ("how are you?"): keep them all rather than collide on "how"
+        kept = words
+    if len(kept) <= SHORT_QUERY_WORDS:
+        kept = sorted(kept)
+    return ' '.join(kept)
@@ -1,57 +1,151 @@
+import asyncio
 import json
-import os
-import google.generativeai as genai
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
+from . import llm, near_duplicates
+from .conversation import (aclaim_message, aget_bot, aget_or_create_session, arecent_history, arelease_message,
+                           asave_message, await_reply)
+from .models import UserProfile
+from .pipeline import FAQ_ANSWER, GROUNDED, adecide
+from .services import StreamInterrupted, astream_gemini_response, join_reply
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
-        self.accept()
 
-    def disconnect(self, close_code):
-        pass
+def validation_error(data):
+    """Why a client frame cannot be answered, or None."""
+    if not isinstance(data, dict):
+        return 'Messages must be JSON objects.'
+    if not isinstance(data.get('message'), str):
+        return 'message must be a string.'
+    client_message_id = data.get('client_message_id')
+    if client_message_id is not None and not isinstance(client_message_id, str):
+        return 'client_message_id must be a string.'
+    if client_message_id and len(client_message_id) > 64:
+        return 'client_message_id must be at most 64 characters.'
+    if not isinstance(data.get('session_id'), (str, type(None))):
+        return 'session_id must be a string.'
+    if not isinstance(data.get('bot_id'), (str, int, type(None))) or isinstance(data.get('bot_id'), bool):
+        return 'bot_id must be a string or number.'
+    return None
 
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    Client sends {"message", "session_id"?, "bot_id"?, "client_message_id"?}.
+    Gemini replies are streamed as {"type": "delta", "delta": ...} frames;
+    every reply ends with {"type": "done", "reply": <full text>, "session_id": ...}.
+    Resending a client_message_id of the session gets just the "done" frame
+    with the reply it already had. A malformed frame, or a failure while
+    answering (including a reply cut off mid-stream, which is not saved),
+    gets a {"type": "error", "error": ...} frame instead.
+
+    Each message is answered in its own task on the event loop, so a slow
+    Gemini call holds no thread; tasks still running when the client
+    disconnects are cancelled.
+    """
+
+    async def connect(self):
+        self.replies = set()
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        for task in self.replies:
+            task.cancel()
+
+    async def receive(self, text_data):
+        task = asyncio.create_task(self.reply(text_data))
+        self.replies.add(task)
+        task.add_done_callback(self.replies.discard)
+
+    async def reply(self, text_data):
+        """Answer one client frame; anything going wrong ends in an "error" frame, not a silent client."""
+        try:
+            try:
+                text_data_json = json.loads(text_data)
+            except ValueError:
+                await self.send_error('Messages must be JSON.')
+                return
+            error = validation_error(text_data_json)
+            if error:
+                await self.send_error(error)
+                return
+            await self.respond(text_data_json)
+        except asyncio.CancelledError:
+            raise  # the client disconnected
+        except StreamInterrupted:
+            # Nothing was saved; the client drops the deltas it got and may resend
+            await self.send_error('The reply was cut off. Please try again.')
+        except Exception as e:
+            print(f"Error answering WebSocket message: {e}")
+            await self.send_error('Something went wrong answering this message. Please try again.')
+
+    async def respond(self, text_data_json):
         message = text_data_json['message']
+        client_message_id = text_data_json.get('client_message_id') or None
+        bot_config = await aget_bot(text_data_json.get('bot_id'))
+
+        # Logged-in users get the exchange saved to their chat session
+        chat_session = session_id = None
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            user_profile, _ = await UserProfile.objects.aget_or_create(user=user)
+            chat_session, session_id = await aget_or_create_session(user_profile, text_data_json.get('session_id'))
+            if client_message_id:
+                # A resent message gets the reply already given (or being given) to it
+                saved_message, created = await aclaim_message(chat_session, message, client_message_id)
+                if not created:
+                    reply = await await_reply(chat_session, saved_message)
+                    if reply is not None:
+                        await self.send_done(reply, session_id)
+                        return
+            else:
+                await asave_message(chat_session, 'user', message)
+
+        try:
+            reply = await self.answer(message, bot_config, chat_session, client_message_id)
+        finally:
+            if chat_session is not None:
+                await arelease_message(chat_session, client_message_id)
+        await self.send_done(reply, session_id)
+
+    async def answer(self, message, bot_config, chat_session, client_message_id):
+        """The reply to message, streaming Gemini deltas as they come; saved if there is a chat_session."""
+        # Answer straight from the FAQ index when retrieval is confident enough
+        decision = await adecide(message, bot_config=bot_config)
+        history = near_duplicate = None
+        if decision.action != FAQ_ANSWER:
+            history = await arecent_history(chat_session) if chat_session is not None else None
+            if not history:
+                # First question of a session: an earlier reply to a near-duplicate will do
+                near_duplicate = await near_duplicates.alookup(message, bot_config)
+        if decision.action == FAQ_ANSWER:
+            reply = decision.answer
+        elif near_duplicate is not None:
+            reply = near_duplicate
+        else:
+            passages = decision.passages() if decision.action == GROUNDED else None
+            # Shared, preconfigured chat model (see llm.py)
+            model = llm.get_model(llm.DEFAULT_MODEL, llm.CHAT_GENERATION_CONFIG, llm.DEFAULT_SAFETY_SETTINGS)
+            parts = []
+            async for delta in astream_gemini_response(message, bot_config=bot_config, passages=passages,
+                                                       history=history, model=model):
+                parts.append(delta)
+                await self.send(text_data=json.dumps({'type': 'delta', 'delta': delta}))
+            reply = join_reply(parts)
+
+        # Persist only once the whole reply is known
+        if chat_session is not None:
+            bot_message = await asave_message(chat_session, 'bot', reply, bot=bot_config,
+                                              client_message_id=client_message_id,
+                                              generated=getattr(reply, 'generated', False))
+            if decision.action != FAQ_ANSWER and near_duplicate is None and not history:
+                await near_duplicates.aremember(message, bot_message, bot_config)
+        return reply
+
+    async def send_error(self, error):
+        await self.send(text_data=json.dumps({'type': 'error', 'error': error}))
 
-        # Configure the Gemini API key
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
-        # Create the model
-        generation_config = {
-            "temperature": 0.9,
-            "top_p": 1,
-            "top_k": 1,
-            "max_output_tokens": 2048,
-        }
-
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_MEDIUM_AND_ABOVE"
-            },
-        ]
-
-        model = genai.GenerativeModel(model_name="gemini-pro-latest",
-                                      generation_config=generation_config,
-                                      safety_settings=safety_settings)
-
-        convo = model.start_chat(history=[])
-        convo.send_message(message)
-        response = convo.last.text
-
-        self.send(text_data=json.dumps({
-            'reply': response
-        }))
\ No newline at end of file
+    async def send_done(self, reply, session_id):
+        await self.send(text_data=json.dumps({
+            'type': 'done',
+            'reply': reply,
+            'session_id': session_id,
+        }))
@@ -0,0 +1,167 @@
+"""
+Chat session helpers shared by the HTTP chat view and the WebSocket consumer.
+The a-prefixed variants use Django's async ORM for async callers.
+
+Clients may tag a message with a client_message_id, unique per session: a
+request repeating one (a retry after a timeout, a resend after a dropped
+connection) gets the reply already stored, or waits for the request still
+computing it, instead of saving the message again and calling Gemini twice.
+"""
+import asyncio
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.utils import timezone
+
+from . import memory, metrics
+from .models import BotConfiguration, ChatMessage, ChatSession
+
+
+def _new_session_id(session_id):
+    """The client's session_id if it is a well-formed UUID, else a fresh one."""
+    try:
+        return str(uuid.UUID(session_id))
+    except (TypeError, ValueError):
+        return str(uuid.uuid4())
+
+
+def get_or_create_session(user_profile, session_id=None):
+    """
+    The user's ChatSession for session_id, or a new session. A new session
+    keeps the client's session_id if it is a UUID nobody has used, so that a
+    resent first message finds the session the original created; otherwise
+    it gets a fresh id. Returns (chat_session, session_id).
+    """
+    if session_id:
+        try:
+            return ChatSession.objects.get(user_profile=user_profile, session_id=session_id), session_id
+        except ChatSession.DoesNotExist:
+            print(f"Provided session_id {session_id} not found for user {user_profile}. Creating new session.")
+    new_id = _new_session_id(session_id)
+    try:
+        return ChatSession.objects.create(user_profile=user_profile, session_id=new_id), new_id
+    except IntegrityError:
+        # Someone else's session (or the user's own, created concurrently)
+        try:
+            return ChatSession.objects.get(user_profile=user_profile, session_id=new_id), new_id
+        except ChatSession.DoesNotExist:
+            new_id = str(uuid.uuid4())
+            return ChatSession.objects.create(user_profile=user_profile, session_id=new_id), new_id
+
+
+def get_bot(bot_id):
+    """BotConfiguration for bot_id, or None if unset/unknown."""
+    if not bot_id:
+        return None
+    try:
+        return BotConfiguration.objects.get(id=bot_id)
+    except (BotConfiguration.DoesNotExist, ValueError):
+        return None
+
+
+def recent_history(chat_session, skip_latest=True):
+    """
+    memory.History of up to LLM_HISTORY_TURNS earlier (sender, content) turns,
+    oldest first, with a summary of the session before them.
+    """
+    return memory.history(memory.load(chat_session), skip_latest)
+
+
+def save_message(chat_session, sender, content, bot=None, client_message_id=None, generated=False):
+    """generated: content is a completed Gemini reply (services.Reply.generated), reusable for near-duplicates."""
+    message = ChatMessage.objects.create(session=chat_session, sender=sender, content=content, bot=bot,
+                                         client_message_id=client_message_id, generated=generated)
+    memory.record(chat_session, message)
+    return message
+
+
+async def aget_or_create_session(user_profile, session_id=None):
+    if session_id:
+        try:
+            return await ChatSession.objects.aget(user_profile=user_profile, session_id=session_id), session_id
+        except ChatSession.DoesNotExist:
+            print(f"Provided session_id {session_id} not found for user {user_profile.pk}. Creating new session.")
+    new_id = _new_session_id(session_id)
+    try:
+        return await ChatSession.objects.acreate(user_profile=user_profile, session_id=new_id), new_id
+    except IntegrityError:
+        try:
+            return await ChatSession.objects.aget(user_profile=user_profile, session_id=new_id), new_id
+        except ChatSession.DoesNotExist:
+            new_id = str(uuid.uuid4())
+            return await ChatSession.objects.acreate(user_profile=user_profile, session_id=new_id), new_id
+
+
+async def aget_bot(bot_id):
+    if not bot_id:
+        return None
+    try:
+        return await BotConfiguration.objects.aget(id=bot_id)
+    except (BotConfiguration.DoesNotExist, ValueError):
+        return None
+
+
+async def arecent_history(chat_session, skip_latest=True):
+    return memory.history(await memory.aload(chat_session), skip_latest)
+
+
+async def asave_message(chat_session, sender, content, bot=None, client_message_id=None, generated=False):
+    message = await ChatMessage.objects.acreate(session=chat_session, sender=sender, content=content, bot=bot,
+                                                client_message_id=client_message_id, generated=generated)
+    await memory.arecord(chat_session, message)
+    return message
+
+
+# Cache marker held while a request computes the reply to a client message id
+REPLYING_KEY = 'replying:{}:{}'
+REPLAY_POLL_INTERVAL = 0.1
+# A replay finding no marker still waits this long after the original was saved,
+# in case it arrived between the original saving its message and setting the marker
+REPLAY_GRACE = 1.0
+
+
+async def aclaim_message(chat_session, content, client_message_id):
+    """
+    Save the user's message tagged client_message_id. Returns (message,
+    created); created is False, with the earlier message, for a replay.
+    """
+    try:
+        message = await asave_message(chat_session, 'user', content, client_message_id=client_message_id)
+    except IntegrityError:
+        message = await chat_session.messages.aget(sender='user', client_message_id=client_message_id)
+        await sync_to_async(metrics.incr, thread_sensitive=False)('chat.replay')
+        return message, False
+    await cache.aset(REPLYING_KEY.format(chat_session.pk, client_message_id), 1, timeout=settings.CHAT_REPLAY_WAIT)
+    return message, True
+
+
+async def arelease_message(chat_session, client_message_id):
+    """The reply to client_message_id is saved (or will never be): stop replays waiting for it."""
+    if client_message_id:
+        await cache.adelete(REPLYING_KEY.format(chat_session.pk, client_message_id))
+
+
+async def await_reply(chat_session, user_message):
+    """
+    The stored bot reply to a replayed user message, waiting up to
+    CHAT_REPLAY_WAIT seconds while another request is still computing it.
+    None if that request failed or died: the caller then takes over (holding
+    the marker, to release with arelease_message) and answers it.
+    """
+    client_message_id = user_message.client_message_id
+    marker = REPLYING_KEY.format(chat_session.pk, client_message_id)
+    deadline = user_message.timestamp + timedelta(seconds=settings.CHAT_REPLAY_WAIT)
+    while True:
+        reply = await chat_session.messages.filter(sender='bot', client_message_id=client_message_id).afirst()
+        if reply is not None:
+            # Decrypting may load the user's data key from the database
+            return await sync_to_async(lambda: reply.content)()
+        now = timezone.now()
+        in_flight = await cache.aget(marker) or now - user_message.timestamp < timedelta(seconds=REPLAY_GRACE)
+        if now >= deadline or (not in_flight and await cache.aadd(marker, 1, timeout=settings.CHAT_REPLAY_WAIT)):
+            return None
+        await asyncio.sleep(REPLAY_POLL_INTERVAL)
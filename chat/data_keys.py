@@ -0,0 +1,110 @@
+"""
+Per-user data keys for chat history (envelope encryption).
+
+Each UserProfile's messages are encrypted with a Fernet key of its own, kept
+in a DataKey row encrypted with the master DJANGO_ENCRYPTION_KEY; a stored
+message names the DataKey it was encrypted with (see fields.KEYED).
+Deleting a user's history shreds their keys instead of deleting the
+messages: the DataKey rows are cleared and the sessions detached from the
+profile in one short transaction, which makes every message under those keys
+unreadable at once however many there are. Messages saved before data keys
+existed are still under the master key: detaching hides them, but they stay
+readable until purge.py deletes the rows, in small batches, in the
+background.
+
+Unwrapped keys are kept per worker for DATA_KEY_CACHE_TTL seconds, which
+bounds how long another worker could still read a detached session's
+messages. The current key of a profile is looked up on every save, so no
+worker encrypts with a shredded key.
+"""
+import threading
+import time
+
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from . import memory, metrics
+from .models import ChatSession, DataKey
+
+_ciphers = {}  # DataKey id -> (Fernet, or None if shredded, expiry)
+_lock = threading.Lock()
+
+
+def _remember(found):
+    expires = time.monotonic() + settings.DATA_KEY_CACHE_TTL
+    with _lock:
+        for key_id, cipher in found.items():
+            _ciphers[key_id] = (cipher, expires)
+
+
+def forget(key_ids=None):
+    """Drop unwrapped keys from this worker's cache (all of them by default)."""
+    with _lock:
+        if key_ids is None:
+            _ciphers.clear()
+        for key_id in key_ids or ():
+            _ciphers.pop(key_id, None)
+
+
+def ciphers(key_ids):
+    """{DataKey id: Fernet, or None if the key was shredded} for key_ids."""
+    now = time.monotonic()
+    found, missing = {}, []
+    with _lock:
+        for key_id in key_ids:
+            cached = _ciphers.get(key_id)
+            if cached is not None and cached[1] > now:
+                found[key_id] = cached[0]
+            else:
+                missing.append(key_id)
+    if missing:
+        # values_list() decrypts the keys, in one batch
+        wrapped = dict(DataKey.objects.filter(id__in=missing, shredded_at__isnull=True).values_list('id', 'key'))
+        loaded = {}
+        for key_id in missing:
+            try:
+                loaded[key_id] = Fernet(wrapped[key_id]) if wrapped.get(key_id) else None
+            except ValueError:  # not decryptable with the master keys
+                metrics.incr('data_keys.unreadable')
+                loaded[key_id] = None
+        _remember(loaded)
+        found.update(loaded)
+    return found
+
+
+def current(user_profile_id):
+    """(DataKey id, Fernet) to encrypt the profile's new messages with, created on first use."""
+    key_id = (DataKey.objects.filter(user_profile_id=user_profile_id, shredded_at__isnull=True)
+              .order_by('-id').values_list('id', flat=True).first())
+    if key_id is not None:
+        cipher = ciphers([key_id])[key_id]
+        if cipher is not None:
+            return key_id, cipher
+    raw_key = Fernet.generate_key()
+    key_id = DataKey.objects.create(user_profile_id=user_profile_id, key=raw_key.decode('ascii')).id
+    cipher = Fernet(raw_key)
+    _remember({key_id: cipher})
+    metrics.incr('data_keys.created')
+    return key_id, cipher
+
+
+def shred(user_profile):
+    """
+    Make the profile's messages under its data keys unreadable and detach
+    its sessions, to be purged later. Returns the number of sessions detached.
+    """
+    with transaction.atomic():
+        key_ids = list(DataKey.objects.filter(user_profile=user_profile, shredded_at__isnull=True)
+                       .values_list('id', flat=True))
+        DataKey.objects.filter(id__in=key_ids).update(key=None, shredded_at=timezone.now())
+        sessions = ChatSession.objects.filter(user_profile=user_profile)
+        session_ids = list(sessions.values_list('session_id', flat=True))
+        detached = sessions.update(user_profile=None)
+    forget(key_ids)
+    # Memory holds decrypted turns of the detached sessions
+    cache.delete_many([memory.KEY.format(session_id) for session_id in session_ids])
+    metrics.incr('data_keys.shredded', len(key_ids))
+    return detached
@@ -0,0 +1,411 @@
+"""
+LLM dispatcher: the one gate every upstream Gemini call goes through.
+
+- At most LLM_MAX_CONCURRENCY calls run at once per process, and at most
+  LLM_MAX_CONCURRENCY_PER_BOT for any one bot, so one busy bot cannot
+  starve the others.
+- Callers over the cap wait in a FIFO queue of at most LLM_QUEUE_SIZE
+  entries for up to LLM_QUEUE_TIMEOUT seconds; beyond that they are turned
+  away at once (QueueFull / QueueTimeout) rather than piling up.
+- Retryable errors (rate limits, 5xx, timeouts, dropped connections) are
+  retried up to LLM_MAX_RETRIES times with full-jitter exponential backoff,
+  never sleeping past LLM_REQUEST_DEADLINE.
+- LLM_BREAKER_FAILURES consecutive retryable failures open the circuit
+  breaker: calls fail fast with CircuitOpen for LLM_BREAKER_COOLDOWN
+  seconds, then a single trial call decides whether it closes again.
+
+Every refusal is an LLMUnavailable, on which callers fall back.
+
+Sync code (threads) and async code (event loop tasks) share the same slots.
+Metrics: llm.dispatch.* counters, wait_ms / queue_depth samples, and the
+in_flight / queued / breaker_state gauges of the last worker to change them.
+Updates are queued and sent to the cache by the calling thread, or from the
+executor for async callers, so the event loop never waits on cache I/O.
+"""
+import asyncio
+import contextlib
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+# (metrics function, args) updates waiting to be sent
+_pending = deque()
+
+
+def _record(fn, *args):
+    _pending.append((fn, args))
+
+
+def _flush():
+    """Send the queued metric updates (from any thread; each goes out once)."""
+    while True:
+        try:
+            fn, args = _pending.popleft()
+        except IndexError:
+            return
+        fn(*args)
+
+
+_aflush = sync_to_async(_flush, thread_sensitive=False)
+
+
+class LLMUnavailable(Exception):
+    """The dispatcher refused the call; callers should fall back."""
+
+
+class QueueFull(LLMUnavailable):
+    pass
+
+
+class QueueTimeout(LLMUnavailable):
+    pass
+
+
+class CircuitOpen(LLMUnavailable):
+    pass
+
+
+class UpstreamFailed(LLMUnavailable):
+    """Retryable errors outlasted the retries (or the breaker opened meanwhile)."""
+
+
+_retryable = None
+
+
+def retryable_errors():
+    """Exception types worth retrying: rate limits, server errors, timeouts, network failures."""
+    global _retryable
+    if _retryable is None:
+        errors = [ConnectionError, TimeoutError]
+        try:
+            from google.api_core import exceptions as google_errors
+
+            errors += [google_errors.TooManyRequests, google_errors.ResourceExhausted,
+                       google_errors.InternalServerError, google_errors.BadGateway,
+                       google_errors.ServiceUnavailable, google_errors.GatewayTimeout,
+                       google_errors.DeadlineExceeded]
+        except ImportError:
+            pass
+        _retryable = tuple(errors)
+    return _retryable
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go upstream now (at most one trial while half-open)."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+                _record(metrics.incr, 'llm.dispatch.breaker_opened')
+
+    def release(self):
+        """Give up a trial that ended without telling success from failure."""
+        with self._lock:
+            self._trial = False
+
+    def _set_state(self, state):
+        self.state = state
+        _record(metrics.gauge, 'llm.dispatch.breaker_state', BREAKER_STATES[state])
+
+
+class Dispatcher:
+    def __init__(self, max_concurrency=16, max_per_bot=8, queue_size=100, queue_timeout=10.0,
+                 max_retries=3, base_delay=0.5, max_delay=8.0, deadline=60.0,
+                 breaker_failures=5, breaker_cooldown=30.0):
+        self.max_concurrency = max_concurrency
+        self.max_per_bot = max_per_bot
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(breaker_failures, breaker_cooldown)
+        self.running = 0
+        self.running_by_bot = {}
+        self.waiters = deque()  # (bot_id, Future), oldest first
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_concurrency=settings.LLM_MAX_CONCURRENCY,
+            max_per_bot=settings.LLM_MAX_CONCURRENCY_PER_BOT,
+            queue_size=settings.LLM_QUEUE_SIZE,
+            queue_timeout=settings.LLM_QUEUE_TIMEOUT,
+            max_retries=settings.LLM_MAX_RETRIES,
+            base_delay=settings.LLM_RETRY_BASE_DELAY,
+            max_delay=settings.LLM_RETRY_MAX_DELAY,
+            deadline=settings.LLM_REQUEST_DEADLINE,
+            breaker_failures=settings.LLM_BREAKER_FAILURES,
+            breaker_cooldown=settings.LLM_BREAKER_COOLDOWN,
+        )
+
+    def state(self):
+        with self._lock:
+            return {
+                'in_flight': self.running,
+                'in_flight_by_bot': {str(bot_id): count for bot_id, count in self.running_by_bot.items()},
+                'queued': len(self.waiters),
+                'breaker': self.breaker.state,
+                'consecutive_failures': self.breaker.failures,
+            }
+
+    # Slots
+
+    def _can_run(self, bot_id):
+        return self.running < self.max_concurrency and self.running_by_bot.get(bot_id, 0) < self.max_per_bot
+
+    def _take(self, bot_id):
+        self.running += 1
+        self.running_by_bot[bot_id] = self.running_by_bot.get(bot_id, 0) + 1
+
+    def _publish(self):
+        # Read outside self._lock; queued like every dispatcher metric (see _flush)
+        _record(metrics.gauge, 'llm.dispatch.in_flight', self.running)
+        _record(metrics.gauge, 'llm.dispatch.queued', len(self.waiters))
+
+    def _enter(self, bot_id):
+        """None if a slot was free (and is now taken), else a Future resolved when one is handed over."""
+        if not self.breaker.allow():
+            _record(metrics.incr, 'llm.dispatch.rejected.circuit_open')
+            raise CircuitOpen('LLM circuit breaker is open')
+        with self._lock:
+            if self._can_run(bot_id):
+                self._take(bot_id)
+                waiter = None
+            elif len(self.waiters) >= self.queue_size:
+                waiter = False
+            else:
+                waiter = Future()
+                self.waiters.append((bot_id, waiter))
+            depth = len(self.waiters)
+        self._publish()
+        if waiter is False:
+            self.breaker.release()
+            _record(metrics.incr, 'llm.dispatch.rejected.queue_full')
+            raise QueueFull(f'LLM queue is full ({self.queue_size} waiting)')
+        if waiter is not None:
+            _record(metrics.observe, 'llm.dispatch.queue_depth', depth)
+        return waiter
+
+    def _abandon(self, bot_id, waiter):
+        """
+        Take waiter out of the queue after a timeout or cancellation. Returns
+        False if a slot was handed to it in the meantime (the caller owns it).
+        """
+        with self._lock:
+            try:
+                self.waiters.remove((bot_id, waiter))
+            except ValueError:
+                return False
+        self._publish()
+        self.breaker.release()
+        return True
+
+    def _release(self, bot_id):
+        with self._lock:
+            self.running -= 1
+            self.running_by_bot[bot_id] -= 1
+            if not self.running_by_bot[bot_id]:
+                del self.running_by_bot[bot_id]
+            # Hand the slot to the oldest waiter that fits under its bot's cap
+            for bot_and_waiter in self.waiters:
+                if self._can_run(bot_and_waiter[0]):
+                    self.waiters.remove(bot_and_waiter)
+                    self._take(bot_and_waiter[0])
+                    bot_and_waiter[1].set_result(True)
+                    break
+        self._publish()
+
+    @contextlib.contextmanager
+    def slot(self, bot_id=None):
+        """Hold one concurrency slot for bot_id, waiting in the queue if needed."""
+        started = time.perf_counter()
+        try:
+            waiter = self._enter(bot_id)
+        finally:
+            _flush()
+        if waiter is not None:
+            try:
+                waiter.result(timeout=self.queue_timeout)
+            except FutureTimeoutError:
+                if self._abandon(bot_id, waiter):
+                    _record(metrics.incr, 'llm.dispatch.rejected.timeout')
+                    raise QueueTimeout(f'Waited {self.queue_timeout}s for an LLM slot')
+            finally:
+                _flush()
+        _record(metrics.observe, 'llm.dispatch.wait_ms', (time.perf_counter() - started) * 1000)
+        try:
+            yield
+        finally:
+            self._release(bot_id)
+            _flush()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, bot_id=None):
+        # Slots change hands on the loop (only in-memory locks); the metrics go out from a thread
+        started = time.perf_counter()
+        try:
+            waiter = self._enter(bot_id)
+        finally:
+            await _aflush()
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter)), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._abandon(bot_id, waiter):
+                    _record(metrics.incr, 'llm.dispatch.rejected.timeout')
+                    raise QueueTimeout(f'Waited {self.queue_timeout}s for an LLM slot')
+            except asyncio.CancelledError:
+                if not self._abandon(bot_id, waiter):
+                    self._release(bot_id)
+                raise
+            finally:
+                await _aflush()
+        _record(metrics.observe, 'llm.dispatch.wait_ms', (time.perf_counter() - started) * 1000)
+        try:
+            yield
+        finally:
+            self._release(bot_id)
+            await _aflush()
+
+    # Retries
+
+    def _backoff(self, attempt, started):
+        """Seconds to sleep before retry number attempt (1-based), or None to give up."""
+        if attempt > self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if time.monotonic() + delay - started > self.deadline:
+            return None
+        return delay
+
+    def _failed(self, error, attempt, started):
+        """Record a failed attempt; the delay before the next one, or None to re-raise."""
+        if not isinstance(error, retryable_errors()):
+            self.breaker.release()
+            return None
+        self.breaker.failure()
+        delay = self._backoff(attempt, started)
+        if delay is None or not self.breaker.allow():
+            return None
+        _record(metrics.incr, 'llm.dispatch.retries')
+        print(f"Retrying LLM call in {delay:.2f}s after: {error}")
+        return delay
+
+    def retry(self, fn):
+        """fn() with jittered exponential backoff on retryable errors; call inside slot()."""
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._failed(e, attempt, started)
+                _flush()
+                if delay is None:
+                    if isinstance(e, retryable_errors()):
+                        raise UpstreamFailed(f'LLM call failed after {attempt} attempts: {e}') from e
+                    raise
+                time.sleep(delay)
+            else:
+                self.breaker.success()
+                _flush()
+                return result
+
+    async def aretry(self, fn):
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._failed(e, attempt, started)
+                await _aflush()
+                if delay is None:
+                    if isinstance(e, retryable_errors()):
+                        raise UpstreamFailed(f'LLM call failed after {attempt} attempts: {e}') from e
+                    raise
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.success()
+                await _aflush()
+                return result
+
+    def call(self, fn, bot_id=None):
+        with self.slot(bot_id):
+            return self.retry(fn)
+
+    async def acall(self, fn, bot_id=None):
+        async with self.aslot(bot_id):
+            return await self.aretry(fn)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """The process-wide Dispatcher, configured from settings on first use."""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = Dispatcher.from_settings()
+    return _dispatcher
+
+
+def reset():
+    """Forget the dispatcher (e.g. after changing its settings)."""
+    global _dispatcher
+    with _dispatcher_lock:
+        _dispatcher = None
@@ -0,0 +1,347 @@
+"""
+Dense-vector (semantic) FAQ retrieval.
+
+One L2-normalised float32 embedding per FAQ is kept in contiguous matrix
+files under settings.FAQ_INDEX_DIR. Workers np.memmap them read-only, so
+every process shares the same page cache instead of holding its own copy.
+Only FAQs whose text hash changed are re-embedded when the store is synced,
+and only their rows are written (see EmbeddingStore).
+"""
+import hashlib
+import json
+import os
+import uuid
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .retrieval import TOKEN_RE, ScoredFAQ, tokenize
+
+# Upper bound on the dense (queries x FAQs) similarity block computed at once
+MAX_BLOCK_CELLS = 4_000_000
+# Gemini's batchEmbedContents accepts at most 100 texts per request
+REMOTE_BATCH_SIZE = 100
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+class HashingEmbedder:
+    """
+    Offline, deterministic embedder: signed feature hashing of word tokens and
+    character trigrams (a sparse random projection). No network, stable across
+    processes, so it is suitable for tests and development.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = tokenize(text)
+        features = list(words)
+        for word in TOKEN_RE.findall((text or '').lower()):
+            padded = f"#{word}#"
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed_documents(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+                matrix[row, digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return _normalize(matrix)
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+
+class GeminiEmbedder:
+    """Remote embedder backed by the Gemini embedding API."""
+
+    def __init__(self, model='models/text-embedding-004', dim=768):
+        self.model = model
+        self.dim = dim
+        self.name = f"gemini:{model}"
+
+    def _embed(self, texts, task_type):
+        from .llm import gemini
+
+        genai = gemini()
+        rows = []
+        for start in range(0, len(texts), REMOTE_BATCH_SIZE):
+            result = genai.embed_content(model=self.model, content=list(texts[start:start + REMOTE_BATCH_SIZE]),
+                                         task_type=task_type)
+            rows.extend(result['embedding'])
+        return _normalize(np.asarray(rows, dtype=np.float32).reshape(len(texts), self.dim))
+
+    def embed_documents(self, texts):
+        return self._embed(texts, 'retrieval_document')
+
+    def embed_queries(self, texts):
+        return self._embed(texts, 'retrieval_query')
+
+    async def aembed_queries(self, texts):
+        """embed_queries() for async code, holding no thread while the API answers."""
+        from .llm import gemini
+
+        genai = gemini()
+        rows = []
+        for start in range(0, len(texts), REMOTE_BATCH_SIZE):
+            result = await genai.embed_content_async(model=self.model,
+                                                     content=list(texts[start:start + REMOTE_BATCH_SIZE]),
+                                                     task_type='retrieval_query')
+            rows.extend(result['embedding'])
+        return _normalize(np.asarray(rows, dtype=np.float32).reshape(len(texts), self.dim))
+
+
+def get_embedder():
+    """Instantiate the embedder named by settings.FAQ_EMBEDDER."""
+    path = getattr(settings, 'FAQ_EMBEDDER', 'chat.embeddings.HashingEmbedder')
+    return import_string(path)()
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class DenseIndex:
+    """
+    Cosine top-k over an (n_faqs x dim) float32 matrix (may be a memmap).
+    Rows listed in dead (row numbers) are skipped, so a shared matrix file
+    can stay as it is while some of its rows are out of date.
+    """
+
+    def __init__(self, doc_ids, matrix, hashes=None, embedder_name=None, dead=()):
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        self.matrix = matrix
+        # Text hash per row and the embedder that produced them, so the rows
+        # can seed a later sync instead of being re-embedded
+        self.hashes = hashes
+        self.embedder_name = embedder_name
+        self.dead = np.asarray(sorted(dead), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.doc_ids) - len(self.dead)
+
+    def live_rows(self):
+        """Row numbers of the rows not in dead."""
+        return np.setdiff1d(np.arange(len(self.doc_ids)), self.dead, assume_unique=True)
+
+    def search_vectors(self, vectors, k=5):
+        """Top-k ScoredFAQ lists for already-embedded (normalised) queries."""
+        n_docs = len(self.doc_ids)
+        if not len(self):
+            return [[] for _ in range(len(vectors))]
+        k = min(k, len(self))
+        block = max(1, MAX_BLOCK_CELLS // n_docs)
+        results = []
+        for start in range(0, len(vectors), block):
+            scores = vectors[start:start + block] @ self.matrix.T
+            if len(self.dead):
+                scores[:, self.dead] = -np.inf
+            if k < n_docs:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(n_docs), scores.shape)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            for cols, row_scores in zip(top, top_scores):
+                results.append([
+                    ScoredFAQ(int(self.doc_ids[col]), float(score), max(0.0, float(score)))
+                    for col, score in zip(cols, row_scores)
+                ])
+        return results
+
+
+class LayeredDenseIndex:
+    """
+    A DenseIndex over the last compacted matrix (its superseded rows dead)
+    plus one over the rows added or re-embedded since, searched as one.
+    """
+
+    def __init__(self, base, delta, embedder_name=None):
+        self.base = base
+        self.delta = delta
+        self.embedder_name = embedder_name
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+    @cached_property
+    def _live(self):
+        return self.base.live_rows()
+
+    @cached_property
+    def doc_ids(self):
+        return np.concatenate([self.base.doc_ids[self._live], self.delta.doc_ids])
+
+    @cached_property
+    def hashes(self):
+        return [self.base.hashes[row] for row in self._live.tolist()] + list(self.delta.hashes)
+
+    @cached_property
+    def matrix(self):
+        """Every live row in one (copied) matrix, in doc_ids order."""
+        return np.concatenate([self.base.matrix[self._live], self.delta.matrix])
+
+    def search_vectors(self, vectors, k=5):
+        merged = []
+        for base_hits, delta_hits in zip(self.base.search_vectors(vectors, k), self.delta.search_vectors(vectors, k)):
+            merged.append(sorted(base_hits + delta_hits, key=lambda hit: -hit.score)[:k])
+        return merged
+
+
+class EmbeddingStore:
+    """
+    On-disk embeddings: a base segment (matrix file plus a JSON file of its
+    ids and text hashes) written when the store is compacted, a delta segment
+    with the rows added or re-embedded since, and a JSON manifest naming both
+    and the base rows that are dead.
+
+    Syncing a few changed FAQs only rewrites the (small) delta and the
+    manifest; once the delta and dead rows outgrow COMPACT_MIN_ROWS and
+    COMPACT_FRACTION of the base, everything is written to a new base.
+    Segment files are never modified: new ones get unique names and the
+    manifest is replaced atomically, so readers never see a half-written
+    matrix and memmaps held by other workers stay valid until they reload.
+    """
+    COMPACT_MIN_ROWS = 256
+    COMPACT_FRACTION = 0.1
+
+    def __init__(self, directory=None, name='faq_embeddings'):
+        self.directory = Path(directory or settings.FAQ_INDEX_DIR)
+        self.name = name
+        self.manifest_path = self.directory / f"{name}.json"
+
+    def _write_segment(self, ids, hashes, matrix):
+        segment = f"{self.name}-{uuid.uuid4().hex}"
+        np.ascontiguousarray(matrix, dtype=np.float32).tofile(self.directory / f"{segment}.f32")
+        with open(self.directory / f"{segment}.rows.json", 'w', encoding='utf-8') as fh:
+            json.dump({'ids': [int(faq_id) for faq_id in ids], 'hashes': list(hashes)}, fh)
+        return segment
+
+    def _read_segment(self, segment, dim, embedder_name, dead=()):
+        with open(self.directory / f"{segment}.rows.json", encoding='utf-8') as fh:
+            rows = json.load(fh)
+        shape = (len(rows['ids']), dim)
+        if not shape[0]:
+            matrix = np.zeros(shape, dtype=np.float32)
+        else:
+            matrix = np.memmap(self.directory / f"{segment}.f32", dtype=np.float32, mode='r', shape=shape)
+        return DenseIndex(rows['ids'], matrix, rows['hashes'], embedder_name, dead)
+
+    def load(self, embedder):
+        """
+        (manifest, LayeredDenseIndex over the memmapped segments), or
+        (None, None) if nothing usable with embedder is stored.
+        """
+        try:
+            with open(self.manifest_path, encoding='utf-8') as fh:
+                manifest = json.load(fh)
+            if manifest.get('embedder') != embedder.name or manifest.get('dim') != embedder.dim:
+                return None, None
+            base = self._read_segment(manifest['base'], embedder.dim, embedder.name, manifest['dead'])
+            delta = self._read_segment(manifest['delta'], embedder.dim, embedder.name)
+        except (FileNotFoundError, KeyError, ValueError):
+            return None, None
+        return manifest, LayeredDenseIndex(base, delta, embedder.name)
+
+    def _publish(self, embedder, base, delta, dead):
+        manifest = {'embedder': embedder.name, 'dim': embedder.dim, 'base': base, 'delta': delta,
+                    'dead': [int(row) for row in dead]}
+        tmp_path = self.manifest_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp_path, self.manifest_path)
+        # Unlinking is safe for workers still mapping an old file (POSIX keeps the inode)
+        for stale in self.directory.glob(f"{self.name}-*"):
+            if stale.name.split('.')[0] not in (base, delta):
+                try:
+                    stale.unlink()
+                except OSError:
+                    pass
+
+    def sync(self, items, embedder, fallback=None):
+        """
+        Make the store match items ([(faq_id, text), ...]) and return a
+        LayeredDenseIndex over the memmapped result. Stored rows are reused;
+        only new or edited texts are sent to the embedder. When nothing usable
+        is stored yet, rows of the fallback DenseIndex are reused instead.
+        """
+        wanted = {faq_id: text_hash(text) for faq_id, text in items}
+        manifest, current = self.load(embedder)
+        if current is not None and dict(zip(current.doc_ids.tolist(), current.hashes)) == wanted:
+            return current
+
+        ids = list(wanted)
+        dead = None
+        if current is not None:
+            # Base rows whose text is unchanged stay; the rest are dead and the delta holds their new rows
+            base = current.base
+            dead = [row for row, key in enumerate(zip(base.doc_ids.tolist(), base.hashes))
+                    if wanted.get(key[0]) != key[1]]
+            in_base = set(base.doc_ids.tolist()) - {int(base.doc_ids[row]) for row in dead}
+            delta_ids = [faq_id for faq_id in ids if faq_id not in in_base]
+            if len(dead) + len(delta_ids) > max(self.COMPACT_MIN_ROWS, self.COMPACT_FRACTION * len(base.doc_ids)):
+                dead = None
+
+        # Rows already embedded, by (faq_id, text hash); a new delta can only reuse rows of the old one
+        if current is not None:
+            sources = [current.delta] if dead is not None else [current.base, current.delta]
+        elif fallback is not None and fallback.hashes is not None and fallback.embedder_name == embedder.name:
+            sources = [fallback]
+        else:
+            sources = []
+        known = {}
+
+        def reuse(source):
+            for row, key in enumerate(zip(source.doc_ids.tolist(), source.hashes)):
+                known[key] = (source.matrix, row)
+
+        for source in sources:
+            reuse(source)
+        texts = dict(items)
+
+        def segment(faq_ids):
+            hashes = [wanted[faq_id] for faq_id in faq_ids]
+            matrix = np.zeros((len(faq_ids), embedder.dim), dtype=np.float32)
+            stale = []
+            for row, key in enumerate(zip(faq_ids, hashes)):
+                if key in known:
+                    source, source_row = known[key]
+                    matrix[row] = source[source_row]
+                else:
+                    stale.append(row)
+            if stale:
+                matrix[stale] = embedder.embed_documents([texts[faq_ids[row]] for row in stale])
+                known.update(((faq_ids[row], hashes[row]), (matrix, row)) for row in stale)
+            return faq_ids, hashes, matrix
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if dead is not None:
+            delta = segment(delta_ids)
+            base_name = manifest['base']
+        else:
+            # Compact: everything in a new base
+            delta = segment([])
+            base_name = self._write_segment(*segment(ids))
+            dead = []
+        self._publish(embedder, base_name, self._write_segment(*delta), dead)
+        manifest, stored = self.load(embedder)
+        if stored is None or dict(zip(stored.doc_ids.tolist(), stored.hashes)) != wanted:
+            # Another worker replaced the store meanwhile; serve what we embedded
+            if current is not None:
+                reuse(current.base)
+            faq_ids, hashes, matrix = segment(ids)
+            return DenseIndex(faq_ids, matrix, hashes, embedder.name)
+        return stored
@@ -0,0 +1,469 @@
+"""
+Process-wide retrieval index over the FAQ table.
+
+Keywords and questions are compiled once into an Aho-Corasick automaton, so a
+lookup walks the user message once no matter how many FAQs exist. Messages
+without a keyword hit fall through to BM25 ranking (see retrieval.py), then
+typo-tolerant trigram matching (see trigram_index.py) and finally embedding
+similarity (see embeddings.py). Answers are only kept as
+BM25 term weights; the winning FAQ's answer is decrypted on demand.
+
+A persisted copy (index_file.py, `manage.py build_faq_index`) is mapped at
+startup so new workers skip the full build while the FAQ table is unchanged.
+
+Each FAQ save/delete bumps a version counter in the shared cache; every
+worker replays the changed rows into a new immutable snapshot and swaps it
+in with one reference assignment, so lookups never take a lock.
+"""
+import os
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from functools import cached_property
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import index_file
+from .embeddings import DenseIndex, EmbeddingStore, get_embedder, text_hash
+from .models import FAQ
+from .retrieval import BM25Index, ScoredFAQ, tokenize
+from .trigram_index import FuzzyMatcher
+
+QUESTION = 'question'
+KEYWORD = 'keyword'
+BM25 = 'bm25'
+FUZZY = 'fuzzy'
+SEMANTIC = 'semantic'
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton: finds every pattern contained in a text in one pass."""
+
+    def __init__(self, patterns):
+        # Parallel lists indexed by trie node id (0 is the root)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for pattern, payload in patterns:
+            if pattern:
+                self._add(pattern, payload)
+        self._link()
+
+    def _add(self, pattern, payload):
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = nxt
+        self._out[node] += (payload,)
+
+    def _link(self):
+        # Breadth-first so every node's failure target is linked before its children
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target
+                self._out[child] += self._out[target]
+
+    def iter_matches(self, text):
+        """Yield the payload of every pattern occurrence in text."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                yield from out[node]
+
+
+class FAQMatch:
+    """A lookup result; the answer is decrypted on first access only."""
+
+    def __init__(self, faq_id, source, score=1.0):
+        self.faq_id = faq_id
+        self.source = source
+        self.score = score
+
+    @cached_property
+    def answer(self):
+        return FAQ.objects.filter(pk=self.faq_id).values_list('answer', flat=True).first()
+
+    def __repr__(self):
+        return f"FAQMatch(faq_id={self.faq_id}, source={self.source!r}, score={self.score})"
+
+
+def faq_document(faq):
+    """Text a FAQ is ranked on: question, keywords and answer."""
+    return f"{faq.question}\n{faq.keywords}\n{faq.answer}"
+
+
+def faq_embedding_text(faq):
+    """Text a FAQ is embedded from; paraphrases are matched against the question."""
+    return f"{faq.question}\n{faq.keywords}"
+
+
+class FAQRecord(namedtuple('FAQRecord', ['faq_id', 'question', 'keywords', 'embedding_text'])):
+    """The plaintext parts of one FAQ row an index keeps, so deltas never re-read other rows."""
+
+    @classmethod
+    def from_faq(cls, faq):
+        return cls(faq.pk, faq.question.lower().strip(), tuple(faq.get_keywords_list()), faq_embedding_text(faq))
+
+
+def _sync_semantic(records, embedder, store, fallback=None):
+    try:
+        return store.sync([(record.faq_id, record.embedding_text) for record in records.values()],
+                          embedder, fallback=fallback)
+    except Exception as e:
+        # Keyword and BM25 matching still work without embeddings
+        print(f"Semantic FAQ index unavailable: {e}")
+        return None
+
+
+class FAQIndex:
+    """
+    Immutable snapshot of the keyword + BM25 + embedding indexes.
+
+    Changes never mutate a snapshot; with_changes() derives a new one from the
+    retained per-row records and only touches the changed rows in the database
+    and the embedding store.
+    """
+
+    def __init__(self, records, lexical, semantic, version=0, embedder=None, store=None, content_hash=None):
+        self.records = records
+        self.lexical = lexical
+        self.semantic = semantic
+        self.version = version
+        self.embedder = embedder or get_embedder()
+        self._store = store or EmbeddingStore()
+        # FAQ table hash this snapshot was built from, when known (see index_file)
+        self.content_hash = content_hash
+        self._ids = list(records)
+        self._rank = {faq_id: rank for rank, faq_id in enumerate(self._ids)}
+        patterns = []
+        for record in records.values():
+            patterns.append((record.question, (record.faq_id, QUESTION)))
+            for kw in record.keywords:
+                patterns.append((kw, (record.faq_id, KEYWORD)))
+        self._matcher = KeywordMatcher(patterns)
+        self.fuzzy = FuzzyMatcher(records.values())
+
+    @classmethod
+    def build(cls, version=0, embedder=None, store=None, content_hash=None):
+        """Full build from the FAQ table (decrypts every answer once)."""
+        faqs = list(FAQ.objects.order_by('pk'))
+        records = {faq.pk: FAQRecord.from_faq(faq) for faq in faqs}
+        lexical = BM25Index.from_documents(list(records), [faq_document(faq) for faq in faqs])
+        embedder = embedder or get_embedder()
+        store = store or EmbeddingStore()
+        return cls(records, lexical, _sync_semantic(records, embedder, store), version, embedder, store,
+                   content_hash)
+
+    def with_changes(self, faq_ids, version):
+        """New snapshot with the given FAQ rows re-read (or dropped if gone)."""
+        faq_ids = set(faq_ids)
+        faqs = list(FAQ.objects.filter(pk__in=faq_ids))
+        records = {faq_id: record for faq_id, record in self.records.items() if faq_id not in faq_ids}
+        for faq in faqs:
+            records[faq.pk] = FAQRecord.from_faq(faq)
+        records = dict(sorted(records.items()))
+        lexical = self.lexical.with_changes(
+            faq_ids, [faq.pk for faq in faqs], [Counter(tokenize(faq_document(faq))) for faq in faqs])
+        semantic = _sync_semantic(records, self.embedder, self._store, fallback=self.semantic)
+        return FAQIndex(records, lexical, semantic, version, self.embedder, self._store)
+
+    def save(self, path, content_hash):
+        """Persist this snapshot as a binary index file (see index_file.py)."""
+        lexical = self.lexical
+        vectors = self.semantic.matrix if self.semantic is not None else np.zeros((0, 0), dtype=np.float32)
+        vector_ids = self.semantic.doc_ids if self.semantic is not None else np.zeros(0, dtype=np.int64)
+        index_file.write_index(path, {
+            'content_hash': content_hash,
+            'embedder': self.semantic.embedder_name if self.semantic is not None else None,
+            'k1': lexical.k1,
+            'b': lexical.b,
+        }, {
+            'faq_ids': np.asarray(self._ids, dtype=np.int64),
+            'faq_text': index_file.pack_strings(
+                text for record in self.records.values()
+                for text in (record.question, ','.join(record.keywords), record.embedding_text)),
+            'doc_ids': lexical.doc_ids,
+            'vocabulary': index_file.pack_strings(lexical.vocabulary),
+            'indptr': lexical.indptr,
+            'indices': np.asarray(lexical.indices, dtype=np.int32),
+            'tf': np.asarray(lexical.tf, dtype=np.float32),
+            'vector_ids': vector_ids,
+            'vectors': vectors,
+        })
+
+    @classmethod
+    def load(cls, path, embedder=None, store=None):
+        """
+        Snapshot backed by a memory-mapped index file, or None if the file is
+        missing, from another format version or built with another embedder.
+        """
+        loaded = index_file.read_index(path)
+        if loaded is None:
+            return None
+        header, arrays = loaded
+        embedder = embedder or get_embedder()
+        if header['embedder'] not in (None, embedder.name):
+            return None
+        texts = index_file.unpack_strings(arrays['faq_text'])
+        records = {}
+        for row, faq_id in enumerate(arrays['faq_ids'].tolist()):
+            question, keywords, embedding_text = texts[3 * row:3 * row + 3]
+            records[faq_id] = FAQRecord(faq_id, question, tuple(keywords.split(',')) if keywords else (),
+                                        embedding_text)
+        vocabulary = {term: term_id for term_id, term in enumerate(index_file.unpack_strings(arrays['vocabulary']))}
+        lexical = BM25Index(arrays['doc_ids'], vocabulary, arrays['indptr'], arrays['indices'], arrays['tf'],
+                            k1=header['k1'], b=header['b'])
+        semantic = None
+        if header['embedder'] is not None:
+            vector_ids = arrays['vector_ids'].tolist()
+            semantic = DenseIndex(vector_ids, arrays['vectors'],
+                                  [text_hash(records[faq_id].embedding_text) for faq_id in vector_ids],
+                                  header['embedder'])
+        return cls(records, lexical, semantic, 0, embedder, store, header['content_hash'])
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _keyword_hits(self, query):
+        """{faq_id: (full question contained, keywords contained)} for a lowercased query."""
+        hits = {}
+        for faq_id, kind in self._matcher.iter_matches(query):
+            question_hit, keyword_hits = hits.get(faq_id, (False, 0))
+            if kind == QUESTION:
+                hits[faq_id] = (True, keyword_hits)
+            else:
+                hits[faq_id] = (question_hit, keyword_hits + 1)
+        return hits
+
+    def keyword_search(self, user_query, k=5):
+        """
+        FAQs whose question or keywords occur verbatim in the message, as
+        ScoredFAQ (score = keywords + question contained, confidence 1.0).
+        """
+        return self._rank_keyword_hits(self._keyword_hits((user_query or '').lower().strip()), k)
+
+    def _rank_keyword_hits(self, hits, k):
+        # Prefer a full question hit, then most keywords, then table order
+        ranked = sorted(hits, key=lambda faq_id: (hits[faq_id], -self._rank[faq_id]), reverse=True)
+        return [ScoredFAQ(faq_id, float(hits[faq_id][1] + hits[faq_id][0]), 1.0) for faq_id in ranked[:k]]
+
+    def lookup(self, user_query):
+        """Return the best FAQMatch for user_query, or None."""
+        query = (user_query or '').lower().strip()
+        if not query:
+            return None
+
+        # 1. Whole questions / keywords contained in the message
+        hits = self._keyword_hits(query)
+        if hits:
+            best = self._rank_keyword_hits(hits, 1)[0]
+            return FAQMatch(best.faq_id, QUESTION if hits[best.faq_id][0] else KEYWORD, best.score)
+
+        # 2. Fallback: best BM25 hit, if enough of the message is covered
+        hits = self.lexical.search(query, k=1)
+        min_confidence = getattr(settings, 'FAQ_MIN_CONFIDENCE', 0.5)
+        if hits and hits[0].confidence >= min_confidence:
+            return FAQMatch(hits[0].faq_id, BM25, hits[0].confidence)
+
+        # 3. Misspelled keywords or questions
+        hits = self.fuzzy.search(query, k=1)
+        min_fuzzy = getattr(settings, 'FAQ_MIN_FUZZY_SCORE', 0.8)
+        if hits and hits[0].confidence >= min_fuzzy:
+            return FAQMatch(hits[0].faq_id, FUZZY, hits[0].confidence)
+
+        # 4. Paraphrases: nearest FAQ question by embedding similarity
+        hits = self.semantic_search(user_query, k=1)
+        min_similarity = getattr(settings, 'FAQ_MIN_SIMILARITY', 0.8)
+        if hits and hits[0].confidence >= min_similarity:
+            return FAQMatch(hits[0].faq_id, SEMANTIC, hits[0].confidence)
+        return None
+
+    def search(self, user_query, k=5):
+        """Top-k ranked FAQs (ScoredFAQ) for one query."""
+        return self.lexical.search(user_query, k)
+
+    def search_batch(self, queries, k=5):
+        """Top-k ranked FAQs for many queries in one scoring pass."""
+        return self.lexical.search_batch(queries, k)
+
+    def fuzzy_search(self, user_query, k=5):
+        """Top-k typo-tolerant keyword/question matches with their scores."""
+        return self.fuzzy.search(user_query, k)
+
+    def semantic_search_batch(self, queries, k=5):
+        """Top-k FAQs by embedding similarity for many queries at once."""
+        if self.semantic is None or not len(self.semantic) or not queries:
+            return [[] for _ in queries]
+        try:
+            vectors = self.embedder.embed_queries(list(queries))
+        except Exception as e:
+            print(f"Error embedding FAQ query: {e}")
+            return [[] for _ in queries]
+        return self.semantic.search_vectors(vectors, k)
+
+    def semantic_search(self, user_query, k=5):
+        return self.semantic_search_batch([user_query], k)[0]
+
+    async def asemantic_search(self, user_query, k=5):
+        """
+        semantic_search() awaiting the embedder, for embedders that can embed
+        without a thread (aembed_queries); None if this one cannot.
+        """
+        aembed_queries = getattr(self.embedder, 'aembed_queries', None)
+        if aembed_queries is None:
+            return None
+        if self.semantic is None or not len(self.semantic):
+            return []
+        try:
+            vectors = await aembed_queries([user_query])
+        except Exception as e:
+            print(f"Error embedding FAQ query: {e}")
+            return []
+        return self.semantic.search_vectors(vectors, k)[0]
+
+
+# --- Process-wide snapshot ---
+# Readers take whatever _snapshot points at; only writers hold _write_lock.
+# The version counter and per-version change log live in the shared cache so
+# every worker can replay row deltas published by the others.
+VERSION_KEY = 'faq_index:version'
+CHANGE_KEY = 'faq_index:change:{}'
+CHANGE_TIMEOUT = 60 * 60
+
+_snapshot = None
+_checked_at = 0.0
+_write_lock = threading.Lock()
+# Mapped from disk at startup; checked against the FAQ table on first use
+_persisted = None
+
+
+def _shared_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def index_path():
+    return os.path.join(settings.FAQ_INDEX_DIR, 'faq_index.bin')
+
+
+def load_persisted_index():
+    """Memory-map the persisted index file. Does not touch the database."""
+    global _persisted
+    try:
+        _persisted = FAQIndex.load(index_path())
+    except Exception as e:
+        print(f"Could not load persisted FAQ index: {e}")
+        _persisted = None
+
+
+def build_persisted_index(path=None, version=0):
+    """Build the index from the FAQ table and write it to disk."""
+    content_hash = index_file.faq_content_hash()
+    snapshot = FAQIndex.build(version, content_hash=content_hash)
+    snapshot.save(path or index_path(), content_hash)
+    return snapshot
+
+
+def _initial_snapshot(version):
+    """Use the persisted index if it matches the FAQ table, else rebuild and persist."""
+    global _persisted
+    persisted, _persisted = _persisted, None
+    if persisted is not None and persisted.content_hash == index_file.faq_content_hash():
+        persisted.version = version
+        return persisted
+    try:
+        return build_persisted_index(version=version)
+    except OSError as e:
+        print(f"Could not write persisted FAQ index: {e}")
+        return FAQIndex.build(version)
+
+
+def _refresh(blocking):
+    """Bring the local snapshot up to the shared version; returns the current snapshot."""
+    global _snapshot, _checked_at
+    if not _write_lock.acquire(blocking=blocking):
+        return _snapshot
+    try:
+        _checked_at = time.monotonic()
+        version = _shared_version()
+        snapshot = _snapshot
+        if snapshot is None or version < snapshot.version:
+            _snapshot = _initial_snapshot(version)
+        elif version > snapshot.version:
+            changed = set()
+            for v in range(snapshot.version + 1, version + 1):
+                faq_id = cache.get(CHANGE_KEY.format(v))
+                if faq_id is None:
+                    # Change log expired or not written yet: start over
+                    _snapshot = FAQIndex.build(version)
+                    return _snapshot
+                changed.add(faq_id)
+            _snapshot = snapshot.with_changes(changed, version)
+        return _snapshot
+    finally:
+        _write_lock.release()
+
+
+def get_faq_index():
+    """Return the current FAQIndex snapshot without taking a lock on the fast path."""
+    snapshot = _snapshot
+    if snapshot is None:
+        return _refresh(blocking=True)
+    if time.monotonic() - _checked_at >= getattr(settings, 'FAQ_INDEX_REFRESH_INTERVAL', 0.5):
+        return _refresh(blocking=False) or snapshot
+    return snapshot
+
+
+def publish_faq_change(faq_id):
+    """Record that one FAQ row changed and apply it to this process right away."""
+    cache.add(VERSION_KEY, 0, timeout=None)
+    version = cache.incr(VERSION_KEY)
+    cache.set(CHANGE_KEY.format(version), faq_id, timeout=CHANGE_TIMEOUT)
+    _refresh(blocking=True)
+
+
+def invalidate_faq_index():
+    """Drop the local snapshot; the next lookup rebuilds it from the database."""
+    global _snapshot
+    with _write_lock:
+        _snapshot = None
+
+
+def lookup_faq(user_query):
+    return get_faq_index().lookup(user_query)
+
+
+def search_faqs(user_query, k=5):
+    return get_faq_index().search(user_query, k)
+
+
+def search_faqs_batch(queries, k=5):
+    return get_faq_index().search_batch(queries, k)
+
+
+def fuzzy_search_faqs(user_query, k=5):
+    return get_faq_index().fuzzy_search(user_query, k)
+
+
+def get_faq_answer(user_query):
+    """Retrieve FAQ answer using keyword matching (fallback to BM25 ranking)"""
+    match = lookup_faq(user_query)
+    return match.answer if match else None
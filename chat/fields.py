@@ -1,13 +1,27 @@
+import functools
 import os
-from base64 import urlsafe_b64encode, urlsafe_b64decode
+import struct
+import threading
+import zlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 from django.db import models
-from django.core.exceptions import ImproperlyConfigured
-from cryptography.fernet import Fernet, InvalidToken
+from django.db.models.query import ModelIterable
+from django.db.models.query_utils import DeferredAttribute
+from django.core.exceptions import ImproperlyConfigured, SynchronousOnlyOperation
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+from . import metrics
 
 # --- Key Management (Example: Environment Variable) ---
 # In a real application, use a KMS or more robust secret management.
 # Ensure this key is generated once and kept secret.
 # Example: Fernet.generate_key().decode()
+# To rotate keys, put the new key first and keep the old ones after it,
+# comma-separated: values are encrypted with the first key and decrypted
+# with whichever key works, newest first. `manage.py reencrypt` then moves
+# existing rows to the new key, after which the old keys can be dropped.
 ENCRYPTION_KEY = os.environ.get("DJANGO_ENCRYPTION_KEY")
 
 if not ENCRYPTION_KEY:
@@ -16,75 +30,512 @@ if not ENCRYPTION_KEY:
         "Please generate a Fernet key and set it."
     )
 
-cipher_suite = Fernet(ENCRYPTION_KEY)
+ENCRYPTION_KEYS = [key.strip() for key in ENCRYPTION_KEY.split(',') if key.strip()]
+primary_cipher = Fernet(ENCRYPTION_KEYS[0])
+cipher_suite = MultiFernet([primary_cipher] + [Fernet(key) for key in ENCRYPTION_KEYS[1:]])
+
+# Placeholders returned for values that cannot be decrypted
+DECRYPT_FAILED = "[ENCRYPTION_ERROR]"  # wrong key or corrupted token
+DECRYPT_ERROR = "[DECRYPTION_FAILED]"  # anything else
+SHREDDED = "[DELETED]"  # its data key was destroyed (see data_keys.py)
+
+# Binary storage format: one version byte, which also says how the
+# plaintext was compressed before encryption, then the raw (not base64)
+# Fernet token. Text storage (binary=False, and rows not yet migrated) is
+# the base64 Fernet token, whose first byte is always b'g'.
+FORMAT_RAW = 1
+FORMAT_ZLIB = 2
+FORMAT_ZSTD = 3
+COMPRESSIONS = {None: FORMAT_RAW, 'zlib': FORMAT_ZLIB, 'zstd': FORMAT_ZSTD}
+# Set in the version byte of values encrypted with a per-user data key
+# instead of the master key; the DataKey id follows the version byte.
+KEYED = 0x10
+_KEY_ID = struct.Struct('>Q')
+
+_zstd = None
+
+
+def _zstandard():
+    """The optional zstandard module (needed for ENCRYPTION_COMPRESSION = 'zstd')."""
+    global _zstd
+    if _zstd is None:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImproperlyConfigured("zstd compression needs the zstandard package (pip install zstandard).")
+        _zstd = zstandard
+    return _zstd
+
+
+def _compress(data):
+    """(format byte, data) with data compressed as ENCRYPTION_COMPRESSION says, if that makes it smaller."""
+    compression = settings.ENCRYPTION_COMPRESSION
+    if compression not in COMPRESSIONS:
+        raise ImproperlyConfigured(f"ENCRYPTION_COMPRESSION must be one of {sorted(COMPRESSIONS, key=str)}.")
+    if compression is None or len(data) < settings.ENCRYPTION_COMPRESS_MIN_BYTES:
+        return FORMAT_RAW, data
+    if compression == 'zlib':
+        compressed = zlib.compress(data)
+    else:
+        compressed = _zstandard().ZstdCompressor().compress(data)
+    if len(compressed) >= len(data):
+        return FORMAT_RAW, data
+    return COMPRESSIONS[compression], compressed
+
+
+def _decompress(version, data):
+    if version == FORMAT_ZLIB:
+        return zlib.decompress(data)
+    if version == FORMAT_ZSTD:
+        return _zstandard().ZstdDecompressor().decompress(data)
+    return data
+
+
+def is_legacy(stored):
+    """
+    Whether a stored value is in text storage (a base64 Fernet token, see
+    _legacy_token) rather than the binary format.
+    """
+    if isinstance(stored, str) or not stored:
+        return True
+    return stored[0] & ~KEYED not in (FORMAT_RAW, FORMAT_ZLIB, FORMAT_ZSTD)
+
+
+def data_key_id(stored):
+    """Id of the DataKey a stored value was encrypted with, or None for the master key."""
+    if is_legacy(stored) or not stored[0] & KEYED:
+        return None
+    return _KEY_ID.unpack_from(stored, 1)[0]
+
+
+# Every Fernet token starts with the version byte 0x80 and a timestamp whose
+# high bytes are zero, so its base64 starts with this
+FERNET_PREFIX = b'gAAAAA'
+
+
+def _legacy_token(stored):
+    """
+    The Fernet token of a text value. Rows written before the binary format
+    may hold the token base64-encoded once more ("Z0FBQUFB..."), which is
+    decoded first.
+    """
+    raw = stored.encode('ascii', 'replace') if isinstance(stored, str) else bytes(stored)
+    if raw and not raw.startswith(FERNET_PREFIX):
+        try:
+            decoded = urlsafe_b64decode(raw)
+        except ValueError:
+            return stored
+        if decoded.startswith(FERNET_PREFIX):
+            return decoded
+    return stored
+
+
+def _fernet_token(stored):
+    """The Fernet token in a stored value of either format."""
+    if is_legacy(stored):
+        return _legacy_token(stored)
+    start = 1 + _KEY_ID.size if stored[0] & KEYED else 1
+    return urlsafe_b64encode(bytes(stored[start:]))
+
+
+def _data_ciphers(tokens):
+    """{DataKey id: Fernet, or None if shredded} for the keyed values among tokens."""
+    key_ids = {key_id for key_id in map(data_key_id, tokens) if key_id is not None}
+    if not key_ids:
+        return {}
+    from . import data_keys  # imports the models, which import this module
+    return data_keys.ciphers(key_ids)
+
+
+def decrypt(token, model_name=None, ciphers=None):
+    """
+    Plaintext of a stored value (either format); failures are counted
+    (encryption.*) and give a placeholder. ciphers is _data_ciphers() of
+    the values being decrypted, if already looked up.
+    """
+    try:
+        if isinstance(token, memoryview):
+            token = bytes(token)
+        cipher = cipher_suite
+        key_id = data_key_id(token)
+        if key_id is not None:
+            cipher = (ciphers if ciphers is not None else _data_ciphers([token])).get(key_id)
+            if cipher is None:
+                metrics.incr('encryption.shredded')
+                return SHREDDED
+        data = cipher.decrypt(_fernet_token(token))
+        if not is_legacy(token):
+            data = _decompress(token[0] & ~KEYED, data)
+        return data.decode('utf-8')
+    except SynchronousOnlyOperation:
+        raise  # a data key lookup from async code: a bug in the caller, not a bad value
+    except InvalidToken:
+        metrics.incr('encryption.decrypt_failed')
+        _debug(f"Could not decrypt data for {model_name}: {token[:50]}...")
+        return DECRYPT_FAILED
+    except Exception as e:
+        metrics.incr('encryption.decrypt_error')
+        _debug(f"Error during decryption for {model_name}: {e}")
+        return DECRYPT_ERROR
+
+
+def encrypt(value, binary=False, data_key=None):
+    """
+    Stored form of a str or bytes value: with binary, the binary format
+    (compressed first if worthwhile), else a Fernet token as a str. A
+    data_key, (DataKey id, Fernet), encrypts a binary value instead of the
+    master key.
+    """
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if not binary:
+        return cipher_suite.encrypt(value).decode('utf-8')
+    version, data = _compress(value)
+    if data_key is None:
+        return bytes([version]) + urlsafe_b64decode(cipher_suite.encrypt(data))
+    key_id, cipher = data_key
+    return bytes([version | KEYED]) + _KEY_ID.pack(key_id) + urlsafe_b64decode(cipher.encrypt(data))
+
+
+# Bulk crypto: with ENCRYPTION_THREADS above 1, ENCRYPTION_PARALLEL_MIN_VALUES
+# or more values are split into batches of ENCRYPTION_BATCH_SIZE and spread
+# over that many threads; anything smaller runs on the calling thread
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _pool(threads):
+    with _pools_lock:
+        if threads not in _pools:
+            _pools[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='crypto')
+        return _pools[threads]
+
+
+def is_current(stored):
+    """
+    Whether a stored value was encrypted with the newest key (checked
+    without decrypting it). Values under a data key do not depend on the
+    master key; their DataKey row is what gets re-encrypted.
+    """
+    if data_key_id(stored) is not None:
+        return True
+    try:
+        primary_cipher.extract_timestamp(_fernet_token(stored))
+        return True
+    except InvalidToken:
+        return False
+
+
+def rotate(stored):
+    """
+    A stored value re-encrypted with the newest key, in the same format (a
+    compressed payload is not decompressed), or None if no key decrypts it.
+    """
+    try:
+        token = cipher_suite.rotate(_fernet_token(stored))
+    except InvalidToken:
+        metrics.incr('encryption.rotate_failed')
+        return None
+    if not is_legacy(stored):
+        return bytes(stored[:1]) + urlsafe_b64decode(token)
+    return token if isinstance(stored, bytes) else token.decode('ascii')
+
+
+def _map_batches(fn, items):
+    """[fn(item) for item in items], batches run in parallel when there are enough of them."""
+    batch_size, threads = settings.ENCRYPTION_BATCH_SIZE, settings.ENCRYPTION_THREADS
+    if threads <= 1 or len(items) < settings.ENCRYPTION_PARALLEL_MIN_VALUES:
+        return [fn(item) for item in items]
+    batches = [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+    results = []
+    for batch in _pool(threads).map(lambda batch: [fn(item) for item in batch], batches):
+        results.extend(batch)
+    return results
+
+
+def decrypt_many(tokens, model_name=None):
+    """decrypt() of every token, in batches (see _map_batches)."""
+    tokens = [bytes(token) if isinstance(token, memoryview) else token for token in tokens]
+    # Data keys are looked up here, as the worker threads have no database connection of their own
+    ciphers = _data_ciphers(tokens)
+    return _map_batches(lambda token: decrypt(token, model_name, ciphers), tokens)
+
+
+def encrypt_many(values, binary=False, data_key=None):
+    """encrypt() of every value, in batches (see _map_batches)."""
+    return _map_batches(lambda value: encrypt(value, binary, data_key), list(values))
+
+
+def rotate_many(stored_values):
+    """rotate() of every stored value, in batches (see _map_batches)."""
+    return _map_batches(rotate, list(stored_values))
+
+
+def _debug(message):
+    if settings.ENCRYPTED_FIELD_DEBUG:
+        print(f"EncryptedTextField: {message}")
+
+
+class Ciphertext:
+    """A value as loaded from the database, decrypted when first needed."""
+    __slots__ = ('token', 'model_name')
+
+    def __init__(self, token, model_name=None):
+        self.token = token
+        self.model_name = model_name
+
+    def decrypt(self):
+        return decrypt(self.token, self.model_name)
+
+    def __str__(self):
+        return self.decrypt()
+
+    def __repr__(self):
+        return f"Ciphertext({self.token[:16]!r}...)"
+
+
+def plaintext(value):
+    """value, decrypted if it is a Ciphertext."""
+    return value.decrypt() if isinstance(value, Ciphertext) else value
+
+
+class EncryptedAttribute(DeferredAttribute):
+    """
+    Decrypts the loaded Ciphertext on first access and keeps the plaintext on
+    the instance. A data descriptor (unlike DeferredAttribute), so it is
+    consulted even once the value is in the instance __dict__.
+    """
+
+    def __get__(self, instance, cls=None):
+        value = super().__get__(instance, cls)
+        if isinstance(value, Ciphertext):
+            value = instance.__dict__[self.field.attname] = value.decrypt()
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+def _decrypt_rows(rows):
+    """values() / values_list() rows with their Ciphertext values decrypted in one decrypt_many() call."""
+    found = []  # (row number, key or column) of each Ciphertext
+    for number, row in enumerate(rows):
+        if isinstance(row, dict):
+            found.extend((number, key) for key, value in row.items() if isinstance(value, Ciphertext))
+        elif isinstance(row, tuple):
+            found.extend((number, column) for column, value in enumerate(row) if isinstance(value, Ciphertext))
+        elif isinstance(row, Ciphertext):
+            found.append((number, None))
+    if not found:
+        return rows
+    originals = [rows[number] if at is None else rows[number][at] for number, at in found]
+    plain = decrypt_many([ciphertext.token for ciphertext in originals], originals[0].model_name)
+    decrypted = [dict(row) if isinstance(row, dict) else list(row) if isinstance(row, tuple) else row for row in rows]
+    for (number, at), value in zip(found, plain):
+        if at is None:
+            decrypted[number] = value
+        else:
+            decrypted[number][at] = value
+    # Back to the row types values_list() gives (tuples, or namedtuples with named=True)
+    return [type(row)(*new) if hasattr(row, '_fields') else tuple(new) if isinstance(row, tuple) else new
+            for row, new in zip(rows, decrypted)]
+
+
+def _decrypt_instances(instances):
+    """Decrypt the Ciphertext values of model instances in one decrypt_many() call."""
+    found = [(instance.__dict__, name, value) for instance in instances
+             for name, value in instance.__dict__.items() if isinstance(value, Ciphertext)]
+    if found:
+        plain = decrypt_many([value.token for _, _, value in found], found[0][2].model_name)
+        for (data, name, _), value in zip(found, plain):
+            data[name] = value
+    return instances
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _chunk_size():
+    # One batch, or enough rows to be spread over the threads
+    if settings.ENCRYPTION_THREADS <= 1:
+        return settings.ENCRYPTION_BATCH_SIZE
+    return max(settings.ENCRYPTION_BATCH_SIZE * settings.ENCRYPTION_THREADS, settings.ENCRYPTION_PARALLEL_MIN_VALUES)
+
+
+@functools.cache
+def _decrypting(iterable_class):
+    """iterable_class (values() / values_list() rows) with Ciphertext values decrypted."""
+    class DecryptingIterable(iterable_class):
+        def __iter__(self):
+            for chunk in _chunked(super().__iter__(), _chunk_size()):
+                yield from _decrypt_rows(chunk)
+    DecryptingIterable.__name__ = f'Decrypting{iterable_class.__name__}'
+    return DecryptingIterable
+
+
+class DecryptingModelIterable(ModelIterable):
+    """Model instances with their encrypted fields decrypted up front, in batches (see _map_batches)."""
+
+    def __iter__(self):
+        for chunk in _chunked(super().__iter__(), _chunk_size()):
+            yield from _decrypt_instances(chunk)
+
+
+class EncryptedQuerySet(models.QuerySet):
+    """
+    QuerySet for models with EncryptedTextFields: values() and values_list()
+    rows come back decrypted, like attributes of model instances do, and
+    bulk_create() encrypts all its objects' values in batches.
+    decrypted() does the same for instances that will all be read anyway.
+    """
+
+    def values(self, *fields, **expressions):
+        clone = super().values(*fields, **expressions)
+        clone._iterable_class = _decrypting(clone._iterable_class)
+        return clone
+
+    def values_list(self, *fields, flat=False, named=False):
+        clone = super().values_list(*fields, flat=flat, named=named)
+        clone._iterable_class = _decrypting(clone._iterable_class)
+        return clone
+
+    def decrypted(self):
+        """Decrypt every loaded instance's encrypted fields in bulk rather than one by one on access."""
+        clone = self._chain()
+        if clone._iterable_class is ModelIterable:
+            clone._iterable_class = DecryptingModelIterable
+        return clone
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        plain = []
+        for field in self.model._meta.concrete_fields:
+            if not isinstance(field, EncryptedTextField):
+                continue
+            groups = {}  # data key owner id -> [(obj __dict__, attname, plaintext)]
+            for obj in objs:
+                if isinstance(obj.__dict__.get(field.attname), (str, bytes)):
+                    groups.setdefault(field.data_key_owner_id(obj), []).append(
+                        (obj.__dict__, field.attname, obj.__dict__[field.attname]))
+            for owner_id, values in groups.items():
+                tokens = encrypt_many([value for _, _, value in values], field.binary, field.data_key(owner_id))
+                for (data, name, _), token in zip(values, tokens):
+                    data[name] = Ciphertext(token, self.model.__name__)  # saved as is by get_prep_value
+                plain.extend(values)
+        try:
+            return super().bulk_create(objs, *args, **kwargs)
+        finally:
+            for data, name, value in plain:
+                data[name] = value
+
 
 class EncryptedTextField(models.TextField):
     """
     A custom Django model field that encrypts text data before saving to the database
     and decrypts it when retrieved. Uses Fernet symmetric encryption.
+
+    Loaded values stay encrypted until the attribute is first read, so
+    queries that never read the field (counts, ordering, existence checks,
+    ids) do no decryption, and saving an instance whose value was never read
+    writes the stored token back as is. Set ENCRYPTED_FIELD_DEBUG to print
+    decryption failures.
+
+    With binary=True values are stored in a binary column in the compact
+    format (see encrypt()) instead of as base64 text; text tokens left from
+    before are still read. data_key_owner, a dotted attribute path from the
+    instance to a UserProfile id (e.g. 'session.user_profile_id'), encrypts
+    values with that profile's data key rather than the master key, so they
+    can be shredded with it (see data_keys.py).
     """
+    descriptor_class = EncryptedAttribute
+
+    def __init__(self, *args, binary=False, data_key_owner=None, **kwargs):
+        if data_key_owner and not binary:
+            raise ImproperlyConfigured("EncryptedTextField(data_key_owner=...) needs binary=True.")
+        self.binary = binary
+        self.data_key_owner = data_key_owner
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.binary:
+            kwargs['binary'] = True
+        if self.data_key_owner:
+            kwargs['data_key_owner'] = self.data_key_owner
+        return name, path, args, kwargs
+
+    def data_key_owner_id(self, instance):
+        """The UserProfile id whose data key encrypts this field of instance, or None for the master key."""
+        if not self.data_key_owner:
+            return None
+        value = instance
+        for name in self.data_key_owner.split('.'):
+            value = getattr(value, name, None)
+            if value is None:
+                return None
+        return value
+
+    def data_key(self, owner_id):
+        """(DataKey id, Fernet) for a data_key_owner_id(), or None for the master key."""
+        if owner_id is None:
+            return None
+        from . import data_keys  # imports the models, which import this module
+        return data_keys.current(owner_id)
+
+    def get_internal_type(self):
+        return 'BinaryField' if self.binary else super().get_internal_type()
+
     def from_db_value(self, value, expression, connection):
         if value is None:
             return value
-        # Debug: Track field usage
-        import inspect
-        caller_frame = inspect.currentframe().f_back.f_back
-        model_class = caller_frame.f_locals.get('self', None).__class__.__name__ if caller_frame.f_locals.get('self') else 'Unknown'
-        print(f"EncryptedTextField.from_db_value called for {model_class} with value: {value[:50]}...")
-        try:
-            # Decrypt directly (stored value is Fernet's URL-safe base64 string)
-            print(f"EncryptedTextField.from_db_value: Attempting to decrypt value: {value[:50]}...")
-            decrypted_bytes = cipher_suite.decrypt(urlsafe_b64decode(value))
-            decrypted_value = decrypted_bytes.decode('utf-8')
-            print(f"EncryptedTextField.from_db_value: Decrypted successfully: {decrypted_value[:50]}...")
-            return decrypted_value
-        except InvalidToken:
-            # Handle cases where decryption fails (e.g., wrong key, corrupted data)
-            # You might want to log this or return a placeholder
-            print(f"Warning: Could not decrypt data for {model_class}: {value}")
-            return "[ENCRYPTION_ERROR]"
-        except Exception as e:
-            print(f"Error during decryption for {model_class}: {e}")
-            return "[DECRYPTION_FAILED]"
+        if isinstance(value, memoryview):
+            value = bytes(value)
+        return Ciphertext(value, getattr(getattr(self, 'model', None), '__name__', None))
 
     def to_python(self, value):
         # This is called when loading from fixtures or forms
         if isinstance(value, bytes):
             return value.decode('utf-8')
+        return plaintext(value)
+
+    def pre_save(self, model_instance, add):
+        # Read past the descriptor: an untouched Ciphertext is saved without a decrypt/encrypt round trip
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, (str, bytes)) and self.data_key_owner:
+            data_key = self.data_key(self.data_key_owner_id(model_instance))
+            if data_key is not None:
+                return Ciphertext(encrypt(value, self.binary, data_key), model_instance.__class__.__name__)
         return value
 
     def get_prep_value(self, value):
         if value is None:
             return value
-        # Debug: Track field usage
-        import inspect
-        caller_frame = inspect.currentframe().f_back.f_back
-        model_class = caller_frame.f_locals.get('self', None).__class__.__name__ if caller_frame.f_locals.get('self') else 'Unknown'
-        print(f"EncryptedTextField.get_prep_value called for {model_class} with value: {value[:50]}...")
+        if isinstance(value, Ciphertext):
+            return value.token
         try:
-            # Ensure value is bytes before encryption
-            if isinstance(value, str):
-                value = value.encode('utf-8')
-            # Encrypt (Fernet returns URL-safe base64 bytes; decode to string for storage)
-            encrypted_bytes = cipher_suite.encrypt(value)
-            encrypted_value = encrypted_bytes.decode('utf-8')
-            print(f"EncryptedTextField.get_prep_value returning encrypted value: {encrypted_value[:50]}...")
-            return encrypted_value
+            return encrypt(value, self.binary)
         except Exception as e:
-            print(f"Error during encryption in get_prep_value: {str(e)}")
+            metrics.incr('encryption.encrypt_error')
+            _debug(f"Error during encryption in get_prep_value: {e}")
             return value
 
-    def get_db_prep_save(self, value, connection):
-        # Debug: Track field usage
-        import inspect
-        caller_frame = inspect.currentframe().f_back.f_back
-        model_class = caller_frame.f_locals.get('self', None).__class__.__name__ if caller_frame.f_locals.get('self') else 'Unknown'
-        print(f"EncryptedTextField.get_db_prep_save called for {model_class} with value: {value[:50]}...")
-        prep_value = self.get_prep_value(value)
-        print(f"EncryptedTextField.get_db_prep_save returning value: {prep_value[:50]}...")
-        return prep_value
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super().get_db_prep_value(value, connection, prepared)
+        if isinstance(value, (bytes, memoryview)):
+            return connection.Database.Binary(value)
+        return value
 
     def value_to_string(self, obj):
         # Used for serialization (e.g., Django's dumpdata)
-        value = self.value_from_object(obj)
-        return self.get_prep_value(value)
+        value = self.get_prep_value(self.value_from_object(obj))
+        if isinstance(value, bytes):
+            return urlsafe_b64encode(value).decode('ascii')
+        return value
@@ -6,9 +6,12 @@ from django.contrib.auth.models import User
 class BotConfigurationForm(forms.ModelForm):
     class Meta:
         model = BotConfiguration
-        fields = ['name', 'prompt_template']
+        fields = ['name', 'prompt_template', 'faq_answer_threshold', 'grounding_threshold', 'response_cache_ttl']
         widgets = {
             'prompt_template': forms.Textarea(attrs={'rows': 5}),
+            'faq_answer_threshold': forms.NumberInput(attrs={'step': '0.05', 'min': '0', 'max': '1'}),
+            'grounding_threshold': forms.NumberInput(attrs={'step': '0.05', 'min': '0', 'max': '1'}),
+            'response_cache_ttl': forms.NumberInput(attrs={'min': '0', 'placeholder': 'Site default'}),
         }
 
     def __init__(self, *args, **kwargs):
@@ -22,6 +25,18 @@ class BotConfigurationForm(forms.ModelForm):
             if field_name == 'prompt_template' and 'placeholder' not in field.widget.attrs:
                 field.widget.attrs['placeholder'] = 'Describe bot persona and instructions'
 
+    def clean(self):
+        cleaned_data = super().clean()
+        answer_threshold = cleaned_data.get('faq_answer_threshold')
+        grounding_threshold = cleaned_data.get('grounding_threshold')
+        for name in ('faq_answer_threshold', 'grounding_threshold'):
+            value = cleaned_data.get(name)
+            if value is not None and not 0 <= value <= 1:
+                self.add_error(name, "Thresholds must be between 0 and 1.")
+        if answer_threshold is not None and grounding_threshold is not None and grounding_threshold > answer_threshold:
+            self.add_error('grounding_threshold', "Grounding threshold cannot be above the FAQ answer threshold.")
+        return cleaned_data
+
 class UserRegistrationForm(UserCreationForm):
     captcha = forms.CharField(max_length=6, widget=forms.TextInput(attrs={'placeholder': 'Enter CAPTCHA'}))
 
@@ -0,0 +1,122 @@
+"""
+Binary on-disk format for the FAQ retrieval index.
+
+Layout (little-endian):
+
+    MAGIC (8 bytes) | header length (uint32) | header (UTF-8 JSON) | sections
+
+The header carries the format version, the FAQ table content hash the index
+was built from, and a table of named sections (offset, dtype, shape). Each
+section is a raw NumPy array aligned to 64 bytes, so the whole file can be
+np.memmap'ed and every array is a zero-copy view into the page cache.
+"""
+import hashlib
+import json
+import os
+import struct
+import uuid
+
+import numpy as np
+from django.db import models
+
+from .models import FAQ
+
+MAGIC = b'FAQIDX\x00\x01'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct('<8sI')
+
+
+def faq_content_hash():
+    """
+    SHA-256 over every FAQ row. Answers are hashed as stored ciphertext (a
+    plain QuerySet's values_list() leaves them as Ciphertext), so this never
+    decrypts.
+    """
+    digest = hashlib.sha256()
+    rows = models.QuerySet(FAQ).order_by('pk').values_list('pk', 'question', 'keywords', 'answer')
+    for pk, question, keywords, answer in rows.iterator():
+        digest.update('\x1f'.join(str(value) for value in (pk, question, keywords)).encode('utf-8'))
+        digest.update(b'\x1f')
+        if answer is not None:
+            token = answer.token
+            digest.update(token.encode('ascii') if isinstance(token, str) else token)
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+def pack_strings(strings):
+    """Encode strings as one uint8 blob preceded by int64 end offsets."""
+    encoded = [text.encode('utf-8') for text in strings]
+    ends = np.cumsum([len(chunk) for chunk in encoded], dtype=np.int64)
+    return np.concatenate([np.asarray([len(encoded)], dtype=np.int64), ends]).view(np.uint8).tobytes() + b''.join(encoded)
+
+
+def unpack_strings(buffer):
+    buffer = np.asarray(buffer, dtype=np.uint8)
+    count = int(buffer[:8].view(np.int64)[0])
+    ends = buffer[8:8 * (count + 1)].view(np.int64).tolist()
+    blob = buffer[8 * (count + 1):].tobytes()
+    strings = []
+    start = 0
+    for end in ends:
+        strings.append(blob[start:end].decode('utf-8'))
+        start = end
+    return strings
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_index(path, header, sections):
+    """Atomically write header fields plus named arrays (or packed bytes) to path."""
+    arrays = {}
+    for name, value in sections.items():
+        arrays[name] = np.frombuffer(value, dtype=np.uint8) if isinstance(value, bytes) else np.ascontiguousarray(value)
+    table = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        table[name] = [offset, array.dtype.str, list(array.shape)]
+        offset += array.nbytes
+    header = dict(header, format=FORMAT_VERSION, sections=table)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(_PREFIX.size + len(header_bytes))
+
+    path = os.fspath(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as fh:
+        fh.write(_PREFIX.pack(MAGIC, len(header_bytes)))
+        fh.write(header_bytes)
+        for name, array in arrays.items():
+            fh.seek(data_start + table[name][0])
+            fh.write(array.tobytes())
+        fh.truncate(data_start + offset)
+    # Readers holding the old file keep their mapping; new readers get the new one
+    os.replace(tmp_path, path)
+
+
+def read_index(path):
+    """Return (header, {name: memmapped array}), or None if missing or incompatible."""
+    try:
+        mapped = np.memmap(path, dtype=np.uint8, mode='r')
+    except (FileNotFoundError, ValueError):
+        return None
+    if len(mapped) < _PREFIX.size:
+        return None
+    magic, header_length = _PREFIX.unpack(mapped[:_PREFIX.size].tobytes())
+    if magic != MAGIC:
+        return None
+    header = json.loads(mapped[_PREFIX.size:_PREFIX.size + header_length].tobytes())
+    if header.get('format') != FORMAT_VERSION:
+        return None
+    data_start = _align(_PREFIX.size + header_length)
+    arrays = {}
+    for name, (offset, dtype, shape) in header['sections'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape)) if shape else 1
+        start = data_start + offset
+        arrays[name] = mapped[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+    return header, arrays
@@ -0,0 +1,190 @@
+"""
+Process-wide LLM client layer.
+
+The API key is configured once per process, and one model object is built
+per (model name, generation config, safety settings) and shared by every
+request and thread; google-generativeai model objects hold no per-call
+state. settings.LLM_BACKEND picks the backend: GeminiBackend talks to the
+Gemini API, FakeBackend answers locally so the app runs offline and in tests.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_MODEL = 'gemini-pro-latest'
+
+CHAT_GENERATION_CONFIG = {
+    "temperature": 0.9,
+    "top_p": 1,
+    "top_k": 1,
+    "max_output_tokens": 2048,
+}
+
+DEFAULT_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+
+_genai = None
+
+
+def gemini():
+    """The google.generativeai module, configured with GEMINI_API_KEY on first use."""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+
+        genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+        _genai = genai
+    return _genai
+
+
+class GeminiBackend:
+    """google-generativeai, configured once per process."""
+
+    name = 'gemini'
+
+    def __init__(self):
+        self.genai = gemini()
+
+    def model(self, model_name, generation_config=None, safety_settings=None):
+        return self.genai.GenerativeModel(model_name=model_name, generation_config=generation_config,
+                                          safety_settings=safety_settings)
+
+    def warm(self, model):
+        # count_tokens is free; it opens the channel the generate calls reuse
+        model.count_tokens("ping")
+
+
+class FakeResponse:
+    def __init__(self, text, delay=0.0):
+        self.text = text
+        self.delay = delay
+
+    def _chunks(self):
+        return [FakeResponse(self.text[start:start + 16]) for start in range(0, len(self.text), 16)]
+
+    def __iter__(self):
+        # Streamed responses yield chunks that each carry .text
+        for chunk in self._chunks():
+            time.sleep(self.delay)
+            yield chunk
+
+    async def __aiter__(self):
+        for chunk in self._chunks():
+            await asyncio.sleep(self.delay)
+            yield chunk
+
+
+class FakeModel:
+    """
+    Deterministic offline stand-in for a GenerativeModel. It echoes the
+    prompt's last line; settings.LLM_FAKE_DELAY (seconds per streamed chunk)
+    simulates a slow model.
+    """
+
+    def __init__(self, model_name, generation_config=None, safety_settings=None):
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.safety_settings = safety_settings
+        self.delay = getattr(settings, 'LLM_FAKE_DELAY', 0.0)
+
+    def _reply(self, contents):
+        prompt = contents if isinstance(contents, str) else json.dumps(contents, default=str)
+        last_line = prompt.strip().splitlines()[-1] if prompt.strip() else ''
+        return FakeResponse(f"[{self.model_name}] {last_line}", self.delay)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        response = self._reply(contents)
+        if not stream:
+            time.sleep(self.delay * len(response._chunks()))
+        return response
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        response = self._reply(contents)
+        if not stream:
+            await asyncio.sleep(self.delay * len(response._chunks()))
+        return response
+
+    def count_tokens(self, contents):
+        return FakeResponse(str(len(str(contents).split())))
+
+
+class FakeBackend:
+    name = 'fake'
+
+    def model(self, model_name, generation_config=None, safety_settings=None):
+        return FakeModel(model_name, generation_config, safety_settings)
+
+    def warm(self, model):
+        pass
+
+
+_backend = None
+_models = {}
+_lock = threading.Lock()
+
+
+def _freeze(value):
+    """Hashable, order-insensitive form of a generation config / safety settings value."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def get_backend():
+    global _backend
+    backend = _backend
+    if backend is None:
+        with _lock:
+            if _backend is None:
+                _backend = import_string(getattr(settings, 'LLM_BACKEND', 'chat.llm.GeminiBackend'))()
+            backend = _backend
+    return backend
+
+
+def get_model(model_name=DEFAULT_MODEL, generation_config=None, safety_settings=None):
+    """The shared model object for this (name, generation config, safety settings)."""
+    key = (model_name, _freeze(generation_config), _freeze(safety_settings))
+    model = _models.get(key)
+    if model is None:
+        backend = get_backend()
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                model = _models[key] = backend.model(model_name, generation_config, safety_settings)
+    return model
+
+
+def reset():
+    """Forget the backend and every cached model (e.g. after changing LLM_BACKEND)."""
+    global _backend
+    with _lock:
+        _backend = None
+        _models.clear()
+
+
+def warm_up():
+    """
+    Build the models the app uses and open the backend's connection in a
+    daemon thread, so the first chat message doesn't pay for either.
+    """
+    models = [get_model(), get_model(DEFAULT_MODEL, CHAT_GENERATION_CONFIG, DEFAULT_SAFETY_SETTINGS)]
+
+    def warm():
+        try:
+            get_backend().warm(models[0])
+        except Exception as e:
+            print(f"Could not warm up LLM connection: {e}")
+
+    threading.Thread(target=warm, name='llm-warm-up', daemon=True).start()
@@ -0,0 +1,72 @@
+import json
+import os
+import platform
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chat.bench import chat_view, runner
+from chat.management.commands.bench_retrieval import git_commit
+
+
+class Command(BaseCommand):
+    help = ('Compare how many concurrent chat POSTs the sync and async views sustain under ASGI, '
+            'with a simulated slow LLM, in a throwaway database; prints JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 200],
+                            help='Requests in flight per burst (default: 1 10 50 200)')
+        parser.add_argument('--views', nargs='+', choices=sorted(chat_view.VIEWS),
+                            help='Views to run (default: both)')
+        parser.add_argument('--llm-delay', type=float, default=0.05,
+                            help='Simulated LLM seconds per streamed chunk (LLM_FAKE_DELAY)')
+        parser.add_argument('--embed-delay', type=float, default=0.0,
+                            help='Simulated seconds to embed a query (FAQ_FAKE_EMBED_DELAY); needs --faqs')
+        parser.add_argument('--faqs', type=int, default=0,
+                            help='Synthetic FAQs to seed, so retrieval has an index to search (default: none)')
+        parser.add_argument('--rounds', type=int, default=3, help='Bursts per concurrency level')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['rounds'] < 1 or min(options['concurrency']) < 1:
+            raise CommandError('--rounds and --concurrency must be positive')
+        if options['faqs'] < 0 or options['embed_delay'] < 0:
+            raise CommandError('--faqs and --embed-delay must not be negative')
+
+        def log(message):
+            self.stderr.write(message)
+
+        scratch = tempfile.mkdtemp(prefix='bench_chat_view_')
+        started = time.time()
+        with override_settings(ROOT_URLCONF='chat.bench.chat_view', LLM_BACKEND='chat.llm.FakeBackend',
+                               LLM_FAKE_DELAY=options['llm_delay'], FAQ_INDEX_DIR=scratch,
+                               FAQ_EMBEDDER='chat.bench.chat_view.SlowEmbedder',
+                               FAQ_FAKE_EMBED_DELAY=options['embed_delay'],
+                               NEAR_DUPLICATE_ENABLED=False):  # every POST should reach the LLM
+            # SQLite's shared in-memory test database locks up under concurrent threads; use a file
+            with runner.fresh_database(os.path.join(scratch, 'db.sqlite3')):
+                try:
+                    results = chat_view.run(options['concurrency'], options['views'], options['rounds'],
+                                            options['faqs'], log=log)
+                finally:
+                    chat_view.llm.reset()
+                    chat_view.faq_index.invalidate_faq_index()
+        report = {
+            'commit': git_commit(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+            'python': platform.python_version(),
+            'llm_delay': options['llm_delay'],
+            'embed_delay': options['embed_delay'],
+            'faqs': options['faqs'],
+            'rounds': options['rounds'],
+            'results': results,
+        }
+        text = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as fh:
+                fh.write(text + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Wrote benchmark report to {options['output']}"))
+        else:
+            self.stdout.write(text)
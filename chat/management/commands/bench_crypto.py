@@ -0,0 +1,48 @@
+import json
+import platform
+import time
+
+import cryptography
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.bench import crypto, runner
+from chat.management.commands.bench_retrieval import git_commit
+
+
+class Command(BaseCommand):
+    help = ('Compare per-row and bulk (threaded, batched) EncryptedTextField encryption and decryption '
+            'in rows/second, in a throwaway database; prints JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='ChatMessage rows to encrypt and decrypt')
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help='ENCRYPTION_THREADS values for the bulk path (default: 1 2 4 8)')
+        parser.add_argument('--batch-size', type=int, default=256, help='ENCRYPTION_BATCH_SIZE for the bulk path')
+        parser.add_argument('--repeats', type=int, default=3, help='Runs per measurement; the fastest counts')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if min(options['rows'], options['batch_size'], options['repeats'], *options['threads']) < 1:
+            raise CommandError('--rows, --threads, --batch-size and --repeats must be positive')
+
+        def log(message):
+            self.stderr.write(message)
+
+        started = time.time()
+        with runner.fresh_database():
+            results = crypto.run(options['rows'], options['threads'], options['batch_size'],
+                                 options['repeats'], log=log)
+        report = {
+            'commit': git_commit(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+            'python': platform.python_version(),
+            'cryptography': cryptography.__version__,
+            'results': results,
+        }
+        text = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as fh:
+                fh.write(text + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Wrote benchmark report to {options['output']}"))
+        else:
+            self.stdout.write(text)
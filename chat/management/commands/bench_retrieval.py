@@ -0,0 +1,70 @@
+import json
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chat.bench import runner
+from chat.bench.strategies import STRATEGIES
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Benchmark FAQ retrieval strategies on synthetic corpora in a throwaway database '
+            'and print latency, throughput, memory and recall@k/MRR as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                            help='Corpus sizes to generate (default: 1k 10k 100k 1M)')
+        parser.add_argument('--strategies', nargs='+', choices=sorted(STRATEGIES),
+                            help='Strategies to run (default: all)')
+        parser.add_argument('--queries', type=int, default=200, help='Queries per query kind')
+        parser.add_argument('-k', type=int, default=5, help='Rank cutoff for recall@k and MRR')
+        parser.add_argument('--time-budget', type=float, default=10.0,
+                            help='Seconds per strategy and query kind before the rest is skipped')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--embedder', default='chat.embeddings.HashingEmbedder',
+                            help='FAQ_EMBEDDER to benchmark with (default: offline hashing embedder)')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['k'] < 1 or options['queries'] < 1:
+            raise CommandError('-k and --queries must be positive')
+
+        def log(message):
+            self.stderr.write(message)
+
+        index_dir = tempfile.mkdtemp(prefix='bench_faq_index_')
+        started = time.time()
+        with override_settings(FAQ_INDEX_DIR=index_dir, FAQ_EMBEDDER=options['embedder']):
+            results = runner.run(
+                options['sizes'], options['strategies'], query_count=options['queries'], k=options['k'],
+                time_budget=options['time_budget'], seed=options['seed'], log=log)
+        report = {
+            'commit': git_commit(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'k': options['k'],
+            'seed': options['seed'],
+            'embedder': options['embedder'],
+            'results': results,
+        }
+        text = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as fh:
+                fh.write(text + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Wrote benchmark report to {options['output']}"))
+        else:
+            self.stdout.write(text)
@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.faq_index import build_persisted_index, index_path
+
+class Command(BaseCommand):
+    help = 'Build the persisted FAQ retrieval index that workers map at startup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Index file to write (defaults to FAQ_INDEX_DIR/faq_index.bin)')
+
+    def handle(self, *args, **options):
+        path = options['output'] or index_path()
+        started = time.monotonic()
+        snapshot = build_persisted_index(path)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Wrote FAQ index for {len(snapshot)} FAQs to {path} in {time.monotonic() - started:.2f}s'
+            )
+        )
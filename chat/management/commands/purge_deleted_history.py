@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.purge import purge
+
+
+class Command(BaseCommand):
+    help = 'Delete the chat history users have deleted (already unreadable), in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Rows deleted per transaction (default: HISTORY_PURGE_BATCH_SIZE)')
+        parser.add_argument('--sleep', type=float, help='Seconds to pause between batches (default: HISTORY_PURGE_SLEEP)')
+
+    def handle(self, *args, **options):
+        if (options['batch_size'] is not None and options['batch_size'] < 1) or (options['sleep'] or 0) < 0:
+            raise CommandError('--batch-size must be positive and --sleep not negative')
+        messages, sessions = purge(options['batch_size'], options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {messages} messages in {sessions} deleted chat sessions'))
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+
+from chat.fields import ENCRYPTION_KEYS, Ciphertext, EncryptedTextField, is_current, rotate_many
+
+
+def encrypted_models():
+    """(label, model, [EncryptedTextField attnames]) of every chat model with encrypted fields."""
+    found = []
+    for model in apps.get_app_config('chat').get_models():
+        names = [field.attname for field in model._meta.concrete_fields if isinstance(field, EncryptedTextField)]
+        if names:
+            found.append((model._meta.label, model, names))
+    return found
+
+
+def key_id():
+    # Identifies the newest key without storing it; a checkpoint only counts for the key it was made with
+    return hashlib.sha256(ENCRYPTION_KEYS[0].encode('ascii')).hexdigest()[:16]
+
+
+class Command(BaseCommand):
+    help = ('Re-encrypt every EncryptedTextField value with the newest DJANGO_ENCRYPTION_KEY, in primary key '
+            'order and small batches, checkpointing progress so an interrupted run resumes where it stopped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows read and updated per transaction')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to pause between batches, leaving the database to live traffic')
+        parser.add_argument('--models', nargs='+', metavar='LABEL',
+                            help='Only these models (e.g. chat.ChatMessage); default: all with encrypted fields')
+        parser.add_argument('--checkpoint', default=str(settings.ENCRYPTION_REENCRYPT_CHECKPOINT),
+                            help='File recording progress (default: ENCRYPTION_REENCRYPT_CHECKPOINT)')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['sleep'] < 0:
+            raise CommandError('--batch-size must be positive and --sleep not negative')
+        targets = encrypted_models()
+        if options['models']:
+            unknown = set(options['models']) - {label for label, _, _ in targets}
+            if unknown:
+                raise CommandError(f"No encrypted fields on: {', '.join(sorted(unknown))}")
+            targets = [target for target in targets if target[0] in options['models']]
+        if len(ENCRYPTION_KEYS) == 1:
+            self.stdout.write(self.style.WARNING('Only one key is configured; rows under other keys cannot be read'))
+
+        checkpoint = {} if options['restart'] else self.load_checkpoint(options['checkpoint'])
+        for label, model, names in targets:
+            if checkpoint.get(label, {}).get('done'):
+                self.stdout.write(f'{label}: already done')
+                continue
+            self.reencrypt(label, model, names, checkpoint, options)
+        if any(checkpoint[label]['failed'] for label, _, _ in targets):
+            self.stdout.write(self.style.WARNING('Some values could not be decrypted with any configured key '
+                                                 'and were left as they are'))
+        else:
+            self.stdout.write(self.style.SUCCESS('All encrypted values are on the newest key; '
+                                                 'older keys can be removed'))
+
+    def load_checkpoint(self, path):
+        try:
+            with open(path, encoding='utf-8') as fh:
+                saved = json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not read checkpoint {path}: {e}; use --restart to start over')
+        if saved.get('key') != key_id():
+            self.stdout.write('Checkpoint was made for another key; starting over')
+            return {}
+        return saved['models']
+
+    def save_checkpoint(self, path, checkpoint):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fh:
+            json.dump({'key': key_id(), 'models': checkpoint}, fh)
+        os.replace(tmp, path)
+
+    def reencrypt(self, label, model, names, checkpoint, options):
+        progress = checkpoint.setdefault(label, {'last_pk': None, 'rotated': 0, 'current': 0, 'failed': 0})
+        if progress['last_pk'] is not None:
+            self.stdout.write(f"{label}: resuming after pk {progress['last_pk']}")
+        # A plain QuerySet leaves values as Ciphertext, so nothing is decrypted just to be read
+        rows = models.QuerySet(model).order_by('pk')
+        while True:
+            batch_rows = rows if progress['last_pk'] is None else rows.filter(pk__gt=progress['last_pk'])
+            batch = list(batch_rows.values_list('pk', *names)[:options['batch_size']])
+            if not batch:
+                break
+            updates = {}
+            for column, name in enumerate(names, start=1):
+                stale = [(row[0], row[column].token) for row in batch
+                         if row[column] is not None and not is_current(row[column].token)]
+                progress['current'] += sum(1 for row in batch if row[column] is not None) - len(stale)
+                rotated = rotate_many([token for _, token in stale])
+                progress['failed'] += rotated.count(None)
+                updates[name] = [(pk, token) for (pk, _), token in zip(stale, rotated) if token is not None]
+            # Short write transactions, so chat requests are not kept waiting for the database lock
+            with transaction.atomic():
+                for name, values in updates.items():
+                    field = model._meta.get_field(name)
+                    # A Value, as the attribute itself would be decrypted and encrypted again by bulk_update
+                    objs = [model(pk=pk, **{name: models.Value(Ciphertext(token), output_field=field)})
+                            for pk, token in values]
+                    models.QuerySet(model).bulk_update(objs, [name])
+                    progress['rotated'] += len(objs)
+            progress['last_pk'] = batch[-1][0]
+            self.save_checkpoint(options['checkpoint'], checkpoint)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        progress['done'] = True
+        self.save_checkpoint(options['checkpoint'], checkpoint)
+        message = (f"{label}: {progress['rotated']} re-encrypted, {progress['current']} already on the newest key, "
+                   f"{progress['failed']} could not be decrypted")
+        self.stdout.write(self.style.WARNING(message) if progress['failed'] else message)
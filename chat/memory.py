@@ -0,0 +1,134 @@
+"""
+Per-session conversation memory for prompts.
+
+Each session's memory is a dict in the Django cache, keyed by session_id:
+the last LLM_HISTORY_TURNS + 1 turns verbatim (the extra one being the
+message currently being answered), a rolling summary of the turns before
+them, and the id of the newest message it covers. Saving a message appends
+it and folds whatever falls out of the window into the summary, so a
+session's messages are decrypted once rather than on every reply.
+
+The summary is extractive: one line per older turn (its first sentence, cut
+to LLM_MEMORY_SUMMARY_LINE_TOKENS), oldest lines dropped beyond
+LLM_MEMORY_SUMMARY_TOKENS. It costs no LLM call.
+
+If the cached memory is missing or no longer ends at the session's newest
+message (expired, or written by another worker with a per-process cache), it
+is rebuilt from the last LLM_MEMORY_REBUILD_MESSAGES messages. Like the
+response cache, memory holds decrypted text, for LLM_MEMORY_TTL seconds.
+"""
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+from .prompting import estimate_tokens, truncate_to_tokens
+
+KEY = 'memory:{}'
+SENTENCE_RE = re.compile(r'(?<=[.!?])\s')
+
+
+class History(list):
+    """[(sender, content), ...] recent turns, oldest first, plus .summary of the turns before them."""
+
+    def __init__(self, turns=(), summary=''):
+        super().__init__(turns)
+        self.summary = summary
+
+
+def summary_line(sender, content):
+    first = SENTENCE_RE.split((content or '').strip(), maxsplit=1)[0]
+    first = truncate_to_tokens(' '.join(first.split()), settings.LLM_MEMORY_SUMMARY_LINE_TOKENS)
+    return f"{'User asked' if sender == 'user' else 'Assistant said'}: {first}"
+
+
+def empty():
+    return {'turns': [], 'summary': [], 'last_id': None}
+
+
+def append(memory, message_id, sender, content):
+    """Add a turn to memory (in place), folding turns that leave the window into the summary."""
+    memory['turns'].append((sender, content))
+    memory['last_id'] = message_id
+    while len(memory['turns']) > settings.LLM_HISTORY_TURNS + 1:
+        memory['summary'].append(summary_line(*memory['turns'].pop(0)))
+    budget = settings.LLM_MEMORY_SUMMARY_TOKENS
+    while memory['summary'] and sum(estimate_tokens(line) for line in memory['summary']) > budget:
+        memory['summary'].pop(0)
+    return memory
+
+
+def history(memory, skip_latest=True):
+    turns = memory['turns'][:-1] if skip_latest else memory['turns']
+    return History(turns[-settings.LLM_HISTORY_TURNS:], '\n'.join(memory['summary']))
+
+
+def _newest(messages):
+    return messages.order_by('-timestamp', '-id')
+
+
+def _rebuild(rows):
+    memory = empty()
+    for message in reversed(rows):
+        append(memory, message.id, message.sender, message.content)
+    return memory
+
+
+def _store(session_id, memory):
+    cache.set(KEY.format(session_id), memory, timeout=settings.LLM_MEMORY_TTL)
+
+
+def load(chat_session):
+    """The session's memory, rebuilt from the database if the cached one is missing or behind."""
+    memory = cache.get(KEY.format(chat_session.session_id))
+    newest_id = _newest(chat_session.messages).values_list('id', flat=True).first()
+    if memory is not None and memory['last_id'] == newest_id:
+        metrics.incr('memory.hit')
+        return memory
+    metrics.incr('memory.rebuild')
+    memory = _rebuild(list(_newest(chat_session.messages)[:settings.LLM_MEMORY_REBUILD_MESSAGES]))
+    _store(chat_session.session_id, memory)
+    return memory
+
+
+def record(chat_session, message):
+    """Append a just-saved message to the session's memory, if memory is cached and was current."""
+    key = KEY.format(chat_session.session_id)
+    memory = cache.get(key)
+    if memory is None:
+        return  # built on the next load()
+    previous_id = _newest(chat_session.messages.exclude(id=message.id)).values_list('id', flat=True).first()
+    if memory['last_id'] != previous_id:
+        cache.delete(key)  # missed a message; rebuilt on the next load()
+        return
+    _store(chat_session.session_id, append(memory, message.id, message.sender, message.content))
+
+
+async def aload(chat_session):
+    memory = await cache.aget(KEY.format(chat_session.session_id))
+    newest_id = await _newest(chat_session.messages).values_list('id', flat=True).afirst()
+    incr = sync_to_async(metrics.incr, thread_sensitive=False)
+    if memory is not None and memory['last_id'] == newest_id:
+        await incr('memory.hit')
+        return memory
+    await incr('memory.rebuild')
+    rows = [message async for message in _newest(chat_session.messages)[:settings.LLM_MEMORY_REBUILD_MESSAGES]]
+    # Decrypting may load the user's data key from the database
+    memory = await sync_to_async(_rebuild)(rows)
+    await cache.aset(KEY.format(chat_session.session_id), memory, timeout=settings.LLM_MEMORY_TTL)
+    return memory
+
+
+async def arecord(chat_session, message):
+    key = KEY.format(chat_session.session_id)
+    memory = await cache.aget(key)
+    if memory is None:
+        return
+    previous_id = await _newest(chat_session.messages.exclude(id=message.id)).values_list('id', flat=True).afirst()
+    if memory['last_id'] != previous_id:
+        await cache.adelete(key)
+        return
+    append(memory, message.id, message.sender, message.content)
+    await cache.aset(key, memory, timeout=settings.LLM_MEMORY_TTL)
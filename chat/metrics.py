@@ -0,0 +1,149 @@
+"""
+Counters, gauges, value samples and recent events shared across workers
+through the Django cache.
+
+Names are dotted strings (e.g. "retrieval.decision.faq"). Every name ever
+used is remembered under NAMES_KEY / SAMPLE_NAMES_KEY / GAUGE_NAMES_KEY so
+snapshot(), percentiles() and gauges() can report them all without the cache
+backend having to support key listing. Every update is a single cache write
+or an atomic cache.incr, never a read-modify-write of a shared list: samples
+are counted into fixed histogram buckets for the current hour, events go to
+the next slot of a fixed ring. A gauge holds the last value any worker set.
+"""
+import math
+import time
+
+import numpy as np
+from django.core.cache import cache
+
+COUNTER_KEY = 'metrics:counter:{}'
+NAMES_KEY = 'metrics:names'
+SAMPLES_KEY = 'metrics:samples:{}:{}:{}'
+SAMPLE_NAMES_KEY = 'metrics:sample_names'
+EVENTS_KEY = 'metrics:events:{}:{}'
+EVENT_SEQ_KEY = 'metrics:events:{}:seq'
+GAUGE_KEY = 'metrics:gauge:{}'
+GAUGE_NAMES_KEY = 'metrics:gauge_names'
+# Samples are counted in log-spaced histogram buckets per SAMPLE_WINDOW seconds;
+# buckets are HISTOGRAM_GROWTH wide and cover GROWTH**MIN_STEP to GROWTH**MAX_STEP
+SAMPLE_WINDOW = 60 * 60
+HISTOGRAM_GROWTH = 1.05
+HISTOGRAM_MIN_STEP = -142  # about 0.001
+HISTOGRAM_MAX_STEP = 331  # about 10 million
+_LOG_GROWTH = math.log(HISTOGRAM_GROWTH)
+_BUCKETS = HISTOGRAM_MAX_STEP - HISTOGRAM_MIN_STEP + 2
+# Events kept per event name
+EVENT_LIMIT = 100
+
+_registered = set()
+
+
+def _register(name, names_key=NAMES_KEY):
+    names = cache.get(names_key) or []
+    if name not in names:
+        cache.set(names_key, sorted(set(names) | {name}), timeout=None)
+    _registered.add((names_key, name))
+
+
+def incr(name, amount=1):
+    """Increment counter name; never raises so metrics cannot break a request."""
+    try:
+        if (NAMES_KEY, name) not in _registered:
+            _register(name)
+        key = COUNTER_KEY.format(name)
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, amount)
+    except Exception as e:
+        print(f"Could not record metric {name}: {e}")
+
+
+def snapshot(prefix=''):
+    """Current value of every known counter whose name starts with prefix."""
+    names = [name for name in cache.get(NAMES_KEY) or [] if name.startswith(prefix)]
+    values = cache.get_many([COUNTER_KEY.format(name) for name in names])
+    return {name: values.get(COUNTER_KEY.format(name), 0) for name in names}
+
+
+def gauge(name, value):
+    """Set gauge name to value (queue depth, breaker state, ...); never raises."""
+    try:
+        if (GAUGE_NAMES_KEY, name) not in _registered:
+            _register(name, GAUGE_NAMES_KEY)
+        cache.set(GAUGE_KEY.format(name), value, timeout=None)
+    except Exception as e:
+        print(f"Could not record metric {name}: {e}")
+
+
+def gauges(prefix=''):
+    names = [name for name in cache.get(GAUGE_NAMES_KEY) or [] if name.startswith(prefix)]
+    values = cache.get_many([GAUGE_KEY.format(name) for name in names])
+    return {name: values.get(GAUGE_KEY.format(name)) for name in names}
+
+
+def _bucket(value):
+    """Histogram bucket of value: 0 for values <= 0, else its HISTOGRAM_GROWTH log step (clamped)."""
+    if value <= 0:
+        return 0
+    step = math.floor(math.log(value) / _LOG_GROWTH)
+    return min(max(step, HISTOGRAM_MIN_STEP), HISTOGRAM_MAX_STEP) - HISTOGRAM_MIN_STEP + 1
+
+
+def _bucket_value(bucket):
+    """Geometric middle of a bucket: the value percentiles() reports for it."""
+    if bucket == 0:
+        return 0.0
+    return HISTOGRAM_GROWTH ** (bucket - 1 + HISTOGRAM_MIN_STEP + 0.5)
+
+
+def observe(name, value):
+    """Record one sample of a measured value (latency, size, ...); never raises."""
+    try:
+        if (SAMPLE_NAMES_KEY, name) not in _registered:
+            _register(name, SAMPLE_NAMES_KEY)
+        window = int(time.time() // SAMPLE_WINDOW)
+        key = SAMPLES_KEY.format(name, window, _bucket(float(value)))
+        # Kept through the next window, which reports this one too
+        cache.add(key, 0, timeout=2 * SAMPLE_WINDOW)
+        cache.incr(key)
+    except Exception as e:
+        print(f"Could not record metric {name}: {e}")
+
+
+def percentiles(prefix=''):
+    """
+    {name: {count, p50, p95, p99, max}} over the samples of each name in
+    the current and previous SAMPLE_WINDOW, read off the histogram (each
+    value within a HISTOGRAM_GROWTH factor of the exact one).
+    """
+    names = [name for name in cache.get(SAMPLE_NAMES_KEY) or [] if name.startswith(prefix)]
+    window = int(time.time() // SAMPLE_WINDOW)
+    result = {}
+    for name in names:
+        keys = [SAMPLES_KEY.format(name, w, bucket) for w in (window - 1, window) for bucket in range(_BUCKETS)]
+        values = cache.get_many(keys)
+        counts = np.array([values.get(key, 0) for key in keys], dtype=np.int64).reshape(2, _BUCKETS).sum(axis=0)
+        total = int(counts.sum())
+        if not total:
+            continue
+        cumulative = np.cumsum(counts)
+        p50, p95, p99 = (_bucket_value(int(np.searchsorted(cumulative, q * total))) for q in (0.5, 0.95, 0.99))
+        result[name] = {'count': total, 'p50': p50, 'p95': p95, 'p99': p99,
+                        'max': _bucket_value(int(np.flatnonzero(counts)[-1]))}
+    return result
+
+
+def log_event(name, event, limit=EVENT_LIMIT):
+    """Keep event (a JSON-serialisable dict) among the last limit events of name."""
+    try:
+        # Each event takes the next slot of a ring of limit keys; incr hands out slots atomically
+        cache.add(EVENT_SEQ_KEY.format(name), 0, timeout=None)
+        seq = cache.incr(EVENT_SEQ_KEY.format(name))
+        cache.set(EVENTS_KEY.format(name, seq % limit), (seq, event), timeout=None)
+    except Exception as e:
+        print(f"Could not record event {name}: {e}")
+
+
+def events(name, limit=EVENT_LIMIT):
+    """The last limit events of name, oldest first."""
+    values = cache.get_many([EVENTS_KEY.format(name, slot) for slot in range(limit)])
+    return [event for _, event in sorted(values.values(), key=lambda item: item[0])]
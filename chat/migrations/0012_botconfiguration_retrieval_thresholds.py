@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_faq_keywords'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botconfiguration',
+            name='faq_answer_threshold',
+            field=models.FloatField(default=0.75, help_text='Retrieval confidence (0-1) at or above which the FAQ answer is returned without calling Gemini'),
+        ),
+        migrations.AddField(
+            model_name='botconfiguration',
+            name='grounding_threshold',
+            field=models.FloatField(default=0.35, help_text='Retrieval confidence (0-1) at or above which Gemini is given the top FAQ passages as context'),
+        ),
+    ]
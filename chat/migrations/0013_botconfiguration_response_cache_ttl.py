@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_botconfiguration_retrieval_thresholds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botconfiguration',
+            name='response_cache_ttl',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds to reuse a cached Gemini reply for this bot (empty: site default, 0: never cache)', null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:03
+
+import chat.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_chatmessage_client_message_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='content',
+            field=chat.fields.EncryptedTextField(binary=True),
+        ),
+        migrations.AlterField(
+            model_name='faq',
+            name='answer',
+            field=chat.fields.EncryptedTextField(binary=True),
+        ),
+        migrations.AlterField(
+            model_name='sensitivedata',
+            name='sensitive_info',
+            field=chat.fields.EncryptedTextField(binary=True),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='bot_personality',
+            field=chat.fields.EncryptedTextField(binary=True, default='Friendly'),
+        ),
+    ]
@@ -0,0 +1,146 @@
+"""
+Rewrites encrypted values stored as base64 text tokens (either form, see
+text_token) in the compact binary format (0016 only changed the column types;
+text tokens stay readable).
+
+Rows are read BATCH_SIZE at a time in primary key order, so a table is never
+loaded whole, and each batch commits on its own: an interrupted run leaves
+converted and unconverted rows, both readable, and running it again only
+converts what is left. Values that cannot be decrypted are left as they are.
+
+The format is copied here as it was when this migration was written (a
+version byte, then the raw Fernet token under the master keys; values are
+compressed with zlib when that makes them smaller), and columns are read and
+written as raw values past EncryptedTextField, so later changes to
+chat/fields.py do not change what this migration does.
+"""
+import os
+import zlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from cryptography.fernet import Fernet, MultiFernet
+from django.db import migrations, models, transaction
+from django.db.models import ExpressionWrapper, F, Value
+
+BATCH_SIZE = 500
+FIELDS = [
+    ('ChatMessage', 'content'),
+    ('FAQ', 'answer'),
+    ('UserProfile', 'bot_personality'),
+    ('SensitiveData', 'sensitive_info'),
+]
+
+FORMAT_RAW = 1
+FORMAT_ZLIB = 2
+FORMAT_ZSTD = 3
+COMPRESS_MIN_BYTES = 128
+# Start of every Fernet token in base64 (version byte 0x80, then a timestamp)
+FERNET_PREFIX = b'gAAAAA'
+
+
+def master_cipher():
+    keys = [key.strip() for key in os.environ.get('DJANGO_ENCRYPTION_KEY', '').split(',') if key.strip()]
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def is_text(stored):
+    """Whether a stored value is a base64 Fernet token rather than the binary format."""
+    return isinstance(stored, str) or not stored or stored[0] not in (FORMAT_RAW, FORMAT_ZLIB, FORMAT_ZSTD)
+
+
+def text_token(stored):
+    """
+    The Fernet token of a text value; values written before this series hold
+    it base64-encoded once more ("Z0FBQUFB...").
+    """
+    raw = stored.encode('ascii') if isinstance(stored, str) else bytes(stored)
+    if not raw.startswith(FERNET_PREFIX):
+        decoded = urlsafe_b64decode(raw)
+        if decoded.startswith(FERNET_PREFIX):
+            return decoded
+    return raw
+
+
+def decrypt(cipher, stored):
+    """Plaintext bytes of a stored value, or None if it cannot be decrypted."""
+    try:
+        if is_text(stored):
+            return cipher.decrypt(text_token(stored))
+        data = cipher.decrypt(urlsafe_b64encode(stored[1:]))
+        if stored[0] == FORMAT_ZLIB:
+            return zlib.decompress(data)
+        if stored[0] == FORMAT_ZSTD:
+            import zstandard
+
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+    except Exception:
+        return None
+
+
+def encrypt(cipher, data, binary):
+    if not binary:
+        return cipher.encrypt(data).decode('ascii')
+    version = FORMAT_RAW
+    if len(data) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            version, data = FORMAT_ZLIB, compressed
+    return bytes([version]) + urlsafe_b64decode(cipher.encrypt(data))
+
+
+def convert(apps, to_binary):
+    cipher = master_cipher()
+    # Written as plain column values, so EncryptedTextField does not encrypt them again
+    output_field = models.BinaryField() if to_binary else models.TextField()
+    for model_name, field_name in FIELDS:
+        model = apps.get_model('chat', model_name)
+        last_pk, converted, skipped = None, 0, 0
+        while True:
+            rows = model.objects.order_by('pk')
+            if last_pk is not None:
+                rows = rows.filter(pk__gt=last_pk)
+            stored = ExpressionWrapper(F(field_name), output_field=models.BinaryField())
+            batch = list(rows.annotate(stored=stored).values_list('pk', 'stored')[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            stale = [(pk, bytes(value) if isinstance(value, memoryview) else value) for pk, value in batch
+                     if value is not None and is_text(value) == to_binary]
+            objs = []
+            for pk, value in stale:
+                data = decrypt(cipher, value)
+                if data is None:
+                    skipped += 1
+                    continue
+                objs.append(model(pk=pk, **{field_name: Value(encrypt(cipher, data, to_binary),
+                                                              output_field=output_field)}))
+            if not objs:
+                continue
+            with transaction.atomic():
+                model.objects.bulk_update(objs, [field_name])
+            converted += len(objs)
+        if skipped:
+            print(f"\n  {model_name}.{field_name}: {converted} converted, {skipped} left as is (could not decrypt)")
+
+
+def to_binary(apps, schema_editor):
+    convert(apps, True)
+
+
+def to_text(apps, schema_editor):
+    # Run before 0016 turns the columns back into text; on PostgreSQL that
+    # cast needs the values to be ASCII, which the text tokens are.
+    convert(apps, False)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chat', '0016_encrypted_binary_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_binary, to_text),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:09
+
+import chat.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_convert_encrypted_rows'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='content',
+            field=chat.fields.EncryptedTextField(binary=True, data_key_owner='session.user_profile_id'),
+        ),
+        migrations.AlterField(
+            model_name='chatsession',
+            name='user_profile',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chat_sessions', to='chat.userprofile'),
+        ),
+        migrations.CreateModel(
+            name='DataKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', chat.fields.EncryptedTextField(binary=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('shredded_at', models.DateTimeField(blank=True, null=True)),
+                ('user_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data_keys', to='chat.userprofile')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0018_user_data_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='generated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -4,35 +4,61 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta # Import timedelta for DurationField default
-from .fields import EncryptedTextField # Import the custom encrypted field
+from .fields import EncryptedQuerySet, EncryptedTextField # Import the custom encrypted field
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    bot_personality = EncryptedTextField(default='Friendly')
+    bot_personality = EncryptedTextField(binary=True, default='Friendly')
     chats_initiated = models.IntegerField(default=0)
     total_chat_time = models.DurationField(default=timedelta)
     custom_bots = models.IntegerField(default=0)
 
+    objects = EncryptedQuerySet.as_manager()
+
     def __str__(self):
         return self.user.username
 
+class DataKey(models.Model):
+    user_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='data_keys')
+    key = EncryptedTextField(binary=True, null=True) # The user's Fernet key, encrypted with the master key; cleared when shredded
+    created_at = models.DateTimeField(auto_now_add=True)
+    shredded_at = models.DateTimeField(null=True, blank=True)
+
+    objects = EncryptedQuerySet.as_manager()
+
+    def __str__(self):
+        return f"Data key {self.pk} for {self.user_profile}"
+
 class ChatSession(models.Model):
-    user_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='chat_sessions')
+    user_profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, null=True, blank=True, related_name='chat_sessions') # None once its history is deleted, until purged
     session_id = models.CharField(max_length=36, unique=True, editable=False) # Temporarily CharField to fix invalid UUIDs
     start_time = models.DateTimeField(auto_now_add=True)
     end_time = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
+        if self.user_profile_id is None:
+            return f"Session {self.session_id} (deleted)"
         return f"Session {self.session_id} for {self.user_profile.user.username}"
 
 class ChatMessage(models.Model):
     session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
     sender = models.CharField(max_length=10) # 'user' or 'bot'
-    content = EncryptedTextField() # Changed to EncryptedTextField
+    content = EncryptedTextField(binary=True, data_key_owner='session.user_profile_id') # Encrypted with the user's data key
+    bot = models.ForeignKey('BotConfiguration', on_delete=models.SET_NULL, null=True, blank=True, related_name='messages') # Bot that wrote a 'bot' message
+    client_message_id = models.CharField(max_length=64, null=True, blank=True) # Client's id for the exchange, on both its messages
+    generated = models.BooleanField(default=False) # A completed Gemini reply, reusable for near-duplicate questions
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    objects = EncryptedQuerySet.as_manager()
+
     class Meta:
         ordering = ['timestamp']
+        constraints = [
+            # One user message and one bot reply per client message id in a session
+            models.UniqueConstraint(fields=['session', 'sender', 'client_message_id'],
+                                    condition=models.Q(client_message_id__isnull=False),
+                                    name='unique_client_message_per_session'),
+        ]
 
     def __str__(self):
         return f"{self.sender} in {self.session.session_id}: {self.content[:50]}"
@@ -41,6 +67,9 @@ class BotConfiguration(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
     prompt_template = models.TextField(blank=True, null=True) # For defining bot's persona/instructions
+    faq_answer_threshold = models.FloatField(default=0.75, help_text="Retrieval confidence (0-1) at or above which the FAQ answer is returned without calling Gemini")
+    grounding_threshold = models.FloatField(default=0.35, help_text="Retrieval confidence (0-1) at or above which Gemini is given the top FAQ passages as context")
+    response_cache_ttl = models.PositiveIntegerField(blank=True, null=True, help_text="Seconds to reuse a cached Gemini reply for this bot (empty: site default, 0: never cache)")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -49,11 +78,13 @@ class BotConfiguration(models.Model):
 
 class FAQ(models.Model):
     question = models.TextField(unique=True)
-    answer = EncryptedTextField()
+    answer = EncryptedTextField(binary=True)
     keywords = models.TextField(blank=True, help_text="Comma-separated keywords for semantic matching (e.g., 'account,login,access')")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = EncryptedQuerySet.as_manager()
+
     class Meta:
         verbose_name = "FAQ"
         verbose_name_plural = "FAQs"
@@ -70,8 +101,10 @@ class FAQ(models.Model):
 # Example model for sensitive data (already created)
 class SensitiveData(models.Model):
     name = models.CharField(max_length=100)
-    sensitive_info = EncryptedTextField()
+    sensitive_info = EncryptedTextField(binary=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = EncryptedQuerySet.as_manager()
+
     def __str__(self):
         return self.name
\ No newline at end of file
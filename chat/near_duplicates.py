@@ -0,0 +1,213 @@
+"""
+Near-duplicate questions answered from chat history.
+
+Every standalone exchange (a session's first user message and the bot reply
+to it, so the reply depends on nothing but the question and the bot) whose
+reply is a completed Gemini generation (ChatMessage.generated; not a
+fallback FAQ answer or an error message) is indexed by the MinHash signature of the question. A new standalone question
+whose estimated Jaccard similarity to an indexed one reaches
+NEAR_DUPLICATE_THRESHOLD, for the same bot and within NEAR_DUPLICATE_WINDOW
+seconds (and since the bot was last edited), is given the earlier reply
+instead of a new Gemini call.
+
+Signatures are NUM_PERM 32-bit min-hashes of the question's character
+shingles; LSH splits them into BANDS bands whose hashes select candidate
+buckets, so a lookup only compares against questions sharing a band. The
+index holds signatures and ChatMessage ids only (replies are decrypted from
+the database on a hit), keeps at most NEAR_DUPLICATE_MAX_ENTRIES entries,
+oldest dropped first, and is per worker: it is built from recent history on
+first use and then grows as this worker saves replies.
+"""
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .canonical import canonicalize
+from .models import ChatMessage, ChatSession
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 4
+# Parameters of the NUM_PERM hash functions (a * x + b) mod MERSENNE_61
+MERSENNE_61 = (1 << 61) - 1
+_rng = np.random.RandomState(20240607)
+_A = _rng.randint(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+
+Entry = namedtuple('Entry', ['bot_id', 'created', 'signature'])
+
+
+def shingles(text):
+    text = f" {canonicalize(text)} "
+    if len(text) <= SHINGLE:
+        return {text}
+    return {text[i:i + SHINGLE] for i in range(len(text) - SHINGLE + 1)}
+
+
+def signature(text):
+    hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles(text)), dtype=np.uint64)
+    # uint64 products wrap around; that only permutes the hash family
+    permuted = (np.outer(hashes, _A) + _B) % MERSENNE_61
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def _bucket_keys(bot_id, sig):
+    return [hash((bot_id, band, sig[band * ROWS:(band + 1) * ROWS].tobytes())) for band in range(BANDS)]
+
+
+class NearDuplicateIndex:
+    def __init__(self, threshold, window, max_entries):
+        self.threshold = threshold
+        self.window = window
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # bot reply ChatMessage id -> Entry, oldest first
+        self._buckets = {}  # band key -> [message ids]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, message_id, bot_id, question, created):
+        sig = signature(question)
+        with self._lock:
+            if message_id in self._entries:
+                return
+            self._entries[message_id] = Entry(bot_id, created, sig)
+            for key in _bucket_keys(bot_id, sig):
+                self._buckets.setdefault(key, []).append(message_id)
+            self._expire(time.time())
+
+    def _drop(self, message_id):
+        entry = self._entries.pop(message_id)
+        for key in _bucket_keys(entry.bot_id, entry.signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.remove(message_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def _expire(self, now):
+        while self._entries:
+            oldest_id, oldest = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and oldest.created >= now - self.window:
+                break
+            self._drop(oldest_id)
+
+    def find(self, bot_id, question, not_before=0.0):
+        """(message id, estimated similarity) of the closest match created after not_before, or None."""
+        sig = signature(question)
+        now = time.time()
+        # Entries are expired oldest-added first, which need not be oldest-created
+        not_before = max(not_before, now - self.window)
+        with self._lock:
+            self._expire(now)
+            candidates = set()
+            for key in _bucket_keys(bot_id, sig):
+                candidates.update(self._buckets.get(key, ()))
+            best = None
+            for message_id in candidates:
+                entry = self._entries[message_id]
+                if entry.bot_id != bot_id or entry.created < not_before:
+                    continue  # band key collision, or replied before the bot was last edited
+                similarity = float(np.mean(entry.signature == sig))
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (message_id, similarity)
+            return best
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _standalone_pairs(since):
+    """
+    (user message id, bot reply id, bot id, created) of the first exchange of
+    sessions since `since`, where the reply was generated.
+    """
+    rows = (ChatMessage.objects
+            .filter(session__in=ChatSession.objects.filter(start_time__gte=since))
+            .order_by('session_id', 'timestamp', 'id')
+            .values_list('id', 'session_id', 'sender', 'bot_id', 'timestamp', 'generated'))
+    pairs, session, position, first = [], None, 0, None
+    for message_id, session_id, sender, bot_id, timestamp, generated in rows.iterator():
+        if session_id != session:
+            session, position, first = session_id, 0, None
+        position += 1
+        if position == 1 and sender == 'user':
+            first = message_id
+        elif position == 2 and sender == 'bot' and generated and first is not None:
+            pairs.append((first, message_id, bot_id, timestamp.timestamp()))
+    return pairs
+
+
+def build_index():
+    """A NearDuplicateIndex over the standalone exchanges still inside the freshness window."""
+    index = NearDuplicateIndex(settings.NEAR_DUPLICATE_THRESHOLD, settings.NEAR_DUPLICATE_WINDOW,
+                               settings.NEAR_DUPLICATE_MAX_ENTRIES)
+    pairs = _standalone_pairs(timezone.now() - timedelta(seconds=settings.NEAR_DUPLICATE_WINDOW))
+    pairs = sorted(pairs, key=lambda pair: pair[3])[-index.max_entries:]
+    # Only the questions are decrypted; replies are read back on a hit
+    questions = ChatMessage.objects.in_bulk([pair[0] for pair in pairs])
+    for question_id, reply_id, bot_id, created in pairs:
+        if question_id in questions:
+            index.add(reply_id, bot_id, questions[question_id].content, created)
+    return index
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = build_index()
+    return _index
+
+
+def reset():
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def lookup(question, bot_config=None):
+    """The earlier reply to a near-duplicate standalone question, or None."""
+    if not settings.NEAR_DUPLICATE_ENABLED:
+        return None
+    bot_id = getattr(bot_config, 'id', None)
+    # Replies given before the bot's last edit may not match its current template
+    not_before = bot_config.updated_at.timestamp() if bot_config is not None else 0.0
+    match = get_index().find(bot_id, question, not_before)
+    if match is not None:
+        # Not from history its user has deleted since
+        reply = ChatMessage.objects.filter(id=match[0], session__user_profile__isnull=False).first()
+        if reply is not None:
+            metrics.incr('near_duplicate.hit')
+            metrics.observe('near_duplicate.similarity', match[1])
+            return reply.content
+    metrics.incr('near_duplicate.miss')
+    return None
+
+
+def remember(question, reply_message, bot_config=None):
+    """
+    Index a standalone exchange just saved (reply_message is the bot's
+    ChatMessage), if its reply was saved as a completed generation.
+    """
+    if not settings.NEAR_DUPLICATE_ENABLED or not reply_message.generated:
+        return
+    index = get_index()
+    index.add(reply_message.id, getattr(bot_config, 'id', None), question, reply_message.timestamp.timestamp())
+    metrics.gauge('near_duplicate.entries', len(index))
+
+
+alookup = sync_to_async(lookup, thread_sensitive=False)
+aremember = sync_to_async(remember, thread_sensitive=False)
@@ -0,0 +1,194 @@
+"""
+Hybrid FAQ retrieval stage that sits in front of the LLM.
+
+Candidate lists from the keyword automaton, BM25, trigram and embedding
+retrievers are fused with reciprocal rank fusion (RRF). Each retriever
+reports a confidence in [0, 1] for its hits; the fused top hit's confidence
+is their noisy-OR, so agreement between independent retrievers raises it.
+The result is gated against the selected bot's thresholds:
+
+    confidence >= faq_answer_threshold  -> answer straight from the FAQ
+    confidence >= grounding_threshold   -> Gemini, grounded on the top-k FAQs
+    otherwise                           -> plain Gemini
+
+Decisions are cached per canonical query, FAQ index version and bot, so a
+repeated question, whether it matched an FAQ or not, skips retrieval.
+Every decision is counted (see metrics.py) so the thresholds can be tuned.
+"""
+from collections import namedtuple
+from functools import cached_property
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .canonical import canonicalize
+from .faq_index import FAQMatch, get_faq_index
+from .models import FAQ
+from .response_cache import TwoTierCache
+
+FAQ_ANSWER = 'faq'
+GROUNDED = 'grounded'
+LLM = 'llm'
+
+# Standard RRF damping constant (Cormack et al.)
+RRF_K = 60
+
+Candidate = namedtuple('Candidate', ['faq_id', 'rrf_score', 'confidence', 'sources'])
+
+# Final decisions, FAQ answers and "no FAQ matched" alike
+answers = TwoTierCache('retrieval.answer_cache')
+
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K):
+    """
+    Fuse {source: [ScoredFAQ, ...]} into Candidates ordered by RRF score.
+    confidence = 1 - prod(1 - c) over the sources that returned the FAQ.
+    """
+    fused = {}
+    for source, hits in ranked_lists.items():
+        for rank, hit in enumerate(hits, start=1):
+            rrf_score, miss, sources = fused.get(hit.faq_id, (0.0, 1.0, ()))
+            fused[hit.faq_id] = (rrf_score + 1.0 / (k + rank), miss * (1.0 - hit.confidence), sources + (source,))
+    candidates = [Candidate(faq_id, rrf_score, 1.0 - miss, sources)
+                  for faq_id, (rrf_score, miss, sources) in fused.items()]
+    return sorted(candidates, key=lambda c: (-c.rrf_score, -c.confidence, c.faq_id))
+
+
+def _semantic_confidence(similarity):
+    # Cosine similarities cluster well above zero; rescale the useful range to [0, 1]
+    floor = getattr(settings, 'FAQ_SEMANTIC_FLOOR', 0.5)
+    return max(0.0, min(1.0, (similarity - floor) / (1.0 - floor)))
+
+
+def retrieve(user_query, k=5, semantic_hits=None):
+    """
+    Fused, ranked FAQ candidates for user_query. semantic_hits are the index's
+    semantic_search() results for it, if the caller already has them.
+    """
+    index = get_faq_index()
+    if semantic_hits is None:
+        semantic_hits = index.semantic_search(user_query, k)
+    semantic = [hit._replace(confidence=_semantic_confidence(hit.score)) for hit in semantic_hits]
+    return reciprocal_rank_fusion({
+        'keyword': index.keyword_search(user_query, k),
+        'bm25': index.search(user_query, k),
+        'fuzzy': index.fuzzy_search(user_query, k),
+        'semantic': semantic,
+    })[:k]
+
+
+class RetrievalDecision:
+    """What to do with one message; FAQ text is only decrypted when asked for."""
+
+    def __init__(self, action, confidence, candidates):
+        self.action = action
+        self.confidence = confidence
+        self.candidates = candidates
+        self._passages = {}
+
+    @cached_property
+    def answer(self):
+        """The top FAQ's answer (for FAQ_ANSWER decisions)."""
+        return FAQMatch(self.candidates[0].faq_id, 'hybrid', self.confidence).answer
+
+    def passages(self, k=3):
+        """(question, answer) pairs of the top-k candidates, best first."""
+        if k not in self._passages:
+            ids = [candidate.faq_id for candidate in self.candidates[:k]]
+            faqs = FAQ.objects.in_bulk(ids)
+            self._passages[k] = [(faqs[faq_id].question, faqs[faq_id].answer) for faq_id in ids if faq_id in faqs]
+        return self._passages[k]
+
+    def prefetch(self):
+        """Load the answer or passages this action needs now, so async code can read them."""
+        if self.action == FAQ_ANSWER:
+            self.answer
+        elif self.action == GROUNDED:
+            self.passages()
+        return self
+
+    def to_cache(self):
+        entry = {'action': self.action, 'confidence': self.confidence}
+        if self.action == FAQ_ANSWER:
+            entry['answer'] = self.answer
+        elif self.action == GROUNDED:
+            entry['passages'] = self.passages()
+        return entry
+
+    @classmethod
+    def from_cache(cls, entry):
+        decision = cls(entry['action'], entry['confidence'], [])
+        if 'answer' in entry:
+            decision.__dict__['answer'] = entry['answer']
+        if 'passages' in entry:
+            decision._passages[3] = entry['passages']
+        return decision
+
+    def __repr__(self):
+        return f"RetrievalDecision(action={self.action!r}, confidence={self.confidence:.3f})"
+
+
+def _thresholds(bot_config):
+    if bot_config is not None:
+        return bot_config.faq_answer_threshold, bot_config.grounding_threshold
+    return (getattr(settings, 'FAQ_ANSWER_THRESHOLD', 0.75),
+            getattr(settings, 'FAQ_GROUNDING_THRESHOLD', 0.35))
+
+
+def _gate(candidates, bot_config):
+    confidence = candidates[0].confidence if candidates else 0.0
+    answer_threshold, grounding_threshold = _thresholds(bot_config)
+    if candidates and confidence >= answer_threshold:
+        action = FAQ_ANSWER
+    elif candidates and confidence >= grounding_threshold:
+        action = GROUNDED
+    else:
+        action = LLM
+    return RetrievalDecision(action, confidence, candidates)
+
+
+def _cached(user_query, bot_config):
+    """(index, cache key text, cached decision entry or None) for a message."""
+    index = get_faq_index()
+    # Any FAQ edit moves the index version and so retires every cached decision
+    cache_text = f"{index.version}\0{canonicalize(user_query)}"
+    return index, cache_text, answers.get(cache_text, bot_config)
+
+
+def _decide(user_query, bot_config, k, cache_text, entry, semantic_hits=None):
+    if entry is not None:
+        decision = RetrievalDecision.from_cache(entry)
+    else:
+        decision = _gate(retrieve(user_query, k, semantic_hits), bot_config).prefetch()
+        answers.set(cache_text, decision.to_cache(), bot_config, ttl=settings.ANSWER_CACHE_TTL)
+    action, confidence = decision.action, decision.confidence
+
+    bot_label = bot_config.pk if bot_config is not None else 'default'
+    metrics.incr(f"retrieval.decision.{action}")
+    metrics.incr(f"retrieval.decision.{action}.bot.{bot_label}")
+    # Confidence histogram in tenths, for picking thresholds
+    metrics.incr(f"retrieval.confidence.{min(int(confidence * 10), 9) / 10:.1f}")
+    return decision
+
+
+def decide(user_query, bot_config=None, k=5):
+    """
+    Run hybrid retrieval for a message and gate it on the bot's thresholds,
+    or reuse the cached decision for the same canonical query. The returned
+    decision has its answer or passages loaded.
+    """
+    _, cache_text, entry = _cached(user_query, bot_config)
+    return _decide(user_query, bot_config, k, cache_text, entry)
+
+
+async def adecide(user_query, bot_config=None, k=5):
+    """
+    decide() for async code. Nothing here needs the request's ORM thread, so
+    the sync parts run in the shared executor; on a cache miss, an embedder
+    that can embed without a thread (the remote one) is awaited in between.
+    """
+    index, cache_text, entry = await sync_to_async(_cached, thread_sensitive=False)(user_query, bot_config)
+    semantic_hits = await index.asemantic_search(user_query, k) if entry is None else None
+    return await sync_to_async(_decide, thread_sensitive=False)(user_query, bot_config, k, cache_text, entry,
+                                                                semantic_hits)
@@ -0,0 +1,138 @@
+"""
+Token-budgeted prompt assembly for Gemini.
+
+The bot's prompt template and the user's message always go in. Ranked FAQ
+passages are added best first (near-duplicates dropped), then the most
+recent session turns and then a summary of older ones, each only while the
+estimated prompt size stays within settings.LLM_PROMPT_TOKEN_BUDGET. Whatever does not fit is the least
+relevant material and is left out, so prompt size stays bounded.
+"""
+import re
+from collections import namedtuple
+
+from django.conf import settings
+
+from .retrieval import TOKEN_RE
+
+PIECE_RE = re.compile(r"\w+|[^\w\s]")
+# Containment of word 3-gram shingles above which a passage is a duplicate
+DUPLICATE_OVERLAP = 0.8
+# Don't bother including a truncated passage smaller than this
+MIN_PASSAGE_TOKENS = 32
+
+GROUNDING_HEADER = "Answer using the FAQ entries below where they are relevant."
+HISTORY_HEADER = "Conversation so far:"
+SUMMARY_HEADER = "Earlier in this conversation:"
+
+AssembledPrompt = namedtuple('AssembledPrompt', ['text', 'tokens', 'passages', 'turns'])
+
+
+def estimate_tokens(text):
+    """
+    Cheap local token estimate: a word costs one token per 4 characters
+    (rounded up), every punctuation mark one. Close to SentencePiece counts
+    for English without a tokenizer round trip.
+    """
+    return sum((len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == '_' else 1
+               for piece in PIECE_RE.findall(text or ''))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Longest prefix of text (cut at a piece boundary) within max_tokens."""
+    used = 0
+    for match in PIECE_RE.finditer(text or ''):
+        piece = match.group()
+        used += (len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == '_' else 1
+        if used > max_tokens:
+            return text[:match.start()].rstrip()
+    return text or ''
+
+
+def _shingles(text):
+    words = TOKEN_RE.findall((text or '').lower())
+    if len(words) < 3:
+        return {tuple(words)}
+    return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def dedupe_passages(passages):
+    """Drop (question, answer) passages largely contained in a better-ranked one."""
+    kept, kept_shingles = [], []
+    for question, answer in passages:
+        shingles = _shingles(f"{question} {answer}")
+        if any(len(shingles & other) >= DUPLICATE_OVERLAP * min(len(shingles), len(other))
+               for other in kept_shingles):
+            continue
+        kept.append((question, answer))
+        kept_shingles.append(shingles)
+    return kept
+
+
+def _format_passage(question, answer):
+    return f"Q: {question}\nA: {answer}"
+
+
+def _format_turn(sender, content):
+    return f"{'User' if sender == 'user' else 'Assistant'}: {content}"
+
+
+def assemble_prompt(user_message, passages=(), prompt_template=None, history=(), budget=None, summary=''):
+    """
+    Build the Gemini prompt.
+
+    passages: [(question, answer), ...] best first.
+    history: [(sender, content), ...] oldest first, excluding user_message.
+    summary: notes on the turns before history, included whole or not at all.
+    Returns an AssembledPrompt with the text, its estimated token count and
+    how many passages and turns made it in.
+    """
+    budget = budget or getattr(settings, 'LLM_PROMPT_TOKEN_BUDGET', 2048)
+    template = (prompt_template or '').strip()
+    # Section separators ("\n\n") are whitespace and cost no tokens
+    remaining = budget - estimate_tokens(template) - estimate_tokens("User:")
+    message = truncate_to_tokens(user_message, max(remaining, 0))
+    remaining -= estimate_tokens(message)
+
+    included_passages = []
+    header_cost = estimate_tokens(GROUNDING_HEADER)
+    for question, answer in dedupe_passages(passages or ()):
+        cost = estimate_tokens(_format_passage(question, answer))
+        available = remaining - (0 if included_passages else header_cost)
+        if cost > available:
+            # The most relevant passage left gets whatever room remains
+            if available >= MIN_PASSAGE_TOKENS:
+                answer = truncate_to_tokens(answer, available - estimate_tokens(_format_passage(question, '')))
+                included_passages.append(_format_passage(question, answer))
+                remaining = available - estimate_tokens(included_passages[-1])
+            break
+        included_passages.append(_format_passage(question, answer))
+        remaining = available - cost
+
+    included_turns = []
+    header_cost = estimate_tokens(HISTORY_HEADER)
+    for sender, content in reversed(list(history or ())):
+        turn = _format_turn(sender, content)
+        cost = estimate_tokens(turn) + (0 if included_turns else header_cost)
+        if cost > remaining:
+            break
+        included_turns.append(turn)
+        remaining -= cost
+    included_turns.reverse()
+
+    summary = (summary or '').strip()
+    # Only worth having if it adjoins the turns that made it in
+    if len(included_turns) < len(history or ()) or \
+            estimate_tokens(summary) + estimate_tokens(SUMMARY_HEADER) > remaining:
+        summary = ''
+
+    sections = [template] if template else []
+    if included_passages:
+        sections.append("\n\n".join([GROUNDING_HEADER] + included_passages))
+    if summary:
+        sections.append(f"{SUMMARY_HEADER}\n{summary}")
+    if included_turns:
+        sections.append("\n".join([HISTORY_HEADER] + included_turns))
+    # A bare message is sent as-is, like before templates/context existed
+    sections.append(f"User: {message}" if sections else message)
+    text = "\n\n".join(sections)
+    return AssembledPrompt(text, estimate_tokens(text), len(included_passages), len(included_turns))
@@ -0,0 +1,83 @@
+"""
+Deletes the chat history that data_keys.shred() detached from its users.
+
+Messages go first, HISTORY_PURGE_BATCH_SIZE at a time, each batch in its
+own short transaction and followed by a HISTORY_PURGE_SLEEP pause, so the
+SQLite write lock is never held for long; then the emptied sessions, then the
+shredded DataKey rows. The rows are unreadable from the moment they are
+shredded, so nothing depends on how soon this runs.
+
+schedule() runs a purge in a daemon thread of this worker (at most one at a
+time, run again if asked meanwhile); `manage.py purge_deleted_history` runs
+one in the foreground, e.g. from cron.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import metrics
+from .models import ChatMessage, ChatSession, DataKey
+
+
+def _delete_in_batches(queryset, batch_size, sleep):
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            queryset.model.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+        if sleep:
+            time.sleep(sleep)
+
+
+def purge(batch_size=None, sleep=None):
+    """Delete detached sessions, their messages and shredded keys; returns (messages, sessions) deleted."""
+    batch_size = batch_size or settings.HISTORY_PURGE_BATCH_SIZE
+    sleep = settings.HISTORY_PURGE_SLEEP if sleep is None else sleep
+    messages = _delete_in_batches(ChatMessage.objects.filter(session__user_profile__isnull=True), batch_size, sleep)
+    sessions = _delete_in_batches(ChatSession.objects.filter(user_profile__isnull=True), batch_size, sleep)
+    # A key shredded meanwhile may go too; an unknown key reads as shredded
+    if not ChatSession.objects.filter(user_profile__isnull=True).exists():
+        DataKey.objects.filter(shredded_at__isnull=False).delete()
+    metrics.incr('purge.messages', messages)
+    metrics.incr('purge.sessions', sessions)
+    return messages, sessions
+
+
+_state_lock = threading.Lock()
+_running = False
+_requested = False
+
+
+def _run():
+    global _running, _requested
+    try:
+        while True:
+            try:
+                purge()
+            except Exception as e:
+                print(f"Error purging deleted chat history: {e}")
+            with _state_lock:
+                if not _requested:
+                    _running = False
+                    return
+                _requested = False
+    finally:
+        connection.close()
+
+
+def schedule():
+    """Purge in a background thread, unless HISTORY_PURGE_IN_BACKGROUND is off (then leave it to the command)."""
+    global _running, _requested
+    if not settings.HISTORY_PURGE_IN_BACKGROUND:
+        return
+    with _state_lock:
+        if _running:
+            _requested = True
+            return
+        _running = True
+    threading.Thread(target=_run, name='history-purge', daemon=True).start()
@@ -0,0 +1,174 @@
+"""
+Two-tier cache for bot replies.
+
+A small in-process LRU sits in front of the shared Django cache
+(settings.RESPONSE_CACHE_ALIAS), so hot entries cost no round trip while
+every worker still sees what any other worker cached. Local copies live at
+most RESPONSE_CACHE_LOCAL_TTL seconds, since the shared entry may expire or
+be replaced first. Keys are fixed-length SHA-256 digests of (namespace, bot
+id, text), whatever the length of the prompt. Each value is stored with the bot's version (a digest of its prompt
+template and retrieval thresholds): after those change, older entries no
+longer match and are treated as misses, in every worker, without having to
+find and delete them.
+Saving a bot also drops its entries from the saving worker's LRU.
+
+Stats are exported as <namespace>.{local_hit,shared_hit,miss,stale,evicted,
+invalidated} counters (see metrics.snapshot).
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+MISSING = object()
+
+_instances = []
+
+
+def bot_version(bot_config):
+    """Digest of the bot settings cached replies depend on (prompt template, retrieval thresholds)."""
+    parts = [getattr(bot_config, name, None) for name in
+             ('prompt_template', 'faq_answer_threshold', 'grounding_threshold')]
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def bot_ttl(bot_config):
+    """The bot's response_cache_ttl, else settings.RESPONSE_CACHE_TTL."""
+    ttl = getattr(bot_config, 'response_cache_ttl', None)
+    return ttl if ttl is not None else settings.RESPONSE_CACHE_TTL
+
+
+class TwoTierCache:
+    def __init__(self, namespace, local_size=None):
+        self.namespace = namespace
+        self._local_size = local_size
+        self._local = OrderedDict()  # key -> (expires_at, bot_id, version, value)
+        self._lock = threading.Lock()
+        _instances.append(self)
+
+    @property
+    def local_size(self):
+        return self._local_size if self._local_size is not None else settings.RESPONSE_CACHE_LOCAL_SIZE
+
+    @property
+    def shared(self):
+        return caches[settings.RESPONSE_CACHE_ALIAS]
+
+    def key(self, text, bot_config=None):
+        bot_id = getattr(bot_config, 'id', None)
+        digest = hashlib.sha256(f'{self.namespace}\0{bot_id}\0{text}'.encode('utf-8')).hexdigest()
+        return f'{self.namespace}:{digest}'
+
+    def _count(self, stat):
+        metrics.incr(f'{self.namespace}.{stat}')
+
+    # Local tier
+
+    def _local_get(self, key, version):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, _, entry_version, value = entry
+            if expires_at <= time.monotonic() or entry_version != version:
+                del self._local[key]
+                return MISSING
+            self._local.move_to_end(key)
+            return value
+
+    def _local_set(self, key, bot_id, version, value, ttl):
+        evicted = 0
+        with self._lock:
+            self._local[key] = (time.monotonic() + ttl, bot_id, version, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.incr(f'{self.namespace}.evicted', evicted)
+
+    def invalidate_bot(self, bot_id):
+        """Drop bot_id's entries from this worker's LRU."""
+        with self._lock:
+            keys = [key for key, entry in self._local.items() if entry[1] == bot_id]
+            for key in keys:
+                del self._local[key]
+        self._count('invalidated')
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+
+    # Lookups
+
+    def _unpack(self, stored, version):
+        """Value of a shared-tier entry, or MISSING if absent or from an older bot version."""
+        if stored is None:
+            return MISSING
+        stored_version, value = stored
+        if stored_version != version:
+            self._count('stale')
+            return MISSING
+        return value
+
+    def get(self, text, bot_config=None, default=None):
+        key, version = self.key(text, bot_config), bot_version(bot_config)
+        value = self._local_get(key, version)
+        if value is not MISSING:
+            self._count('local_hit')
+            return value
+        value = self._unpack(self.shared.get(key), version)
+        if value is MISSING:
+            self._count('miss')
+            return default
+        self._count('shared_hit')
+        self._local_set(key, getattr(bot_config, 'id', None), version, value, settings.RESPONSE_CACHE_LOCAL_TTL)
+        return value
+
+    def set(self, text, value, bot_config=None, ttl=None):
+        """Store value for ttl seconds (default: the bot's reply cache TTL, see bot_ttl); 0 stores nothing."""
+        ttl = ttl if ttl is not None else bot_ttl(bot_config)
+        if ttl <= 0:
+            return
+        key, version = self.key(text, bot_config), bot_version(bot_config)
+        self.shared.set(key, (version, value), timeout=ttl)
+        self._local_set(key, getattr(bot_config, 'id', None), version, value, min(ttl, settings.RESPONSE_CACHE_LOCAL_TTL))
+
+    async def aget(self, text, bot_config=None, default=None):
+        key, version = self.key(text, bot_config), bot_version(bot_config)
+        count = sync_to_async(self._count, thread_sensitive=False)
+        value = self._local_get(key, version)
+        if value is not MISSING:
+            await count('local_hit')
+            return value
+        value = self._unpack(await self.shared.aget(key), version)
+        if value is MISSING:
+            await count('miss')
+            return default
+        await count('shared_hit')
+        self._local_set(key, getattr(bot_config, 'id', None), version, value, settings.RESPONSE_CACHE_LOCAL_TTL)
+        return value
+
+    async def aset(self, text, value, bot_config=None, ttl=None):
+        ttl = ttl if ttl is not None else bot_ttl(bot_config)
+        if ttl <= 0:
+            return
+        key, version = self.key(text, bot_config), bot_version(bot_config)
+        await self.shared.aset(key, (version, value), timeout=ttl)
+        self._local_set(key, getattr(bot_config, 'id', None), version, value, min(ttl, settings.RESPONSE_CACHE_LOCAL_TTL))
+
+
+# Gemini replies, keyed by the assembled prompt
+responses = TwoTierCache('llm.response')
+
+
+def invalidate_bot(bot_id):
+    """Drop bot_id's entries from every two-tier cache's LRU in this worker."""
+    for instance in _instances:
+        instance.invalidate_bot(bot_id)
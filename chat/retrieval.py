@@ -0,0 +1,185 @@
+"""
+Ranked lexical retrieval (BM25) over FAQ text.
+
+Term weights are precomputed into a term-major sparse matrix (CSR arrays in
+NumPy), so scoring a batch of queries against every FAQ is one sparse
+matrix product instead of a Python loop per row.
+"""
+import re
+from collections import Counter, namedtuple
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+")
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can could do does for from has have how i if in
+into is it its me my of on or our so that the their them there these they this
+to was we were what when where which who why will with would you your
+""".split())
+
+# Upper bound on the dense (queries x FAQs) score block scored at once
+MAX_BLOCK_CELLS = 4_000_000
+
+ScoredFAQ = namedtuple('ScoredFAQ', ['faq_id', 'score', 'confidence'])
+
+
+def tokenize(text):
+    """Lowercase word tokens with stopwords removed."""
+    return [tok for tok in TOKEN_RE.findall((text or '').lower()) if tok not in STOPWORDS]
+
+
+def _postings(vocabulary, term_counts, first_doc=0):
+    """(term ids, doc columns, tf) triples for Counters, extending vocabulary in place."""
+    terms, docs, tfs = [], [], []
+    for d, counts in enumerate(term_counts, start=first_doc):
+        for term, tf in counts.items():
+            terms.append(vocabulary.setdefault(term, len(vocabulary)))
+            docs.append(d)
+            tfs.append(tf)
+    return (np.asarray(terms, dtype=np.int64), np.asarray(docs, dtype=np.int32),
+            np.asarray(tfs, dtype=np.float32))
+
+
+class BM25Index:
+    """
+    Immutable BM25 index; rows are terms, columns are documents.
+
+    Raw term frequencies are kept as term-major CSR arrays (indptr, indices,
+    tf) so the index can be persisted, memory-mapped back and patched row by
+    row; BM25 weights are derived from them with a few vectorized passes.
+    """
+
+    def __init__(self, doc_ids, vocabulary, indptr, indices, tf, k1=1.5, b=0.75):
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.indices = indices
+        self.tf = tf
+        self.k1 = k1
+        self.b = b
+        n_docs = len(self.doc_ids)
+
+        df = np.diff(indptr)
+        self.idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        # idf of a term no FAQ contains; still counts against a query's confidence
+        self.unseen_idf = float(np.log1p((n_docs + 0.5) / 0.5))
+
+        doc_len = np.bincount(indices, weights=tf, minlength=n_docs)
+        avgdl = float(doc_len.mean()) if n_docs and doc_len.any() else 1.0
+        terms = np.repeat(np.arange(len(df)), df)
+        norm = k1 * (1 - b + b * doc_len[indices] / avgdl)
+        self.data = (self.idf[terms] * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+    @classmethod
+    def _from_postings(cls, doc_ids, vocabulary, terms, docs, tf, **kwargs):
+        order = np.lexsort((docs, terms))
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocabulary)), out=indptr[1:])
+        return cls(doc_ids, vocabulary, indptr, docs[order], tf[order], **kwargs)
+
+    @classmethod
+    def from_term_counts(cls, doc_ids, term_counts, **kwargs):
+        """Build from one Counter of tokens per document (see tokenize)."""
+        vocabulary = {}
+        terms, docs, tf = _postings(vocabulary, term_counts)
+        return cls._from_postings(doc_ids, vocabulary, terms, docs, tf, **kwargs)
+
+    @classmethod
+    def from_documents(cls, doc_ids, documents, **kwargs):
+        return cls.from_term_counts(doc_ids, [Counter(tokenize(text)) for text in documents], **kwargs)
+
+    def with_changes(self, removed_ids, added_ids, added_term_counts):
+        """New index without removed_ids and with the added documents appended."""
+        drop = np.isin(self.doc_ids, np.asarray(list(removed_ids) + list(added_ids), dtype=np.int64))
+        keep_columns = np.flatnonzero(~drop)
+        # Old column -> new column (-1 for dropped documents)
+        remap = np.full(len(self.doc_ids), -1, dtype=np.int64)
+        remap[keep_columns] = np.arange(len(keep_columns))
+
+        terms = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+        docs = remap[self.indices]
+        kept = docs >= 0
+        vocabulary = dict(self.vocabulary)
+        new_terms, new_docs, new_tf = _postings(vocabulary, added_term_counts, first_doc=len(keep_columns))
+        return self._from_postings(
+            np.concatenate([self.doc_ids[keep_columns], np.asarray(added_ids, dtype=np.int64)]),
+            vocabulary,
+            np.concatenate([terms[kept], new_terms]),
+            np.concatenate([docs[kept].astype(np.int32), new_docs]),
+            np.concatenate([np.asarray(self.tf)[kept], new_tf]),
+            k1=self.k1, b=self.b,
+        )
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _vectorize(self, query):
+        """Return (term ids, query term counts, reference score).
+
+        The reference score is what a FAQ of average length containing each
+        query term once would get; confidence is the score relative to it.
+        """
+        counts = Counter(tokenize(query))
+        ids, qtf = [], []
+        reference = 0.0
+        for term, count in counts.items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                reference += count * self.unseen_idf
+                continue
+            ids.append(term_id)
+            qtf.append(count)
+            reference += count * float(self.idf[term_id])
+        return ids, qtf, reference
+
+    def _score_block(self, vectors):
+        """Dense (len(vectors) x n_docs) BM25 scores via one sparse product."""
+        n_docs = len(self.doc_ids)
+        q_rows, term_ids, q_weights = [], [], []
+        for row, (ids, qtf, _) in enumerate(vectors):
+            q_rows.extend([row] * len(ids))
+            term_ids.extend(ids)
+            q_weights.extend(qtf)
+        scores = np.zeros(len(vectors) * n_docs, dtype=np.float32)
+        if term_ids:
+            term_ids = np.asarray(term_ids, dtype=np.int64)
+            starts = self.indptr[term_ids]
+            lengths = self.indptr[term_ids + 1] - starts
+            # Gather every posting of every (query, term) pair in one shot
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            rows = np.repeat(np.asarray(q_rows, dtype=np.int64), lengths)
+            values = self.data[offsets] * np.repeat(np.asarray(q_weights, dtype=np.float32), lengths)
+            scores += np.bincount(rows * n_docs + self.indices[offsets], weights=values,
+                                  minlength=len(vectors) * n_docs).astype(np.float32)
+        return scores.reshape(len(vectors), n_docs)
+
+    def search_batch(self, queries, k=5):
+        """Top-k ScoredFAQ lists for many queries at once."""
+        vectors = [self._vectorize(query) for query in queries]
+        n_docs = len(self.doc_ids)
+        if not n_docs:
+            return [[] for _ in vectors]
+        k = min(k, n_docs)
+        block = max(1, MAX_BLOCK_CELLS // n_docs)
+        results = []
+        for start in range(0, len(vectors), block):
+            chunk = vectors[start:start + block]
+            scores = self._score_block(chunk)
+            if k < n_docs:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(n_docs), scores.shape)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            for (_, _, reference), cols, row_scores in zip(chunk, top, top_scores):
+                results.append([
+                    ScoredFAQ(int(self.doc_ids[col]), float(score), min(1.0, float(score) / reference))
+                    for col, score in zip(cols, row_scores) if score > 0
+                ])
+        return results
+
+    def search(self, query, k=5):
+        return self.search_batch([query], k)[0]
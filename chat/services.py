@@ -1,28 +1,255 @@
-import google.generativeai as genai
-import os
+import time
+from asgiref.sync import sync_to_async
 from dotenv import load_dotenv
-from django.core.cache import cache
+from django.conf import settings
+from . import llm, metrics
+from .dispatch import LLMUnavailable, get_dispatcher
+from .faq_index import FAQMatch
+from .pipeline import retrieve
+from .prompting import assemble_prompt
+from .response_cache import bot_ttl, responses
+from .singleflight import SingleFlight, flight_key
 
 load_dotenv() # Load environment variables from .env
 
-def get_gemini_response(prompt, bot_config=None):
+ERROR_REPLY = "I'm sorry, I'm having trouble connecting to Gemini right now."
+
+class StreamInterrupted(Exception):
+    """Generation failed after part of a streamed reply was yielded; the part is not a reply."""
+
+class Reply(str):
+    """
+    Reply text that says where it came from: generated is True for a
+    completed Gemini generation (or its cached copy), the only kind of reply
+    worth reusing, and False for fallback FAQ answers and ERROR_REPLY.
+    """
+    generated = False
+
+def _generated(text):
+    reply = Reply(text)
+    reply.generated = True
+    return reply
+
+def join_reply(parts):
+    """The full Reply from streamed pieces: generated only if every piece was."""
+    reply = Reply(''.join(parts))
+    reply.generated = bool(parts) and all(getattr(part, 'generated', False) for part in parts)
+    return reply
+
+# Identical prompts already in flight (here or in another worker) share one Gemini call
+llm_calls = SingleFlight('llm.singleflight')
+
+def _prepare(prompt, bot_config, passages, history):
+    return assemble_prompt(prompt, passages=passages, history=history,
+                           summary=getattr(history, 'summary', ''),
+                           prompt_template=getattr(bot_config, 'prompt_template', None))
+
+def _flight_key(assembled, bot_config):
+    return flight_key(assembled.text, getattr(bot_config, 'id', None))
+
+def _caches_replies(bot_config):
+    # A bot with response_cache_ttl 0 stores no replies, so other workers have nothing to find
+    return bot_ttl(bot_config) > 0
+
+def fallback_reply(prompt, passages=None):
+    """
+    Best-effort FAQ answer for when the dispatcher turns a call away (breaker
+    open, queue full or timed out): the top grounding passage, else the best
+    FAQ retrieval finds at any confidence, else ERROR_REPLY.
+    """
+    metrics.incr('llm.fallback')
+    if passages:
+        return Reply(passages[0][1])
     try:
-        # Use a cache key unique to the prompt & bot config
-        cache_key = f"gemini_response::{prompt}::{getattr(bot_config, 'id', None) if bot_config else 'default'}"
-        cached_response = cache.get(cache_key)
+        candidates = retrieve(prompt, k=1)
+        if candidates:
+            return Reply(FAQMatch(candidates[0].faq_id, 'hybrid', candidates[0].confidence).answer)
+    except Exception as e:
+        print(f"Error finding fallback FAQ answer: {e}")
+    return Reply(ERROR_REPLY)
+
+def get_gemini_response(prompt, bot_config=None, passages=None, history=None, model=None):
+    """
+    passages: optional [(question, answer), ...] FAQ context to ground the reply on, best first.
+    history: optional [(sender, content), ...] earlier turns of the session, oldest first
+             (a memory.History also carries a summary of the turns before those).
+    model: shared model from llm.get_model() (default model and settings if omitted).
+    Returns a Reply.
+    """
+    try:
+        assembled = _prepare(prompt, bot_config, passages, history)
+        cached_response = responses.get(assembled.text, bot_config)
         if cached_response:
-            return cached_response
-
-        genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
-        model = genai.GenerativeModel('gemini-pro-latest')
-        if bot_config and getattr(bot_config, 'prompt_template', None):
-            full_prompt = f"{bot_config.prompt_template}\n\nUser: {prompt}"
-        else:
-            full_prompt = prompt
-        response = model.generate_content(full_prompt)
-        answer = response.text
-        cache.set(cache_key, answer, timeout=60*5)  # Cache for 5 minutes
-        return answer
+            return _generated(cached_response)
+
+        model = model or llm.get_model()
+
+        dispatcher = get_dispatcher()
+
+        def generate():
+            with dispatcher.slot(getattr(bot_config, 'id', None)):
+                started = time.perf_counter()
+                answer = dispatcher.retry(lambda: model.generate_content(assembled.text).text)
+                record_llm_call(assembled, time.perf_counter() - started, bot_config)
+            responses.set(assembled.text, answer, bot_config)
+            return answer
+
+        lookup = (lambda: responses.get(assembled.text, bot_config)) if _caches_replies(bot_config) else None
+        return _generated(llm_calls.do(_flight_key(assembled, bot_config), generate, lookup))
+    except LLMUnavailable as e:
+        print(f"Gemini unavailable, answering from the FAQ: {e}")
+        return fallback_reply(prompt, passages)
     except Exception as e:
         print(f"Error getting Gemini response: {e}")
-        return "I'm sorry, I'm having trouble connecting to Gemini right now."
+        return Reply(ERROR_REPLY)
+
+def stream_gemini_response(prompt, bot_config=None, passages=None, history=None, model=None):
+    """
+    Like get_gemini_response, but yields the reply in pieces as Gemini
+    generates them. join_reply(pieces) is the full Reply; if
+    generation fails after some were yielded, StreamInterrupted is raised
+    and callers should neither save nor cache what they got. Callers asking
+    for a prompt already being generated share that generation (llm_calls)
+    and get its reply in one piece when it is done.
+    """
+    parts = []
+    try:
+        assembled = _prepare(prompt, bot_config, passages, history)
+        cached_response = responses.get(assembled.text, bot_config)
+        if cached_response:
+            yield _generated(cached_response)
+            return
+
+        model = model or llm.get_model()
+        dispatcher = get_dispatcher()
+
+        def generate():
+            streamed = []
+            # The slot is held until the last chunk; only opening the stream is retried
+            with dispatcher.slot(getattr(bot_config, 'id', None)):
+                started = time.perf_counter()
+                first_token = None
+                for chunk in dispatcher.retry(lambda: model.generate_content(assembled.text, stream=True)):
+                    text = chunk.text
+                    if not text:
+                        continue
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    streamed.append(text)
+                    yield text
+                record_llm_call(assembled, time.perf_counter() - started, bot_config, first_token)
+            responses.set(assembled.text, ''.join(streamed), bot_config)
+
+        lookup = (lambda: responses.get(assembled.text, bot_config)) if _caches_replies(bot_config) else None
+        for text in llm_calls.stream(_flight_key(assembled, bot_config), generate, lookup):
+            parts.append(text)
+            yield _generated(text)
+    except LLMUnavailable as e:
+        print(f"Gemini unavailable, answering from the FAQ: {e}")
+        yield fallback_reply(prompt, passages)
+    except Exception as e:
+        print(f"Error streaming Gemini response: {e}")
+        if parts:
+            raise StreamInterrupted(str(e)) from e
+        yield Reply(ERROR_REPLY)
+
+async def aget_gemini_response(prompt, bot_config=None, passages=None, history=None, model=None):
+    """get_gemini_response for async callers, using Gemini's async API."""
+    try:
+        assembled = _prepare(prompt, bot_config, passages, history)
+        cached_response = await responses.aget(assembled.text, bot_config)
+        if cached_response:
+            return _generated(cached_response)
+
+        model = model or llm.get_model()
+
+        dispatcher = get_dispatcher()
+
+        async def attempt():
+            return (await model.generate_content_async(assembled.text)).text
+
+        async def generate():
+            async with dispatcher.aslot(getattr(bot_config, 'id', None)):
+                started = time.perf_counter()
+                answer = await dispatcher.aretry(attempt)
+                await sync_to_async(record_llm_call, thread_sensitive=False)(
+                    assembled, time.perf_counter() - started, bot_config)
+            await responses.aset(assembled.text, answer, bot_config)
+            return answer
+
+        lookup = (lambda: responses.aget(assembled.text, bot_config)) if _caches_replies(bot_config) else None
+        return _generated(await llm_calls.ado(_flight_key(assembled, bot_config), generate, lookup))
+    except LLMUnavailable as e:
+        print(f"Gemini unavailable, answering from the FAQ: {e}")
+        return await sync_to_async(fallback_reply)(prompt, passages)
+    except Exception as e:
+        print(f"Error getting Gemini response: {e}")
+        return Reply(ERROR_REPLY)
+
+async def astream_gemini_response(prompt, bot_config=None, passages=None, history=None, model=None):
+    """
+    Async stream_gemini_response: awaits Gemini's async API, so a worker can
+    hold many slow generations open without a thread each. Cancelling the
+    consuming task closes the underlying stream.
+    """
+    parts = []
+    try:
+        assembled = _prepare(prompt, bot_config, passages, history)
+        cached_response = await responses.aget(assembled.text, bot_config)
+        if cached_response:
+            yield _generated(cached_response)
+            return
+
+        model = model or llm.get_model()
+        dispatcher = get_dispatcher()
+
+        async def generate():
+            streamed = []
+            async with dispatcher.aslot(getattr(bot_config, 'id', None)):
+                started = time.perf_counter()
+                first_token = None
+                response = await dispatcher.aretry(
+                    lambda: model.generate_content_async(assembled.text, stream=True))
+                async for chunk in response:
+                    text = chunk.text
+                    if not text:
+                        continue
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    streamed.append(text)
+                    yield text
+                await sync_to_async(record_llm_call, thread_sensitive=False)(
+                    assembled, time.perf_counter() - started, bot_config, first_token)
+            await responses.aset(assembled.text, ''.join(streamed), bot_config)
+
+        lookup = (lambda: responses.aget(assembled.text, bot_config)) if _caches_replies(bot_config) else None
+        async for text in llm_calls.astream(_flight_key(assembled, bot_config), generate, lookup):
+            parts.append(text)
+            yield _generated(text)
+    except LLMUnavailable as e:
+        print(f"Gemini unavailable, answering from the FAQ: {e}")
+        yield await sync_to_async(fallback_reply)(prompt, passages)
+    except Exception as e:
+        print(f"Error streaming Gemini response: {e}")
+        if parts:
+            raise StreamInterrupted(str(e)) from e
+        yield Reply(ERROR_REPLY)
+
+def record_llm_call(assembled, seconds, bot_config=None, first_token_seconds=None):
+    """Track prompt size next to LLM latency and time to first token (see metrics.percentiles)."""
+    latency_ms = seconds * 1000
+    ttft_ms = first_token_seconds * 1000 if first_token_seconds is not None else None
+    metrics.observe('llm.prompt_tokens', assembled.tokens)
+    metrics.observe('llm.latency_ms', latency_ms)
+    if ttft_ms is not None:
+        metrics.observe('llm.ttft_ms', ttft_ms)
+    metrics.log_event('llm.calls', {
+        'bot': getattr(bot_config, 'id', None),
+        'prompt_tokens': assembled.tokens,
+        'latency_ms': round(latency_ms, 1),
+        'ttft_ms': round(ttft_ms, 1) if ttft_ms is not None else None,
+        'passages': assembled.passages,
+        'turns': assembled.turns,
+        # Prompts contain decrypted FAQ and chat text; only keep them when asked to
+        'prompt': assembled.text if getattr(settings, 'LLM_RECORD_PROMPTS', False) else None,
+    })
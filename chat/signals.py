@@ -0,0 +1,23 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import BotConfiguration, FAQ
+from .faq_index import publish_faq_change
+from .response_cache import invalidate_bot
+
+
+@receiver(post_save, sender=FAQ)
+@receiver(post_delete, sender=FAQ)
+def faq_changed(sender, instance, **kwargs):
+    # FAQ writes come from the training views and the Django admin alike;
+    # publish once committed so other workers never read an uncommitted row
+    faq_id = instance.pk
+    transaction.on_commit(lambda: publish_faq_change(faq_id))
+
+
+@receiver(post_save, sender=BotConfiguration)
+@receiver(post_delete, sender=BotConfiguration)
+def bot_changed(sender, instance, **kwargs):
+    # Other workers skip the old replies by template version (see response_cache.py)
+    invalidate_bot(instance.pk)
@@ -0,0 +1,306 @@
+"""
+Single-flight: concurrent callers asking for the same key share one call.
+
+Within a process, the first caller for a key (the leader) runs the call and
+every caller arriving while it is in flight (threads and asyncio tasks
+alike) waits on the leader's future instead of starting its own. Across
+processes, leaders take a lock in the shared cache; a leader that finds the
+lock taken polls the caller's result lookup (normally the response cache)
+until the other process has stored the result, and only runs the call itself
+if that never happens within LOCK_WAIT seconds.
+
+stream() and astream() do the same for generators: the leader's caller gets
+the items as they are produced, followers get them all once it finishes.
+
+Counters (see metrics.snapshot): <name>.leader for calls actually made,
+<name>.coalesced for callers that shared an in-process call and
+<name>.coalesced_remote for results picked up from another process.
+"""
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import aclosing, closing
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from . import metrics
+
+LOCK_KEY = 'singleflight:{}:{}'
+# Longest a call may hold the cross-process lock (a crashed leader's lock expires)
+LOCK_TIMEOUT = 60
+# How long to wait on another process's call before making our own
+LOCK_WAIT = 30
+POLL_INTERVAL = 0.05
+
+_SPACE_RE = re.compile(r'\s+')
+
+
+def flight_key(text, bot_id=None):
+    """Digest of the case- and whitespace-normalised text plus bot id."""
+    normalized = _SPACE_RE.sub(' ', text).strip().casefold()
+    return hashlib.sha256(f'{bot_id}\0{normalized}'.encode('utf-8')).hexdigest()
+
+
+class LeaderGone(Exception):
+    """The leader was cancelled before finishing; its followers try again."""
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _join(self, key):
+        """(future, is_leader) for key."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, lookup=None):
+        """
+        fn() once for all concurrent callers of key. lookup() returns the
+        result if another process has already stored it (else None); without
+        it there is no cross-process coordination.
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            metrics.incr(f'{self.name}.coalesced')
+            try:
+                return future.result()
+            except LeaderGone:
+                continue
+        try:
+            result = self._lead(key, fn, lookup)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(key, future, error=LeaderGone())
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def ado(self, key, fn, lookup=None):
+        """do() for coroutine functions: fn() and lookup() are awaited."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            await sync_to_async(metrics.incr, thread_sensitive=False)(f'{self.name}.coalesced')
+            try:
+                # shield: a cancelled follower must not cancel the leader's future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except LeaderGone:
+                continue
+        try:
+            result = await self._alead(key, fn, lookup)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(key, future, error=LeaderGone())
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def stream(self, key, fn, lookup=None):
+        """
+        do() for generator functions: the leader yields fn()'s items as they
+        come; followers get all of them at once when the leader finishes, and
+        a result another process stored comes as lookup()'s value alone.
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            metrics.incr(f'{self.name}.coalesced')
+            try:
+                items = future.result()
+            except LeaderGone:
+                continue
+            yield from items
+            return
+        items = []
+        try:
+            # Closed right away if our caller stops early, so the lock and fn()'s resources are let go
+            with closing(self._lead_stream(key, fn, lookup)) as stream:
+                for item in stream:
+                    items.append(item)
+                    yield item
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            # Also the caller closing the stream early
+            self._finish(key, future, error=LeaderGone())
+            raise
+        self._finish(key, future, items)
+
+    async def astream(self, key, fn, lookup=None):
+        """stream() for async generator functions; lookup() is awaited."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            await sync_to_async(metrics.incr, thread_sensitive=False)(f'{self.name}.coalesced')
+            try:
+                items = await asyncio.shield(asyncio.wrap_future(future))
+            except LeaderGone:
+                continue
+            for item in items:
+                yield item
+            return
+        items = []
+        try:
+            async with aclosing(self._alead_stream(key, fn, lookup)) as stream:
+                async for item in stream:
+                    items.append(item)
+                    yield item
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(key, future, error=LeaderGone())
+            raise
+        self._finish(key, future, items)
+
+    def _wait_turn(self, lock_key, lookup):
+        """
+        (result, locked): the result another process stored while we waited
+        for its lock, else whether we now hold the lock (False once LOCK_WAIT
+        is over; the call is then made without it).
+        """
+        if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+            return None, True
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            result = lookup()
+            if result is not None:
+                return result, False
+            if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+                # The previous holder may have stored the result just before we got the lock
+                try:
+                    result = lookup()
+                except BaseException:
+                    cache.delete(lock_key)
+                    raise
+                if result is not None:
+                    cache.delete(lock_key)
+                    return result, False
+                return None, True
+        return None, False
+
+    async def _await_turn(self, lock_key, lookup):
+        if await cache.aadd(lock_key, 1, timeout=LOCK_TIMEOUT):
+            return None, True
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+            result = await lookup()
+            if result is not None:
+                return result, False
+            if await cache.aadd(lock_key, 1, timeout=LOCK_TIMEOUT):
+                try:
+                    result = await lookup()
+                except BaseException:
+                    await cache.adelete(lock_key)
+                    raise
+                if result is not None:
+                    await cache.adelete(lock_key)
+                    return result, False
+                return None, True
+        return None, False
+
+    def _lead(self, key, fn, lookup):
+        if lookup is None:
+            metrics.incr(f'{self.name}.leader')
+            return fn()
+        lock_key = LOCK_KEY.format(self.name, key)
+        result, locked = self._wait_turn(lock_key, lookup)
+        if result is not None:
+            metrics.incr(f'{self.name}.coalesced_remote')
+            return result
+        try:
+            metrics.incr(f'{self.name}.leader')
+            return fn()
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+    async def _alead(self, key, fn, lookup):
+        incr = sync_to_async(metrics.incr, thread_sensitive=False)
+        if lookup is None:
+            await incr(f'{self.name}.leader')
+            return await fn()
+        lock_key = LOCK_KEY.format(self.name, key)
+        result, locked = await self._await_turn(lock_key, lookup)
+        if result is not None:
+            await incr(f'{self.name}.coalesced_remote')
+            return result
+        try:
+            await incr(f'{self.name}.leader')
+            return await fn()
+        finally:
+            if locked:
+                await cache.adelete(lock_key)
+
+    def _lead_stream(self, key, fn, lookup):
+        if lookup is None:
+            metrics.incr(f'{self.name}.leader')
+            yield from fn()
+            return
+        lock_key = LOCK_KEY.format(self.name, key)
+        result, locked = self._wait_turn(lock_key, lookup)
+        if result is not None:
+            metrics.incr(f'{self.name}.coalesced_remote')
+            yield result
+            return
+        try:
+            metrics.incr(f'{self.name}.leader')
+            yield from fn()
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+    async def _alead_stream(self, key, fn, lookup):
+        incr = sync_to_async(metrics.incr, thread_sensitive=False)
+        if lookup is None:
+            await incr(f'{self.name}.leader')
+            async with aclosing(fn()) as stream:
+                async for item in stream:
+                    yield item
+            return
+        lock_key = LOCK_KEY.format(self.name, key)
+        result, locked = await self._await_turn(lock_key, lookup)
+        if result is not None:
+            await incr(f'{self.name}.coalesced_remote')
+            yield result
+            return
+        try:
+            await incr(f'{self.name}.leader')
+            async with aclosing(fn()) as stream:
+                async for item in stream:
+                    yield item
+        finally:
+            if locked:
+                await cache.adelete(lock_key)
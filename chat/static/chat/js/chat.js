@@ -10,7 +10,7 @@ function getSessionId() {
     return urlParams.get('session_id') || generateSessionId();
 }
 
-let socket = new WebSocket("ws://127.0.0.1:8001/ws/chat/lobby/");
+let socket = null; // Opened by connectSocket() below
 
 
 
@@ -195,29 +195,140 @@ function sendMessage() {
     removeTypingIndicator();
     showTypingIndicator();
 
-    // Send message to the server with session_id and selected_bot_id
+    // Sent with every attempt, so a resend is answered once (see conversation.py)
+    const clientMessageId = crypto.randomUUID();
+
+    // Stream the reply over the WebSocket when it is connected
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        pendingSocketMessage = { messageText, sessionId, selectedBotId, clientMessageId };
+        socket.send(JSON.stringify({
+            message: messageText,
+            session_id: sessionId,
+            bot_id: selectedBotId,
+            client_message_id: clientMessageId,
+        }));
+        return;
+    }
+
+    postMessage(messageText, sessionId, selectedBotId, clientMessageId);
+}
+
+// Message sent over the WebSocket whose reply has not finished yet
+let pendingSocketMessage = null;
+// Network failures are retried this many times (with the same client message id)
+const POST_RETRIES = 2;
+
+// HTTP POST, streamed as newline-delimited JSON when the browser can read it
+function postMessage(messageText, sessionId, selectedBotId, clientMessageId, attempt = 0) {
+    const canStream = window.ReadableStream && window.TextDecoder;
     fetch('/chat/', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/x-www-form-urlencoded',
             'X-CSRFToken': getCookie('csrftoken'),
         },
-        body: `message=${encodeURIComponent(messageText)}&session_id=${encodeURIComponent(sessionId)}&bot_id=${encodeURIComponent(selectedBotId)}`
+        body: `message=${encodeURIComponent(messageText)}&session_id=${encodeURIComponent(sessionId)}&bot_id=${encodeURIComponent(selectedBotId)}&client_message_id=${encodeURIComponent(clientMessageId)}${canStream ? '&stream=1' : ''}`
+    })
+    .then(response => {
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!canStream || !response.body || !contentType.includes('application/x-ndjson')) {
+            return response.json();
+        }
+        return readStreamedReply(response);
     })
-    .then(response => response.json())
     .then(data => {
-        removeTypingIndicator();
         if (data.response) {
-            addMessage(data.response, false);
+            finishBotMessage(data.response);
+        } else if (data.error) {
+            discardBotDelta();
+            removeTypingIndicator();
+            addMessage("Error connecting to the bot.", false);
+        } else {
+            removeTypingIndicator();
         }
     })
     .catch(error => {
         console.error('Error:', error);
+        streamingBubble = null;
+        if (error instanceof TypeError && attempt < POST_RETRIES) {
+            // Network failure: the server may have the message already, resending it is safe
+            setTimeout(() => postMessage(messageText, sessionId, selectedBotId, clientMessageId, attempt + 1),
+                       1000 * (attempt + 1));
+            return;
+        }
         removeTypingIndicator();
         addMessage("Error connecting to the bot.", false);
     });
 }
 
+// Read {"delta"} lines into the bot bubble; resolves with the final {"response", "session_id"} (or {"error"}) line
+async function readStreamedReply(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let final = {};
+    while (true) {
+        const { value, done } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+            if (!line.trim()) continue;
+            const data = JSON.parse(line);
+            if (data.delta !== undefined) {
+                appendBotDelta(data.delta);
+            } else {
+                final = data;
+            }
+        }
+        if (done) return final;
+    }
+}
+
+// Streaming bot message: created on the first delta, saved once the reply is complete
+let streamingBubble = null;
+
+function appendBotDelta(delta) {
+    if (!streamingBubble) {
+        removeTypingIndicator();
+        const messageDiv = document.createElement('div');
+        messageDiv.className = 'message bot';
+        messageDiv.innerHTML = `
+            <div class="message-time">${getCurrentTime()}</div>
+            <div class="msg-avatar bot">AI</div>
+            <div class="message-bubble"></div>
+        `;
+        messagesContainer.appendChild(messageDiv);
+        streamingBubble = messageDiv.querySelector('.message-bubble');
+    }
+    streamingBubble.textContent += delta;
+    scrollToBottom();
+}
+
+// A reply cut off mid-stream is not kept
+function discardBotDelta() {
+    if (streamingBubble) {
+        streamingBubble.closest('.message').remove();
+        streamingBubble = null;
+    }
+}
+
+function finishBotMessage(text) {
+    if (!streamingBubble) {
+        appendBotMessage(text);
+        return;
+    }
+    streamingBubble.innerHTML = text;
+    streamingBubble = null;
+    if (currentSessionId) {
+        if (!chatSessions[currentSessionId]) {
+            chatSessions[currentSessionId] = [];
+        }
+        chatSessions[currentSessionId].push({ text, isUser: false, time: getCurrentTime() });
+        saveCurrentSession();
+    }
+}
+
 // Append bot message
 function appendBotMessage(text) {
     removeTypingIndicator();
@@ -372,33 +483,58 @@ function deleteChatHistory() {
 }
 
 // WebSocket events
-socket.onopen = function(event) {
-    // Connection established, no need to show a message
-    console.log("WebSocket connection established");
-};
+function connectSocket() {
+    socket = new WebSocket("ws://127.0.0.1:8001/ws/chat/lobby/");
+
+    socket.onopen = function(event) {
+        // Connection established, no need to show a message
+        console.log("WebSocket connection established");
+    };
+
+    socket.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+        if (data.type === 'delta') {
+            appendBotDelta(data.delta);
+        } else if (data.type === 'error') {
+            pendingSocketMessage = null;
+            discardBotDelta();
+            removeTypingIndicator();
+            console.error("Chat error:", data.error);
+            addMessage("Error connecting to the bot.", false);
+        } else {
+            pendingSocketMessage = null;
+            finishBotMessage(data.reply);
+        }
+    };
 
-socket.onmessage = function(event) {
-    const data = JSON.parse(event.data);
-    appendBotMessage(data.reply);
-};
+    socket.onerror = function(event) {
+        removeTypingIndicator();
+        console.error("WebSocket connection error:", event);
+        // Don't show error message in the chat UI
+    };
 
-socket.onerror = function(event) {
-    removeTypingIndicator();
-    console.error("WebSocket connection error:", event);
-    // Don't show error message in the chat UI
-};
+    socket.onclose = function() {
+        removeTypingIndicator();
+        streamingBubble = null; // A reply cut off mid-stream stays as far as it got
+        console.log("WebSocket connection closed");
+        if (pendingSocketMessage) {
+            // Resend over HTTP; the server answers with the reply it already has, if any
+            const { messageText, sessionId, selectedBotId, clientMessageId } = pendingSocketMessage;
+            pendingSocketMessage = null;
+            showTypingIndicator();
+            postMessage(messageText, sessionId, selectedBotId, clientMessageId);
+        }
+        // Don't show closed message in the chat UI
+
+        // Automatically attempt to reconnect (with the same handlers)
+        setTimeout(() => {
+            console.log("Attempting to reconnect...");
+            connectSocket();
+        }, 5000); // Try to reconnect after 5 seconds
+    };
+}
 
-socket.onclose = function() {
-    removeTypingIndicator();
-    console.log("WebSocket connection closed");
-    // Don't show closed message in the chat UI
-    
-    // Optional: Automatically attempt to reconnect
-    setTimeout(() => {
-        console.log("Attempting to reconnect...");
-        socket = new WebSocket("ws://127.0.0.1:8001/ws/chat/lobby/");
-    }, 5000); // Try to reconnect after 5 seconds
-};
+connectSocket();
 
 // Fetch all user-specific backend sessions (fixes missing history)
 async function fetchBackendChatSessions() {
@@ -1,3 +1,443 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+from base64 import urlsafe_b64encode
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 
 # Create your tests here.
+from . import conversation, data_keys, dispatch, fields, memory, metrics, near_duplicates, pipeline, purge, services
+from .embeddings import DenseIndex, EmbeddingStore, HashingEmbedder
+from .models import FAQ, ChatMessage, ChatSession, DataKey, SensitiveData, UserProfile
+
+
+class DataKeyAsyncTests(TestCase):
+    """Messages under a user's data key read from async code while no key is cached yet."""
+
+    def setUp(self):
+        user = User.objects.create_user('async-reader', 'async-reader@example.com', 'password')
+        self.session = ChatSession.objects.create(user_profile=UserProfile.objects.create(user=user),
+                                                  session_id='data-key-async')
+        conversation.save_message(self.session, 'user', 'question', client_message_id='m1')
+        conversation.save_message(self.session, 'bot', 'answer', client_message_id='m1')
+        cache.delete(memory.KEY.format(self.session.session_id))
+        data_keys.forget()
+
+    async def test_history_rebuild_decrypts(self):
+        history = await conversation.arecent_history(self.session, skip_latest=False)
+        self.assertEqual(list(history), [('user', 'question'), ('bot', 'answer')])
+
+    async def test_replayed_reply_decrypts(self):
+        user_message = await self.session.messages.aget(sender='user', client_message_id='m1')
+        self.assertEqual(await conversation.await_reply(self.session, user_message), 'answer')
+
+
+class DispatcherMetricsTests(SimpleTestCase):
+    """Async dispatcher calls send their metrics from a thread, never the event loop."""
+
+    async def test_acall_keeps_metrics_off_the_loop(self):
+        loop_thread = threading.get_ident()
+        sent = []
+
+        def record(name, *args):
+            sent.append((name, threading.get_ident()))
+
+        dispatcher = dispatch.Dispatcher(max_concurrency=1, queue_timeout=1.0)
+
+        async def answer():
+            await asyncio.sleep(0.01)
+            return 'ok'
+
+        with mock.patch.object(metrics, 'incr', record), mock.patch.object(metrics, 'gauge', record), \
+                mock.patch.object(metrics, 'observe', record):
+            results = await asyncio.gather(dispatcher.acall(answer), dispatcher.acall(answer))
+
+        self.assertEqual(results, ['ok', 'ok'])
+        names = [name for name, _ in sent]
+        self.assertIn('llm.dispatch.queue_depth', names)
+        self.assertEqual(names.count('llm.dispatch.wait_ms'), 2)
+        self.assertNotIn(loop_thread, [thread for _, thread in sent])
+
+
+class MetricsTests(SimpleTestCase):
+    """Samples and events are written without reading shared lists back."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_percentiles_from_histogram(self):
+        for value in range(1, 1001):
+            metrics.observe('test.latency_ms', value)
+        stats = metrics.percentiles('test.')['test.latency_ms']
+        self.assertEqual(stats['count'], 1000)
+        for key, exact in [('p50', 500), ('p95', 950), ('p99', 990), ('max', 1000)]:
+            self.assertAlmostEqual(stats[key] / exact, 1, delta=metrics.HISTOGRAM_GROWTH - 1)
+
+    def test_events_keep_the_latest(self):
+        for i in range(metrics.EVENT_LIMIT + 5):
+            metrics.log_event('test.calls', {'i': i})
+        self.assertEqual([event['i'] for event in metrics.events('test.calls')],
+                         list(range(5, metrics.EVENT_LIMIT + 5)))
+
+
+class SingleFlightLookupTests(SimpleTestCase):
+    """Only bots that cache replies have other workers poll the response cache for them."""
+
+    def lookups(self, ttl):
+        bot = SimpleNamespace(id=1, prompt_template=None, response_cache_ttl=ttl)
+        with mock.patch.object(services.llm_calls, 'do', return_value='reply') as do:
+            services.get_gemini_response(f'uncached question for ttl {ttl}', bot_config=bot, model=object())
+        return do.call_args.args[2]
+
+    def test_no_lookup_without_reply_cache(self):
+        self.assertIsNone(self.lookups(0))
+
+    def test_lookup_with_reply_cache(self):
+        self.assertTrue(callable(self.lookups(60)))
+
+
+class FailingStreamModel:
+    """Gemini model whose streamed replies break off after their first chunk."""
+
+    async def generate_content_async(self, text, stream=False):
+        async def chunks():
+            yield SimpleNamespace(text='The first half')
+            raise ConnectionError('stream reset')
+        return chunks()
+
+
+class InterruptedStreamTests(TransactionTestCase):
+    """A reply cut off mid-stream ends in an error, and is neither saved nor cached."""
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_stream_raises_after_partial_reply(self):
+        parts = []
+        with self.assertRaises(services.StreamInterrupted):
+            async for delta in services.astream_gemini_response('cut off question', model=FailingStreamModel()):
+                parts.append(delta)
+        self.assertEqual(parts, ['The first half'])
+
+    async def test_ndjson_stream_ends_in_error(self):
+        user = await User.objects.acreate_user('streamer', 'streamer@example.com', 'password')
+        await self.async_client.aforce_login(user)
+        with mock.patch.object(services.llm, 'get_model', return_value=FailingStreamModel()):
+            response = await self.async_client.post('/chat/', {'message': 'cut off question',
+                                                               'client_message_id': 'm1', 'stream': '1'})
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        lines = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(lines[0], {'delta': 'The first half'})
+        self.assertIn('error', lines[-1])
+        self.assertFalse(await ChatMessage.objects.filter(sender='bot').aexists())
+
+
+class AnsweringModel:
+    def generate_content(self, text, stream=False):
+        return SimpleNamespace(text='Restart the router, then wait a minute.')
+
+    async def generate_content_async(self, text, stream=False):
+        return self.generate_content(text)
+
+
+class NearDuplicateReuseTests(TestCase):
+    """Only completed Gemini replies are reused for near-duplicate questions, also after a rebuild."""
+
+    def setUp(self):
+        user = User.objects.create_user('asker', 'asker@example.com', 'password')
+        self.profile = UserProfile.objects.create(user=user)
+        cache.clear()
+        near_duplicates.reset()
+
+    def answer(self, question, reply):
+        session = ChatSession.objects.create(user_profile=self.profile, session_id=f'session {question}')
+        conversation.save_message(session, 'user', question)
+        message = conversation.save_message(session, 'bot', reply, generated=reply.generated)
+        near_duplicates.remember(question, message)
+
+    def test_generated_reply_is_reused(self):
+        question = 'how do I fix my wifi connection'
+        reply = services.get_gemini_response(question, model=AnsweringModel())
+        self.assertTrue(reply.generated)
+        self.answer(question, reply)
+        self.assertEqual(near_duplicates.lookup('how do I fix my wifi connection?'), reply)
+        near_duplicates.reset()
+        self.assertEqual(near_duplicates.lookup('how do I fix my wifi connection?'), reply)
+
+    def test_fallback_reply_is_not_reused(self):
+        question = 'how do I fix my wifi connection'
+        reply = services.fallback_reply(question, passages=[('wifi', 'See the router FAQ.')])
+        self.assertFalse(reply.generated)
+        self.answer(question, reply)
+        self.assertIsNone(near_duplicates.lookup('how do I fix my wifi connection?'))
+        near_duplicates.reset()
+        self.assertIsNone(near_duplicates.lookup('how do I fix my wifi connection?'))
+
+
+class SlowStreamModel:
+    """Gemini model streaming its reply in three chunks; counts the generations it was asked for."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_content_async(self, text, stream=False):
+        self.calls += 1
+
+        async def chunks():
+            for text in ['Restart ', 'the ', 'router.']:
+                await asyncio.sleep(0.02)
+                yield SimpleNamespace(text=text)
+        return chunks()
+
+
+class StreamingSingleFlightTests(SimpleTestCase):
+    """Identical prompts streamed at the same time share one generation."""
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_followers_replay_the_leaders_reply(self):
+        model = SlowStreamModel()
+
+        async def ask():
+            return [part async for part in services.astream_gemini_response('my wifi is down', model=model)]
+
+        leader, follower = await asyncio.gather(ask(), ask())
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(leader, ['Restart ', 'the ', 'router.'])
+        self.assertEqual(services.join_reply(follower), 'Restart the router.')
+        self.assertTrue(services.join_reply(follower).generated)
+
+
+class DecisionCacheTests(TestCase):
+    """Retrieval decisions are cached for ANSWER_CACHE_TTL whatever the bot's reply cache TTL."""
+
+    def test_decisions_cached_for_bot_without_reply_cache(self):
+        cache.clear()
+        pipeline.answers.clear_local()
+        bot = SimpleNamespace(id=1, pk=1, prompt_template=None, response_cache_ttl=0,
+                              faq_answer_threshold=None, grounding_threshold=None)
+        pipeline.decide('how do I reset my password', bot_config=bot)
+        self.assertIsNotNone(pipeline._cached('how do I reset my password', bot)[2])
+
+
+class ChatPostReplayTests(TransactionTestCase):
+    """A resent client_message_id gets the stored reply, before any retrieval."""
+
+    def setUp(self):
+        cache.clear()
+        services.responses.clear_local()
+        near_duplicates.reset()
+
+    async def test_resend_replays_without_retrieval(self):
+        user = await User.objects.acreate_user('resender', 'resender@example.com', 'password')
+        await self.async_client.aforce_login(user)
+        data = {'message': 'my wifi keeps dropping', 'session_id': 'replay-session', 'client_message_id': 'm1'}
+        with mock.patch.object(services.llm, 'get_model', return_value=AnsweringModel()):
+            first = (await self.async_client.post('/chat/', data)).json()
+        with mock.patch('chat.views.adecide', side_effect=AssertionError('retrieval on a resend')):
+            second = (await self.async_client.post('/chat/', {**data, 'session_id': first['session_id']})).json()
+        self.assertEqual(second, first)
+        self.assertEqual(await ChatMessage.objects.filter(client_message_id='m1').acount(), 2)
+
+
+class SlowAnsweringModel(AnsweringModel):
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_content_async(self, text, stream=False):
+        self.calls += 1
+        await asyncio.sleep(0.2)
+        return self.generate_content(text)
+
+
+class ConcurrentReplayTests(TransactionTestCase):
+    """A resend arriving while the original is still answered waits for its reply."""
+
+    def setUp(self):
+        cache.clear()
+        services.responses.clear_local()
+        near_duplicates.reset()
+
+    async def test_resend_waits_for_the_original(self):
+        user = await User.objects.acreate_user('impatient', 'impatient@example.com', 'password')
+        await self.async_client.aforce_login(user)
+        data = {'message': 'my wifi keeps dropping', 'session_id': '6a1f4b3e-0a57-4cf1-9a36-1f0de4d2c7a1',
+                'client_message_id': 'm1'}
+        model = SlowAnsweringModel()
+
+        async def post(delay):
+            await asyncio.sleep(delay)
+            return (await self.async_client.post('/chat/', data)).json()
+
+        with mock.patch.object(services.llm, 'get_model', return_value=model):
+            original, resend = await asyncio.gather(post(0), post(0.05))
+        self.assertEqual(resend, original)
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(await ChatMessage.objects.filter(sender='bot').acount(), 1)
+
+
+class EmbeddingStoreTests(SimpleTestCase):
+    """A sync after a few FAQ edits writes only their rows; searches see the edits."""
+
+    def setUp(self):
+        self.store = EmbeddingStore(tempfile.mkdtemp())
+        self.embedder = HashingEmbedder()
+        self.items = [(faq_id, f'how do I reset widget number {faq_id}') for faq_id in range(1, 301)]
+
+    def assertMatchesFreshIndex(self, index):
+        fresh = DenseIndex([faq_id for faq_id, _ in self.items],
+                           self.embedder.embed_documents([text for _, text in self.items]))
+        queries = self.embedder.embed_queries(['reset widget 7', 'replace the battery'])
+        self.assertEqual(len(index), len(self.items))
+        # Tied scores may come back in another order
+        self.assertEqual([(hits[0].faq_id, [round(hit.score, 5) for hit in hits])
+                          for hits in index.search_vectors(queries, 3)],
+                         [(hits[0].faq_id, [round(hit.score, 5) for hit in hits])
+                          for hits in fresh.search_vectors(queries, 3)])
+
+    def test_edits_go_to_the_delta(self):
+        base = self.store.sync(self.items, self.embedder).base
+        self.items[6] = (7, 'how do I replace the battery')
+        del self.items[10]
+        self.items.append((500, 'reset widget 7 twice'))
+        index = self.store.sync(self.items, self.embedder)
+        self.assertEqual(index.base.matrix.filename, base.matrix.filename)
+        self.assertEqual(sorted(index.delta.doc_ids.tolist()), [7, 500])
+        self.assertEqual(len(index.base.dead), 2)
+        self.assertMatchesFreshIndex(index)
+
+    def test_many_edits_compact(self):
+        base = self.store.sync(self.items, self.embedder).base
+        self.items = [(faq_id, f'{text} again') for faq_id, text in self.items]
+        index = self.store.sync(self.items, self.embedder)
+        self.assertNotEqual(index.base.matrix.filename, base.matrix.filename)
+        self.assertEqual((len(index.base.dead), len(index.delta)), (0, 0))
+        self.assertMatchesFreshIndex(index)
+
+
+class EncryptedFieldTests(TestCase):
+    """Stored formats of EncryptedTextField values, old and new."""
+
+    def stored(self, model, pk, column):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {column} FROM {model._meta.db_table} WHERE id = %s', [pk])
+            return bytes(cursor.fetchone()[0])
+
+    def test_binary_round_trip(self):
+        for value, version in [('short', fields.FORMAT_RAW), ('compressible ' * 50, fields.FORMAT_ZLIB)]:
+            stored = fields.encrypt(value, binary=True)
+            self.assertEqual(stored[0], version)
+            self.assertFalse(fields.is_legacy(stored))
+            self.assertIsNone(fields.data_key_id(stored))
+            self.assertEqual(fields.decrypt(stored), value)
+        row = SensitiveData.objects.create(name='binary', sensitive_info='compressible ' * 50)
+        self.assertEqual(self.stored(SensitiveData, row.pk, 'sensitive_info')[0], fields.FORMAT_ZLIB)
+        self.assertEqual(SensitiveData.objects.get(pk=row.pk).sensitive_info, 'compressible ' * 50)
+
+    def test_keyed_round_trip(self):
+        user = User.objects.create_user('keyed', 'keyed@example.com', 'password')
+        profile = UserProfile.objects.create(user=user)
+        session = ChatSession.objects.create(user_profile=profile, session_id='keyed-session')
+        message = conversation.save_message(session, 'user', 'under my own key')
+        stored = self.stored(ChatMessage, message.pk, 'content')
+        key = DataKey.objects.get(user_profile=profile)
+        self.assertTrue(stored[0] & fields.KEYED)
+        self.assertEqual(fields.data_key_id(stored), key.pk)
+        # Only the data key opens it, not the master key
+        with self.assertRaises(InvalidToken):
+            fields.cipher_suite.decrypt(fields._fernet_token(stored))
+        data_keys.forget()
+        self.assertEqual(ChatMessage.objects.get(pk=message.pk).content, 'under my own key')
+
+    def test_legacy_double_encoded_read(self):
+        # What rows written before the binary format hold: base64 of the Fernet token
+        stored = urlsafe_b64encode(fields.cipher_suite.encrypt(b'old secret')).decode('ascii')
+        self.assertTrue(stored.startswith('Z0FBQUFB'))
+        row = SensitiveData.objects.create(name='legacy', sensitive_info='placeholder')
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE chat_sensitivedata SET sensitive_info = %s WHERE id = %s', [stored, row.pk])
+        self.assertEqual(SensitiveData.objects.get(pk=row.pk).sensitive_info, 'old secret')
+        self.assertTrue(fields.is_current(stored))
+        self.assertEqual(fields.decrypt(fields.rotate(stored)), 'old secret')
+
+
+class ReencryptTests(TestCase):
+    """manage.py reencrypt moves every master-key value to the newest key."""
+
+    def test_rotation(self):
+        faq = FAQ.objects.create(question='How do I reset my password?', answer='Use the reset link.')
+        legacy = SensitiveData.objects.create(name='legacy', sensitive_info='placeholder')
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE chat_sensitivedata SET sensitive_info = %s WHERE id = %s',
+                           [fields.cipher_suite.encrypt(b'old text token').decode('ascii'), legacy.pk])
+        old_keys, new_key = fields.ENCRYPTION_KEYS, Fernet.generate_key().decode('ascii')
+        keys = [new_key] + old_keys
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        with mock.patch.object(fields, 'primary_cipher', Fernet(new_key)), \
+                mock.patch.object(fields, 'cipher_suite', MultiFernet([Fernet(key) for key in keys])), \
+                mock.patch('chat.management.commands.reencrypt.ENCRYPTION_KEYS', keys):
+            call_command('reencrypt', checkpoint=checkpoint, sleep=0, stdout=open(os.devnull, 'w'))
+        # Readable with the new key alone
+        with mock.patch.object(fields, 'cipher_suite', MultiFernet([Fernet(new_key)])):
+            self.assertEqual(FAQ.objects.get(pk=faq.pk).answer, 'Use the reset link.')
+            self.assertEqual(SensitiveData.objects.get(pk=legacy.pk).sensitive_info, 'old text token')
+
+
+class CryptoShredTests(TestCase):
+    """Deleting a user's history makes their messages unreadable at once; purge then deletes them."""
+
+    def test_shred(self):
+        profiles = [UserProfile.objects.create(user=User.objects.create_user(name, f'{name}@example.com', 'pw'))
+                    for name in ('leaving', 'staying')]
+        for profile in profiles:
+            session = ChatSession.objects.create(user_profile=profile, session_id=f'shred {profile.pk}')
+            conversation.save_message(session, 'user', 'my secret question')
+        leaving, staying = profiles
+        message_ids = list(ChatMessage.objects.filter(session__user_profile=leaving).values_list('id', flat=True))
+        self.assertEqual(data_keys.shred(leaving), 1)
+        data_keys.forget()
+        self.assertEqual([message.content for message in ChatMessage.objects.filter(id__in=message_ids)],
+                         [fields.SHREDDED])
+        self.assertEqual(ChatMessage.objects.get(session__user_profile=staying).content, 'my secret question')
+        self.assertEqual(purge.purge(sleep=0), (1, 1))
+        self.assertFalse(ChatMessage.objects.filter(id__in=message_ids).exists())
+        self.assertFalse(DataKey.objects.filter(user_profile=leaving).exists())
+
+
+class BinaryStorageMigrationTests(TransactionTestCase):
+    """0017 converts rows in the pre-series text form to the binary format."""
+
+    before = [('chat', '0016_encrypted_binary_storage')]
+    after = [('chat', '0017_convert_encrypted_rows')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('chat'))
+
+    def test_old_text_rows_are_converted(self):
+        self.migrate(self.before)
+        stored = urlsafe_b64encode(fields.cipher_suite.encrypt(b'pre-series secret')).decode('ascii')
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO chat_sensitivedata (name, sensitive_info, created_at) "
+                           "VALUES ('old', %s, '2025-01-01 00:00:00')", [stored])
+        self.migrate(self.after)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sensitive_info FROM chat_sensitivedata WHERE name = 'old'")
+            converted = bytes(cursor.fetchone()[0])
+        self.assertFalse(fields.is_legacy(converted))
+        self.assertEqual(fields.decrypt(converted), 'pre-series secret')
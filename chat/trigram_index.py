@@ -0,0 +1,168 @@
+"""
+Typo-tolerant matching for FAQ questions and keywords.
+
+Every keyword and question is split into character trigrams and put in an
+inverted index. A query only touches the postings of its own trigrams, so
+finding candidates costs time proportional to the overlap rather than to the
+number of FAQs. Candidates above a trigram similarity floor are then checked
+with a bounded Levenshtein distance before they count as a match.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+from .retrieval import TOKEN_RE, ScoredFAQ
+
+# Edits allowed per character of the matched text (e.g. 2 for "password")
+MAX_EDIT_RATIO = 0.2
+# Keywords shorter than this are too ambiguous to match fuzzily
+MIN_FUZZY_LENGTH = 4
+# Trigram similarity a candidate needs before edit distance is computed
+MIN_TRIGRAM_SIMILARITY = 0.3
+# Most candidates per probe (best trigram similarity first) checked by edit distance
+MAX_VERIFY = 32
+
+
+def normalize(text):
+    return ' '.join(TOKEN_RE.findall((text or '').lower()))
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bounded_edit_distance(a, b, max_distance):
+    """Levenshtein distance of a and b, or max_distance + 1 once it is certainly larger."""
+    limit = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return limit
+    # Only the diagonal band |i - j| <= max_distance can stay within the bound
+    previous = [j if j <= max_distance else limit for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [limit] * (len(b) + 1)
+        if i <= max_distance:
+            current[0] = i
+        lo = max(1, i - max_distance)
+        hi = min(len(b), i + max_distance)
+        for j in range(lo, hi + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+        if min(current[lo - 1:hi + 1]) > max_distance:
+            return limit
+        previous = current
+    return min(previous[len(b)], limit)
+
+
+def max_edits(length):
+    return max(1, round(length * MAX_EDIT_RATIO))
+
+
+def edit_similarity(a, b):
+    """1 - distance / length when a and b are within MAX_EDIT_RATIO edits, else 0."""
+    length = max(len(a), len(b))
+    max_distance = max_edits(length)
+    distance = bounded_edit_distance(a, b, max_distance)
+    return 0.0 if distance > max_distance else 1.0 - distance / length
+
+
+class TrigramIndex:
+    """Inverted index from character trigram to the entries containing it."""
+
+    def __init__(self, entries):
+        """entries: iterable of (normalized text, faq_id)."""
+        self.texts = []
+        self.faq_ids = []
+        sizes = []
+        lengths = []
+        postings = defaultdict(list)
+        for text, faq_id in entries:
+            row = len(self.texts)
+            grams = trigrams(text)
+            for gram in grams:
+                postings[gram].append(row)
+            self.texts.append(text)
+            self.faq_ids.append(faq_id)
+            sizes.append(len(grams))
+            lengths.append(len(text))
+        self.postings = {gram: np.asarray(rows, dtype=np.int32) for gram, rows in postings.items()}
+        self.sizes = np.asarray(sizes, dtype=np.int32)
+        self.lengths = np.asarray(lengths, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def candidates(self, text, min_similarity=MIN_TRIGRAM_SIMILARITY, limit=None):
+        """
+        (row, trigram similarity) pairs at or above min_similarity that could
+        be within MAX_EDIT_RATIO edits of text, best first (at most limit).
+        """
+        grams = trigrams(text)
+        lists = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not lists:
+            return []
+        hits = np.concatenate(lists)
+        if len(hits) * 16 < len(self.texts):
+            rows, shared = np.unique(hits, return_counts=True)
+        else:
+            # Many postings: counting into a dense array beats sorting them
+            counts = np.bincount(hits, minlength=len(self.texts))
+            rows = np.flatnonzero(counts)
+            shared = counts[rows]
+        sizes = self.sizes[rows]
+        similarity = shared / (len(grams) + sizes - shared)
+        # Count filter: one edit removes at most 3 distinct trigrams, so rows
+        # sharing fewer cannot pass the edit-distance check
+        max_distance = np.maximum(1, np.rint(np.maximum(self.lengths[rows], len(text)) * MAX_EDIT_RATIO))
+        keep = (similarity >= min_similarity) & (shared >= np.maximum(sizes, len(grams)) - 3 * max_distance)
+        rows, similarity = rows[keep], similarity[keep]
+        order = np.argsort(-similarity, kind='stable')[:limit]
+        return [(int(rows[i]), float(similarity[i])) for i in order]
+
+
+class FuzzyMatcher:
+    """Trigram + edit-distance matching of a message against FAQ keywords and questions."""
+
+    def __init__(self, records):
+        keyword_entries = []
+        question_entries = []
+        self.max_keyword_words = 1
+        for record in records:
+            question_entries.append((normalize(record.question), record.faq_id))
+            for kw in record.keywords:
+                kw = normalize(kw)
+                if len(kw) >= MIN_FUZZY_LENGTH:
+                    keyword_entries.append((kw, record.faq_id))
+                    self.max_keyword_words = max(self.max_keyword_words, kw.count(' ') + 1)
+        self.keywords = TrigramIndex(keyword_entries)
+        self.questions = TrigramIndex(question_entries)
+
+    def search(self, user_query, k=5):
+        """
+        Top-k ScoredFAQ by fuzzy match. score is the trigram similarity,
+        confidence the edit-distance similarity (1.0 means an exact match).
+        """
+        text = normalize(user_query)
+        if not text:
+            return []
+        best = {}
+
+        def consider(index, row, similarity, window):
+            confidence = edit_similarity(window, index.texts[row])
+            faq_id = index.faq_ids[row]
+            if confidence and (faq_id not in best or (confidence, similarity) > best[faq_id][1:]):
+                best[faq_id] = (faq_id, similarity, confidence)
+
+        # Keywords: compare against every run of up to max_keyword_words words
+        words = text.split()
+        for size in range(1, self.max_keyword_words + 1):
+            for start in range(len(words) - size + 1):
+                window = ' '.join(words[start:start + size])
+                if len(window) >= MIN_FUZZY_LENGTH:
+                    for row, similarity in self.keywords.candidates(window, limit=MAX_VERIFY):
+                        consider(self.keywords, row, similarity, window)
+        # Questions: compare against the whole message
+        for row, similarity in self.questions.candidates(text, limit=MAX_VERIFY):
+            consider(self.questions, row, similarity, text)
+
+        ranked = sorted(best.values(), key=lambda hit: (-hit[2], -hit[1], hit[0]))
+        return [ScoredFAQ(*hit) for hit in ranked[:k]]
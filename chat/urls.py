@@ -20,6 +20,7 @@ urlpatterns = [
     path('admin_dashboard/user_management/<int:user_id>/chat_logs/', views.user_chat_logs, name='user_chat_logs'),
     path('admin_dashboard/analytics/', views.analytics, name='analytics'),
     path('api/analytics/', views.analytics_api, name='analytics_api'),
+    path('api/metrics/', views.metrics_api, name='metrics_api'),
     path('api/admin_dashboard/', views.admin_dashboard_api, name='admin_dashboard_api'),
     path('delete_history/', views.delete_history, name='delete_history'),
     path('api/user_chat_sessions/', views.get_user_chat_sessions, name='get_user_chat_sessions'),
@@ -1,16 +1,22 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
 from .forms import BotConfigurationForm
 from .models import BotConfiguration, FAQ, ChatSession, ChatMessage, UserProfile
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count # Import Count UserProfile
+from django.db.models import Count, Prefetch # Import Count UserProfile
 from django.db.models.functions import TruncMonth # Import date aggregation for charts
 from django.contrib.auth.decorators import login_required, user_passes_test # Import login_required and staff check
 from django.contrib.auth import authenticate, login, logout # Import authenticate, login, and logout
 from django.contrib.auth.forms import UserCreationForm # Import UserCreationForm
 from .forms import BotConfigurationForm, UserRegistrationForm, EmailAuthenticationForm # Import UserRegistrationForm and EmailAuthenticationForm
-from .services import get_gemini_response # Import Gemini service
+from .services import StreamInterrupted, aget_gemini_response, astream_gemini_response, join_reply # Import Gemini service
+from .conversation import (aclaim_message, aget_bot, aget_or_create_session, arecent_history, arelease_message,
+                           asave_message, await_reply)
+from .pipeline import FAQ_ANSWER, GROUNDED, adecide # Hybrid FAQ retrieval + confidence gate
+from . import data_keys, metrics, near_duplicates, purge
+from .dispatch import get_dispatcher
 from django.contrib import messages # Import messages
 import json
 import uuid
@@ -26,19 +32,6 @@ from django.http import HttpResponse
 def is_staff_user(user):
     return user.is_authenticated and user.is_staff
 
-def get_faq_answer(user_query):
-    """Retrieve FAQ answer using keyword matching (fallback to question matching)"""
-    user_query_lower = user_query.lower().strip()
-    # 1. Keyword-based matching
-    for faq in FAQ.objects.all():
-        if any(kw in user_query_lower for kw in faq.get_keywords_list()):
-            return faq.answer
-    # 2. Fallback to original question matching
-    try:
-        return FAQ.objects.get(question__icontains=user_query).answer
-    except FAQ.DoesNotExist:
-        return None
-
 @login_required
 @user_passes_test(is_staff_user)
 def dashboard_stats(request):
@@ -46,8 +39,8 @@ def dashboard_stats(request):
     try:
         total_users = User.objects.count()
         active_bots = BotConfiguration.objects.filter(is_active=True).count()
-        total_chats = ChatSession.objects.count()
-        total_messages = ChatMessage.objects.count()
+        total_chats = ChatSession.objects.filter(user_profile__isnull=False).count()
+        total_messages = ChatMessage.objects.filter(session__user_profile__isnull=False).count()
 
         return JsonResponse({
             'total_users': total_users,
@@ -95,12 +88,116 @@ def home(request):
 def about(request):
     return render(request, 'chat/about.html')
 
-def chat(request):
-    print(f"Chat view called. Request method: {request.method}, User authenticated: {request.user.is_authenticated}")
-    if not request.user.is_authenticated:
+async def _chat_post(request, user):
+    user_message = request.POST.get('message')
+    session_id = request.POST.get('session_id')
+    selected_bot_id = request.POST.get('bot_id') # Get selected bot ID
+    client_message_id = request.POST.get('client_message_id') or None # Makes resending the message safe
+    if client_message_id and len(client_message_id) > 64:
+        return JsonResponse({'error': 'client_message_id must be at most 64 characters.'}, status=400)
+
+    # Get the selected bot configuration
+    selected_bot = await aget_bot(selected_bot_id)
+
+    user_profile, _ = await UserProfile.objects.aget_or_create(user=user)
+    chat_session, session_id = await aget_or_create_session(user_profile, session_id)
+
+    # Save user message, unless this is a resend of one already answered or being answered
+    # (checked first, so a resend costs no retrieval)
+    if client_message_id:
+        saved_message, created = await aclaim_message(chat_session, user_message, client_message_id)
+        if not created:
+            bot_response = await await_reply(chat_session, saved_message)
+            if bot_response is not None:
+                return JsonResponse({'response': bot_response, 'session_id': session_id})
+    else:
+        await asave_message(chat_session, 'user', user_message)
+
+    streaming = False
+    try:
+        # Hybrid FAQ retrieval decides between FAQ answer, grounded and plain Gemini;
+        # repeats of a question are answered from the answer cache before any retrieval
+        decision = await adecide(user_message, bot_config=selected_bot)
+        passages = decision.passages() if decision.action == GROUNDED else None
+
+        history = await arecent_history(chat_session) if decision.action != FAQ_ANSWER else None
+        if decision.action != FAQ_ANSWER and not history:
+            # A session's first question depends on nothing but the bot: reuse the reply to a near-duplicate
+            bot_response = await near_duplicates.alookup(user_message, selected_bot)
+            if bot_response is not None:
+                await asave_message(chat_session, 'bot', bot_response, bot=selected_bot,
+                                    client_message_id=client_message_id)
+                return JsonResponse({'response': bot_response, 'session_id': session_id})
+
+        if request.POST.get('stream') and decision.action != FAQ_ANSWER:
+            # Newline-delimited JSON: {"delta": ...} lines, then the usual {"response", "session_id"}
+            # (or {"error"} if the reply was cut off; nothing is saved then)
+            async def stream():
+                try:
+                    parts = []
+                    try:
+                        async for delta in astream_gemini_response(user_message, bot_config=selected_bot,
+                                                                   passages=passages, history=history):
+                            parts.append(delta)
+                            yield json.dumps({'delta': delta}) + '\n'
+                    except StreamInterrupted:
+                        yield json.dumps({'error': 'The reply was cut off. Please try again.'}) + '\n'
+                        return
+                    bot_response = join_reply(parts)
+                    bot_message = await asave_message(chat_session, 'bot', bot_response, bot=selected_bot,
+                                                      client_message_id=client_message_id,
+                                                      generated=bot_response.generated)
+                    if not history:
+                        await near_duplicates.aremember(user_message, bot_message, selected_bot)
+                    yield json.dumps({'response': bot_response, 'session_id': session_id}) + '\n'
+                finally:
+                    await arelease_message(chat_session, client_message_id)
+            streaming = True
+            return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+        if decision.action == FAQ_ANSWER:
+            bot_response = decision.answer
+            print(f"FAQ matched. Bot response: {bot_response}")
+        else:
+            try:
+                bot_response = await aget_gemini_response(user_message, bot_config=selected_bot, passages=passages,
+                                                          history=history) # Pass bot_config
+                print(f"Gemini response: {bot_response}")
+            except Exception as e:
+                # Handle potential errors from Gemini service
+                print(f"Error getting response from AI: {e}")
+                return JsonResponse({'error': f'Error getting response from AI: {str(e)}'}, status=500)
+
+        # Save bot response (either from FAQ or Gemini)
+        bot_message = await asave_message(chat_session, 'bot', bot_response, bot=selected_bot,
+                                          client_message_id=client_message_id,
+                                          generated=getattr(bot_response, 'generated', False))
+        if decision.action != FAQ_ANSWER and not history:
+            await near_duplicates.aremember(user_message, bot_message, selected_bot)
+    finally:
+        if not streaming:
+            await arelease_message(chat_session, client_message_id)
+
+    response_data = {'response': bot_response, 'session_id': session_id}
+    print(f"Returning JSON response: {response_data}")
+    return JsonResponse(response_data)
+
+async def chat(request):
+    """
+    Async so that a POST waiting on Gemini holds no worker thread under ASGI.
+    GET pages are still rendered by the sync _chat_page in a thread.
+    """
+    user = await request.auser()
+    print(f"Chat view called. Request method: {request.method}, User authenticated: {user.is_authenticated}")
+    if not user.is_authenticated:
         print("User not authenticated, redirecting to login page.")
         return redirect('login')
 
+    if request.method == 'POST':
+        return await _chat_post(request, user)
+    return await sync_to_async(_chat_page)(request)
+
+def _chat_page(request):
     # Handle GET request - check for session ID
     if request.method == 'GET':
         session_id = request.GET.get('session_id')
@@ -127,79 +224,6 @@ def chat(request):
             # No session_id provided, show chat interface without creating session
             return render(request, 'chat/chat.html', {'session_id': None, 'bots': bots})
 
-    # Handle POST request
-    if request.method == 'POST':
-        user_message = request.POST.get('message')
-        session_id = request.POST.get('session_id')
-        selected_bot_id = request.POST.get('bot_id') # Get selected bot ID
-
-        user_profile, _ = UserProfile.objects.get_or_create(user=request.user)
-
-        chat_session = None
-        if session_id:
-            # Try to get existing session for the current user
-            try:
-                chat_session = ChatSession.objects.get(
-                    user_profile=user_profile,
-                    session_id=session_id
-                )
-            except ChatSession.DoesNotExist:
-                # If session_id is provided but doesn't exist for this user,
-                # treat it as a new session request with a new ID.
-                print(f"Provided session_id {session_id} not found for user {request.user.username}. Creating new session.")
-                session_id = str(uuid.uuid4()) # Generate a new UUID
-                chat_session = ChatSession.objects.create(
-                    user_profile=user_profile,
-                    session_id=session_id
-                )
-        
-        if not chat_session: # If no session_id was provided or the provided one was invalid/not found
-            session_id = str(uuid.uuid4())
-            chat_session = ChatSession.objects.create(
-                user_profile=user_profile,
-                session_id=session_id
-            )
-
-        # Get the selected bot configuration
-        selected_bot = None
-        if selected_bot_id:
-            try:
-                selected_bot = BotConfiguration.objects.get(id=selected_bot_id)
-            except BotConfiguration.DoesNotExist:
-                pass # Handle case where bot doesn't exist
-
-        # Save user message
-        ChatMessage.objects.create(
-            session=chat_session,
-            sender='user',
-            content=user_message
-        )
-
-        # Simple FAQ matching logic
-        faq_match = FAQ.objects.filter(question__icontains=user_message).first()
-        if faq_match:
-            bot_response = faq_match.answer
-            print(f"FAQ matched. Bot response: {bot_response}")
-        else:
-            try:
-                # If no FAQ match, get response from Gemini
-                bot_response = get_gemini_response(user_message, bot_config=selected_bot) # Pass bot_config
-                print(f"Gemini response: {bot_response}")
-            except Exception as e:
-                # Handle potential errors from Gemini service
-                print(f"Error getting response from AI: {e}")
-                return JsonResponse({'error': f'Error getting response from AI: {str(e)}'}, status=500)
-
-        # Save bot response (either from FAQ or Gemini)
-        ChatMessage.objects.create(
-            session=chat_session,
-            sender='bot',
-            content=bot_response
-        )
-
-        response_data = {'response': bot_response, 'session_id': session_id}
-        print(f"Returning JSON response: {response_data}")
-        return JsonResponse(response_data)
     print("Returning chat.html for GET request.")
     user_profile, created = UserProfile.objects.get_or_create(user=request.user)
     # Filter out sessions that have no messages
@@ -380,10 +404,10 @@ def admin_dashboard(request):
     active_bots = BotConfiguration.objects.count()
 
     # Get total number of chat sessions
-    total_chats = ChatSession.objects.count()
+    total_chats = ChatSession.objects.filter(user_profile__isnull=False).count()
 
     # Get total number of messages
-    total_messages = ChatMessage.objects.count()
+    total_messages = ChatMessage.objects.filter(session__user_profile__isnull=False).count()
 
     context = {
         'total_users': total_users,
@@ -411,11 +435,11 @@ def admin_dashboard_api(request):
 
     # Chat sessions over time (last 30 days)
     thirty_days_ago = timezone.now() - datetime.timedelta(days=30)
-    chat_sessions = ChatSession.objects.filter(start_time__gte=thirty_days_ago).annotate(day=TruncDay('start_time')).values('day').annotate(count=Count('id')).order_by('day')
+    chat_sessions = ChatSession.objects.filter(user_profile__isnull=False, start_time__gte=thirty_days_ago).annotate(day=TruncDay('start_time')).values('day').annotate(count=Count('id')).order_by('day')
     chat_data = [{'day': entry['day'].strftime('%d %b'), 'count': entry['count']} for entry in chat_sessions]
 
     # Messages over time (last 30 days)
-    messages = ChatMessage.objects.filter(timestamp__gte=thirty_days_ago).annotate(day=TruncDay('timestamp')).values('day').annotate(count=Count('id')).order_by('day')
+    messages = ChatMessage.objects.filter(session__user_profile__isnull=False, timestamp__gte=thirty_days_ago).annotate(day=TruncDay('timestamp')).values('day').annotate(count=Count('id')).order_by('day')
     message_data = [{'day': entry['day'].strftime('%d %b'), 'count': entry['count']} for entry in messages]
 
     return JsonResponse({
@@ -432,8 +456,9 @@ from django.views.decorators.http import require_POST
 def delete_history(request):
     try:
         user_profile = UserProfile.objects.get(user=request.user)
-        ChatMessage.objects.filter(session__user_profile=user_profile).delete()
-        ChatSession.objects.filter(user_profile=user_profile).delete()
+        # Unreadable and gone from the user's history at once; the rows are deleted in the background
+        data_keys.shred(user_profile)
+        purge.schedule()
         return JsonResponse({'success': True, 'message': 'Chat history deleted successfully.'})
     except UserProfile.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'User profile not found.'}, status=404)
@@ -451,13 +476,14 @@ def get_user_chat_sessions(request):
     """API endpoint to fetch all user-specific chat sessions and messages"""
     try:
         user_profile = UserProfile.objects.get(user=request.user)
-        chat_sessions = ChatSession.objects.filter(user_profile=user_profile, messages__isnull=False).distinct().order_by('-start_time')
+        chat_sessions = ChatSession.objects.filter(user_profile=user_profile, messages__isnull=False).distinct().order_by('-start_time')\
+            .prefetch_related(Prefetch('messages', queryset=ChatMessage.objects.order_by('timestamp').decrypted())) # Every message is shown: decrypt them in bulk
         
         # Serialize sessions and messages (matches frontend format)
         serialized_sessions = []
         for session in chat_sessions:
             messages = []
-            for msg in session.messages.all().order_by('timestamp'):
+            for msg in session.messages.all():
                 messages.append({
                     'text': msg.content,
                     'isUser': msg.sender == 'user',
@@ -567,7 +593,8 @@ def user_management(request):
 @login_required
 def user_chat_logs(request, user_id):
     user_profile = get_object_or_404(UserProfile, pk=user_id)
-    chat_sessions = ChatSession.objects.filter(user_profile=user_profile).order_by('-start_time')
+    chat_sessions = ChatSession.objects.filter(user_profile=user_profile).order_by('-start_time')\
+        .prefetch_related(Prefetch('messages', queryset=ChatMessage.objects.decrypted())) # Decrypted in bulk
 
     context = {
         'user_profile': user_profile,
@@ -582,6 +609,21 @@ def analytics(request):
 
     return render(request, 'chat/analytics.html')
 
+@login_required
+def metrics_api(request):
+    """Retrieval decision counters, latency/prompt size percentiles, LLM dispatcher state and recent LLM calls"""
+    if not request.user.is_superuser:
+        return JsonResponse({'error': 'Unauthorized'}, status=403)
+    prefix = request.GET.get('prefix', '')
+    return JsonResponse({
+        'counters': metrics.snapshot(prefix),
+        'percentiles': metrics.percentiles(prefix),
+        'gauges': metrics.gauges(prefix),
+        # This worker's live queue and circuit breaker
+        'dispatch': get_dispatcher().state(),
+        'recent_llm_calls': metrics.events('llm.calls'),
+    })
+
 @login_required
 def analytics_api(request):
     """API endpoint for comprehensive analytics data"""
@@ -604,16 +646,16 @@ def analytics_api(request):
     new_users_30d = User.objects.filter(date_joined__gte=thirty_days_ago).count()
     new_users_7d = User.objects.filter(date_joined__gte=seven_days_ago).count()
 
-    # Chat analytics
-    total_sessions = ChatSession.objects.count()
-    sessions_30d = ChatSession.objects.filter(start_time__gte=thirty_days_ago).count()
-    sessions_7d = ChatSession.objects.filter(start_time__gte=seven_days_ago).count()
-    total_messages = ChatMessage.objects.count()
-    messages_30d = ChatMessage.objects.filter(timestamp__gte=thirty_days_ago).count()
-    messages_7d = ChatMessage.objects.filter(timestamp__gte=seven_days_ago).count()
+    # Chat analytics (deleted history waiting to be purged is left out)
+    total_sessions = ChatSession.objects.filter(user_profile__isnull=False).count()
+    sessions_30d = ChatSession.objects.filter(user_profile__isnull=False, start_time__gte=thirty_days_ago).count()
+    sessions_7d = ChatSession.objects.filter(user_profile__isnull=False, start_time__gte=seven_days_ago).count()
+    total_messages = ChatMessage.objects.filter(session__user_profile__isnull=False).count()
+    messages_30d = ChatMessage.objects.filter(session__user_profile__isnull=False, timestamp__gte=thirty_days_ago).count()
+    messages_7d = ChatMessage.objects.filter(session__user_profile__isnull=False, timestamp__gte=seven_days_ago).count()
 
     # Average session duration (for sessions with end_time)
-    avg_session_duration = ChatSession.objects.filter(end_time__isnull=False).aggregate(avg_duration=Avg(F('end_time') - F('start_time')))['avg_duration']
+    avg_session_duration = ChatSession.objects.filter(user_profile__isnull=False, end_time__isnull=False).aggregate(avg_duration=Avg(F('end_time') - F('start_time')))['avg_duration']
     if avg_session_duration:
         avg_session_duration = str(avg_session_duration).split('.')[0]  # Remove microseconds
 
@@ -631,11 +673,11 @@ def analytics_api(request):
     daily_data = [{'day': entry['day'].strftime('%d %b'), 'count': entry['count']} for entry in daily_active]
 
     # Chat sessions by day (last 30 days)
-    chat_sessions_daily = ChatSession.objects.filter(start_time__gte=thirty_days_ago).annotate(day=TruncDay('start_time')).values('day').annotate(count=Count('id')).order_by('day')
+    chat_sessions_daily = ChatSession.objects.filter(user_profile__isnull=False, start_time__gte=thirty_days_ago).annotate(day=TruncDay('start_time')).values('day').annotate(count=Count('id')).order_by('day')
     chat_daily_data = [{'day': entry['day'].strftime('%d %b'), 'count': entry['count']} for entry in chat_sessions_daily]
 
     # Messages by day (last 30 days)
-    messages_daily = ChatMessage.objects.filter(timestamp__gte=thirty_days_ago).annotate(day=TruncDay('timestamp')).values('day').annotate(count=Count('id')).order_by('day')
+    messages_daily = ChatMessage.objects.filter(session__user_profile__isnull=False, timestamp__gte=thirty_days_ago).annotate(day=TruncDay('timestamp')).values('day').annotate(count=Count('id')).order_by('day')
     message_daily_data = [{'day': entry['day'].strftime('%d %b'), 'count': entry['count']} for entry in messages_daily]
 
     # User activity distribution
@@ -192,4 +192,114 @@ CACHES = {
 #     }
 # }
 
-
+# FAQ retrieval: minimum share of a message's BM25 weight an FAQ must cover
+# before it is used as the answer instead of calling Gemini
+FAQ_MIN_CONFIDENCE = 0.5
+# Minimum edit-distance similarity for a misspelled keyword/question to count
+FAQ_MIN_FUZZY_SCORE = 0.8
+
+# Semantic FAQ retrieval: embeddings live in a shared memory-mapped matrix.
+# HashingEmbedder works offline; GeminiEmbedder uses the Gemini embedding API.
+FAQ_INDEX_DIR = BASE_DIR / 'faq_index'
+FAQ_EMBEDDER = 'chat.embeddings.GeminiEmbedder' if GEMINI_API_KEY else 'chat.embeddings.HashingEmbedder'
+FAQ_MIN_SIMILARITY = 0.8
+# How often (seconds) a worker checks the shared cache for FAQ edits made elsewhere
+FAQ_INDEX_REFRESH_INTERVAL = 0.5
+
+# Hybrid retrieval gate (per-bot values on BotConfiguration override these):
+# answer from the FAQ at or above FAQ_ANSWER_THRESHOLD, ground Gemini on the
+# top FAQs at or above FAQ_GROUNDING_THRESHOLD, otherwise call Gemini plainly
+FAQ_ANSWER_THRESHOLD = 0.75
+FAQ_GROUNDING_THRESHOLD = 0.35
+# Cosine similarity that maps to zero semantic confidence
+FAQ_SEMANTIC_FLOOR = 0.5
+
+# Prompt assembly: estimated token budget for template + FAQ passages + recent
+# turns + message, and how many earlier turns of a session are considered
+LLM_PROMPT_TOKEN_BUDGET = 2048
+LLM_HISTORY_TURNS = 6
+# Per-session memory (chat/memory.py): turns older than LLM_HISTORY_TURNS are
+# summarised, one line of at most LLM_MEMORY_SUMMARY_LINE_TOKENS each, in at
+# most LLM_MEMORY_SUMMARY_TOKENS; cached memory lives LLM_MEMORY_TTL seconds
+# and is rebuilt from the last LLM_MEMORY_REBUILD_MESSAGES messages when lost
+LLM_MEMORY_SUMMARY_LINE_TOKENS = 24
+LLM_MEMORY_SUMMARY_TOKENS = 256
+LLM_MEMORY_TTL = 60 * 60 * 24
+LLM_MEMORY_REBUILD_MESSAGES = 24
+# Longest (seconds) a resent message (same client_message_id) waits for the
+# reply still being computed for the original; above LLM_REQUEST_DEADLINE
+CHAT_REPLAY_WAIT = 90
+# Keep full assembled prompts in the recent LLM call log (they contain decrypted text)
+LLM_RECORD_PROMPTS = DEBUG
+
+# LLM client layer (chat/llm.py): GeminiBackend calls the Gemini API,
+# FakeBackend answers locally for offline development and tests
+LLM_BACKEND = 'chat.llm.GeminiBackend'
+# Seconds FakeBackend waits per streamed chunk, to simulate a slow model
+LLM_FAKE_DELAY = 0.0
+# Build the shared models and open the Gemini connection when the app starts
+LLM_WARM_UP = bool(GEMINI_API_KEY)
+
+# LLM dispatcher (chat/dispatch.py), per worker process: concurrent Gemini
+# calls overall and per bot, how many callers may wait for a slot and for how
+# long, retries with jittered exponential backoff (seconds), the overall
+# deadline for one call including retries, and the circuit breaker that
+# fails fast (answering from the FAQ) after repeated upstream failures
+LLM_MAX_CONCURRENCY = 16
+LLM_MAX_CONCURRENCY_PER_BOT = 8
+LLM_QUEUE_SIZE = 100
+LLM_QUEUE_TIMEOUT = 10.0
+LLM_MAX_RETRIES = 3
+LLM_RETRY_BASE_DELAY = 0.5
+LLM_RETRY_MAX_DELAY = 8.0
+LLM_REQUEST_DEADLINE = 60.0
+LLM_BREAKER_FAILURES = 5
+LLM_BREAKER_COOLDOWN = 30.0
+
+# Two-tier reply cache (chat/response_cache.py): an in-process LRU of
+# RESPONSE_CACHE_LOCAL_SIZE entries (each kept at most RESPONSE_CACHE_LOCAL_TTL
+# seconds) in front of the RESPONSE_CACHE_ALIAS cache, which should be shared
+# (Redis/Memcached) in production. RESPONSE_CACHE_TTL is the default lifetime
+# of a cached reply; BotConfiguration.response_cache_ttl overrides it per bot
+RESPONSE_CACHE_ALIAS = 'default'
+RESPONSE_CACHE_TTL = 60 * 5
+RESPONSE_CACHE_LOCAL_SIZE = 1024
+RESPONSE_CACHE_LOCAL_TTL = 60
+# Lifetime of cached retrieval decisions (FAQ answers and "no FAQ matched");
+# FAQ edits retire them sooner. Independent of BotConfiguration.response_cache_ttl,
+# which only applies to Gemini replies
+ANSWER_CACHE_TTL = 60 * 60
+
+# Reuse of earlier replies to near-duplicate standalone questions
+# (chat/near_duplicates.py): estimated Jaccard similarity needed, how old
+# (seconds) a reply may be, and the most exchanges each worker indexes
+NEAR_DUPLICATE_ENABLED = True
+NEAR_DUPLICATE_THRESHOLD = 0.85
+NEAR_DUPLICATE_WINDOW = 60 * 60 * 24 * 7
+NEAR_DUPLICATE_MAX_ENTRIES = 10000
+
+# Print EncryptedTextField decryption/encryption failures (they are always
+# counted as encryption.* metrics)
+ENCRYPTED_FIELD_DEBUG = False
+# Bulk encryption/decryption (decrypted() querysets, values(), bulk_create):
+# values per batch, and threads the batches are spread over. Fernet holds
+# the GIL for much of each value, so more threads have not been measured to
+# help (`manage.py bench_crypto` shows it for a host); with 1 everything runs
+# on the calling thread. Fewer than ENCRYPTION_PARALLEL_MIN_VALUES values are
+# never spread over threads.
+ENCRYPTION_BATCH_SIZE = 256
+ENCRYPTION_THREADS = 1
+ENCRYPTION_PARALLEL_MIN_VALUES = 4096
+# Compression of binary EncryptedTextField values before encryption: 'zlib',
+# 'zstd' (needs the zstandard package) or None. Values shorter than
+# ENCRYPTION_COMPRESS_MIN_BYTES, or that would not shrink, are stored as is.
+ENCRYPTION_COMPRESSION = 'zlib'
+ENCRYPTION_COMPRESS_MIN_BYTES = 128
+# Progress file of `manage.py reencrypt` (key rotation), so it can resume
+ENCRYPTION_REENCRYPT_CHECKPOINT = BASE_DIR / 'reencrypt_checkpoint.json'
+# Per-user data keys (chat/data_keys.py): seconds a worker keeps a key
+# unwrapped, and how deleted (shredded) history is purged afterwards
+DATA_KEY_CACHE_TTL = 300
+HISTORY_PURGE_IN_BACKGROUND = True
+HISTORY_PURGE_BATCH_SIZE = 500
+HISTORY_PURGE_SLEEP = 0.05
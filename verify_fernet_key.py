@@ -11,12 +11,14 @@ ENCRYPTION_KEY = os.environ.get("DJANGO_ENCRYPTION_KEY")
 if not ENCRYPTION_KEY:
     raise Exception("DJANGO_ENCRYPTION_KEY environment variable not set")
 
-# Validate Fernet key format
-try:
-    cipher_suite = Fernet(ENCRYPTION_KEY)
-    print("✅ Fernet key is valid")
-except Exception as e:
-    raise Exception(f"❌ Invalid Fernet key: {e}")
+# Validate Fernet key format (several comma-separated keys, newest first, while rotating)
+for key in [key.strip() for key in ENCRYPTION_KEY.split(',') if key.strip()]:
+    try:
+        Fernet(key)
+    except Exception as e:
+        raise Exception(f"❌ Invalid Fernet key: {e}")
+cipher_suite = Fernet(ENCRYPTION_KEY.split(',')[0].strip())
+print("✅ Fernet key is valid")
 
 # Generate test token and check prefix
 test_value = "Test Fernet token generation"